@@ -1,12 +1,95 @@
 from agents.base import BaseAgent
 from core.db_models import StockDaily
+from core.indicators import get_latest_indicators
+from core import clock
+from core.tick_buffer import tick_buffer
+from core.minute_bars import get_intraday_summary
+from core.prompt_codec import encode_rows
+import math
 import logging
-import datetime
+
+def format_indicators(ts_code):
+    """将最新技术指标整理为 Prompt 文本，无数据时返回 N/A"""
+    ind = get_latest_indicators(ts_code)
+    if not ind:
+        return "N/A"
+
+    def v(key):
+        val = ind.get(key)
+        return "N/A" if val is None else round(val, 2)
+
+    return (
+        f"As of {ind['trade_date']}: Close {v('close')}\n"
+        f"MA5/10/20/60: {v('ma5')} / {v('ma10')} / {v('ma20')} / {v('ma60')}\n"
+        f"MACD DIF/DEA/Hist: {v('macd_dif')} / {v('macd_dea')} / {v('macd_hist')}\n"
+        f"RSI14: {v('rsi14')}, ATR14: {v('atr14')}\n"
+        f"Bollinger Upper/Mid/Lower: {v('boll_upper')} / {v('boll_mid')} / {v('boll_lower')}\n"
+        f"Volume Ratio (vs 5D avg): {v('vol_ratio')}, 20D High/Low: {v('high20')} / {v('low20')}"
+    )
+
+def intraday_range(ts_code, current_price, quote_data=None):
+    """日内 (open, high, low, vwap)
+
+    开/高/低以交易所实时行情为准 (分钟线可能缺少开盘前后的成交)，高/低再用分钟线与当前价扩展；
+    分钟线仅用于 VWAP 及补齐行情缺失的字段，两者都没有时以当前价兜底。
+    """
+    quote = {}
+    for key in ('open', 'high', 'low'):
+        try:
+            value = float((quote_data or {}).get(key) or 0)
+        except (TypeError, ValueError) as e:
+            logging.warning(f"Error parsing quote {key} for {ts_code}: {e}")
+            value = 0
+        if value > 0:
+            quote[key] = value
+
+    summary = get_intraday_summary(ts_code) or {}
+    open_ = quote.get('open') or summary.get('open') or current_price
+    highs = [v for v in (quote.get('high'), summary.get('high'), current_price) if v]
+    lows = [v for v in (quote.get('low'), summary.get('low'), current_price) if v]
+    vwap = summary.get('vwap')
+    return open_, max(highs), min(lows), vwap if vwap is not None else 'N/A'
+
+# 各模板单只股票报告的校验规则 (批量结果逐条校验，不合格的改为单只重新分析)
+REPORT_SCHEMAS = {
+    'analysis_intra_day.j2': {'required': ('ts_code', 'action', 'reason', 'confidence'),
+                              'actions': ('BUY', 'HOLD', 'SELL_ALL', 'SELL_HALF')},
+    'analysis_pre_close.j2': {'required': ('ts_code', 'action', 'reason'),
+                              'actions': ('HOLD', 'SELL_ALL', 'SELL_HALF')},
+}
+
+# 单只模板 -> 多只合并模板
+BATCH_TEMPLATES = {
+    'analysis_intra_day.j2': 'analysis_intra_day_batch.j2',
+    'analysis_pre_close.j2': 'analysis_pre_close_batch.j2',
+}
+
+def validate_report(report, ts_code, template_name):
+    """报告是否符合该模板的单只股票 Schema (代码一致、必填字段齐全、操作合法、信心分数在 0-10)"""
+    schema = REPORT_SCHEMAS[template_name]
+    if not isinstance(report, dict) or str(report.get('ts_code', '')).strip().upper() != ts_code:
+        return False
+    if any(report.get(field) in (None, '') for field in schema['required']):
+        return False
+    if report['action'] not in schema['actions']:
+        return False
+    if 'confidence' in schema['required']:
+        try:
+            return 0 <= float(report['confidence']) <= 10
+        except (TypeError, ValueError):
+            return False
+    return True
+
+def batch_reports(result):
+    """合并模板的返回 -> 报告列表 ({"reports": [...]} 或直接返回数组)"""
+    if isinstance(result, dict):
+        result = result.get('reports')
+    return result if isinstance(result, list) else []
 
 class AnalystAgent(BaseAgent):
     def analyze_pre_market(self, ts_code, news_context="", realtime_quote=None):
         """开盘前分析"""
-        current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        current_time = clock.now().strftime("%Y-%m-%d %H:%M:%S")
 
         # 获取最近30天数据 (约1.5个月)
         # 30天数据足以让LLM识别近期趋势(如20日均线形态)和关键支撑/压力位，
@@ -15,9 +98,10 @@ class AnalystAgent(BaseAgent):
         # 将记录反转，按时间正序排列
         records = sorted(records, key=lambda r: r.trade_date)
         
-        history_data = ""
-        for r in records:
-            history_data += f"Date: {r.trade_date}, Open: {r.open}, Close: {r.close}, High: {r.high}, Low: {r.low}, Vol: {r.vol}, Pct: {r.pct_chg}%\n"
+        # 紧凑表格 (date|open|high|low|close|vol|pct)，超出预算时保留最近的行
+        history_rows = encode_rows(['date', 'open', 'high', 'low', 'close', 'vol', 'pct'],
+                                   [[r.trade_date, r.open, r.high, r.low, r.close, r.vol, r.pct_chg] for r in records],
+                                   {'vol': 0})
 
         # 整理实时竞价数据
         auction_info = "N/A"
@@ -35,45 +119,130 @@ class AnalystAgent(BaseAgent):
             except:
                 pass
 
-        prompt = self.render_prompt('analysis_pre_market.j2', 
-                                    ts_code=ts_code, 
-                                    history_data=history_data,
-                                    news_context=news_context,
+        prompt = self.render_prompt('analysis_pre_market.j2',
+                                    truncate=[('history_data', 'tail', 1), ('news_context', 'head', 0)],
+                                    ts_code=ts_code,
+                                    history_data=history_rows,
+                                    indicators=format_indicators(ts_code),
+                                    news_context=(news_context or '').splitlines(),
                                     auction_info=auction_info,
                                     current_time=current_time)
         
         logging.info(f"Analyst processing {ts_code}...")
-        result = self.call_llm(prompt, json_mode=True)
+        result = self.call_llm(prompt, json_mode=True, template_name='analysis_pre_market.j2')
         return result
 
-    def analyze_pre_close(self, position):
+    def analyze_pre_close(self, position, quote_data=None):
         """收盘前分析"""
-        current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        
+        prompt = self._build_pre_close_prompt(position, quote_data)
+        logging.info(f"Analyst reviewing holding {position.ts_code}...")
+        result = self.call_llm(prompt, json_mode=True, template_name='analysis_pre_close.j2')
+        return result
+
+    def analyze_pre_close_many(self, positions, quotes=None):
+        """收盘前分析 (批量并发提交，按 analyst_batch_size 合并为多只股票一个 Prompt)
+        :param quotes: 与 positions 一一对应的实时行情 (无则 None)
+        """
+        quotes = quotes or [None] * len(positions)
+        contexts = [self._pre_close_context(pos, quote) for pos, quote in zip(positions, quotes)]
+        logging.info(f"Analyst reviewing {len(contexts)} holdings concurrently...")
+        return self._analyze_many('analysis_pre_close.j2', contexts)
+
+    def _analyze_many(self, template_name, contexts):
+        """
+        并发分析多只股票，返回与 contexts 一一对应的报告 (失败为 None)
+        batch_size > 1 时按不超过 batch_size 只均分为若干组，每组合并为一个 Prompt 并发提交，
+        逐条校验返回的报告，缺失或不合格的股票再单独调用单只模板
+        """
+        batch_size = int(self.settings.get('analyst_batch_size') or 1)
+        results = [None] * len(contexts)
+        singles = list(range(len(contexts)))
+        if batch_size > 1 and len(contexts) > 1:
+            batch_template = BATCH_TEMPLATES[template_name]
+            # 均分 (如 11 只、每组至多 5 只 -> 4/4/3)，避免剩下单只的小组
+            n_groups = math.ceil(len(contexts) / batch_size)
+            size, extra = divmod(len(contexts), n_groups)
+            groups, start = [], 0
+            for g in range(n_groups):
+                end = start + size + (1 if g < extra else 0)
+                groups.append(list(range(start, end)))
+                start = end
+            current_time = clock.now().strftime("%Y-%m-%d %H:%M:%S")
+            prompts = [self.render_prompt(batch_template, stocks=[contexts[i] for i in g], current_time=current_time)
+                       for g in groups]
+            replies = self.call_llm_many(prompts, json_mode=True, template_name=batch_template)
+            retried = []
+            for group, reply in zip(groups, replies):
+                by_code = {}
+                for report in batch_reports(reply):
+                    if isinstance(report, dict):
+                        by_code.setdefault(str(report.get('ts_code', '')).strip().upper(), report)
+                for idx in group:
+                    ts_code = contexts[idx]['ts_code']
+                    report = by_code.get(ts_code)
+                    if validate_report(report, ts_code, template_name):
+                        results[idx] = dict(report, ts_code=ts_code)
+                    else:
+                        retried.append(idx)
+            if retried:
+                logging.warning(f"Batched {batch_template}: {len(retried)}/{len(contexts)} reports missing or invalid, "
+                                f"retrying individually: {[contexts[i]['ts_code'] for i in retried]}")
+            singles = retried
+
+        if singles:
+            prompts = [self.render_prompt(template_name, **contexts[i]) for i in singles]
+            for idx, report in zip(singles, self.call_llm_many(prompts, json_mode=True, template_name=template_name)):
+                results[idx] = report
+        return results
+
+    def _build_pre_close_prompt(self, position, quote_data=None):
+        return self.render_prompt('analysis_pre_close.j2', **self._pre_close_context(position, quote_data))
+
+    def _pre_close_context(self, position, quote_data=None):
+        """收盘前分析的单只股票模板变量"""
+        current_time = clock.now().strftime("%Y-%m-%d %H:%M:%S")
+
         # 假设 position 已包含最新实时价格信息(在外部循环更新过)
         pnl_pct = 0.0
         if position.avg_price > 0:
             pnl_pct = round((position.current_price - position.avg_price) / position.avg_price * 100, 2)
 
-        prompt = self.render_prompt('analysis_pre_close.j2',
-                                    ts_code=position.ts_code,
-                                    volume=position.volume,
-                                    avg_price=position.avg_price,
-                                    current_price=position.current_price,
-                                    pnl_pct=pnl_pct,
-                                    open=position.current_price, # 暂用当前价代替，实际应从Tushare取当日Open
-                                    high=position.current_price,
-                                    low=position.current_price,
-                                    close=position.current_price,
-                                    current_time=current_time)
-        
-        logging.info(f"Analyst reviewing holding {position.ts_code}...")
-        result = self.call_llm(prompt, json_mode=True)
-        return result
+        open_p, high_p, low_p, vwap = intraday_range(position.ts_code, position.current_price, quote_data)
+
+        return dict(ts_code=position.ts_code,
+                    volume=position.volume,
+                    avg_price=position.avg_price,
+                    current_price=position.current_price,
+                    pnl_pct=pnl_pct,
+                    open=open_p,
+                    high=high_p,
+                    low=low_p,
+                    close=position.current_price,
+                    vwap=vwap,
+                    current_time=current_time)
 
     def analyze_intra_day(self, ts_code, current_price, position=None, quote_data=None):
         """盘中(午间)分析: 支持持仓和非持仓"""
-        current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        prompt = self._build_intra_day_prompt(ts_code, current_price, position, quote_data)
+        logging.info(f"Analyst (Intra-day) reviewing {ts_code} (Holding: {position is not None})...")
+        result = self.call_llm(prompt, json_mode=True, template_name='analysis_intra_day.j2')
+        return result
+
+    def analyze_intra_day_many(self, items):
+        """盘中分析 (批量并发提交，按 analyst_batch_size 合并为多只股票一个 Prompt)
+        :param items: [(ts_code, current_price, position, quote_data), ...]
+        """
+        contexts = [self._intra_day_context(*item) for item in items]
+        logging.info(f"Analyst (Intra-day) reviewing {len(contexts)} stocks concurrently...")
+        return self._analyze_many('analysis_intra_day.j2', contexts)
+
+    def _build_intra_day_prompt(self, ts_code, current_price, position=None, quote_data=None):
+        return self.render_prompt('analysis_intra_day.j2',
+                                  **self._intra_day_context(ts_code, current_price, position, quote_data))
+
+    def _intra_day_context(self, ts_code, current_price, position=None, quote_data=None):
+        """盘中分析的单只股票模板变量"""
+        current_time = clock.now().strftime("%Y-%m-%d %H:%M:%S")
         
         is_holding = False
         volume = 0
@@ -87,50 +256,30 @@ class AnalystAgent(BaseAgent):
             if avg_price > 0:
                 pnl_pct = round((current_price - avg_price) / avg_price * 100, 2)
         
-        # 默认值
-        open_p = current_price
-        high_p = current_price
-        low_p = current_price
-        close_p = current_price
+        open_p, high_p, low_p, vwap = intraday_range(ts_code, current_price, quote_data)
 
-        if quote_data:
-            try:
-                open_p = float(quote_data.get('open', open_p))
-                high_p = float(quote_data.get('high', high_p))
-                low_p = float(quote_data.get('low', low_p))
-                # 兼容 price 或 close
-                close_p = float(quote_data.get('price', quote_data.get('close', close_p)))
-            except Exception as e:
-                logging.warning(f"Error parsing quote data: {e}")
-
-        prompt = self.render_prompt('analysis_intra_day.j2', 
-                                    ts_code=ts_code, 
-                                    is_holding=is_holding,
-                                    volume=volume,
-                                    avg_price=avg_price,
-                                    current_price=current_price,
-                                    pnl_pct=pnl_pct,
-                                    open=open_p, 
-                                    high=high_p,
-                                    low=low_p,
-                                    close=close_p,
-                                    current_time=current_time)
-        
-        logging.info(f"Analyst (Intra-day) reviewing {ts_code} (Holding: {is_holding})...")
-        result = self.call_llm(prompt, json_mode=True)
-        return result
+        return dict(ts_code=ts_code,
+                    is_holding=is_holding,
+                    indicators=format_indicators(ts_code),
+                    volume=volume,
+                    avg_price=avg_price,
+                    current_price=current_price,
+                    pnl_pct=pnl_pct,
+                    open=open_p,
+                    high=high_p,
+                    low=low_p,
+                    close=current_price,
+                    vwap=vwap,
+                    current_time=current_time)
 
     def analyze_trigger(self, monitor, current_price, quote_data):
         """处理价格触发事件"""
-        current_time = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        current_time = clock.now().strftime("%Y-%m-%d %H:%M:%S")
         
         quote_info = "N/A"
-        open_p, high_p, low_p = 0, 0, 0
-        
+        open_p, high_p, low_p, vwap = intraday_range(monitor.ts_code, current_price, quote_data)
+
         if quote_data:
-            open_p = quote_data.get('open', 0)
-            high_p = quote_data.get('high', 0)
-            low_p = quote_data.get('low', 0)
             b1 = quote_data.get('bid1', 0)
             a1 = quote_data.get('ask1', 0)
             v = quote_data.get('volume', 0)
@@ -150,9 +299,10 @@ class AnalystAgent(BaseAgent):
             open=open_p,
             high=high_p,
             low=low_p,
-            history_trend="N/A"
+            vwap=vwap,
+            history_trend=tick_buffer.format_history(monitor.ts_code)
         )
         
         logging.info(f"Analyst analyzing trigger for {monitor.ts_code}...")
-        result = self.call_llm(prompt, json_mode=True)
+        result = self.call_llm(prompt, json_mode=True, template_name='analysis_trigger.j2')
         return result
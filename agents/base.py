@@ -1,31 +1,79 @@
 import os
 import logging
 import json
+import time
+import random
+import asyncio
 import itertools
-from openai import OpenAI
+import threading
+import openai
+from openai import OpenAI, AsyncOpenAI
 from jinja2 import Environment, FileSystemLoader
 from dotenv import load_dotenv
+from core.llm_cache import llm_cache
+from core.llm_stats import llm_recorder
+from core.prompt_codec import count_tokens, fit_prompt
+from core import routine_context
+from core.tracing import traced
 
 load_dotenv()
 
+# 可重试的瞬时错误: 429 限流 / 5xx / 超时 / 连接异常
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+    asyncio.TimeoutError,
+)
+
 class BaseAgent:
+    # LLM 传输参数默认值，可通过 config.yaml 的 llm 段覆盖 (见 configure)
+    settings = {
+        'timeout': 60,              # 单次请求超时(秒)
+        'deadline': 180,            # 单次调用总时限(含重试, 秒)
+        'max_retries': 3,           # 瞬时错误最大重试次数
+        'backoff_base': 1.0,        # 退避基数(秒), 指数增长并加随机抖动
+        'backoff_max': 20.0,        # 单次退避上限(秒)
+        'max_inflight_per_key': 4,  # 异步模式下每个 Key 的最大并发请求数
+        'prompt_budgets': {},       # 各模板的 Prompt token 预算 {template_name: tokens, 'default': tokens}
+        'analyst_batch_size': 1,    # 盘中/尾盘分析每个 Prompt 合并的股票数 (1 为逐只分析)
+    }
+
+    # 可插拔的 LLM 实现 (如回放用的确定性替身)，签名: backend(prompt, json_mode, template_name)
+    llm_backend = None
+
+    @classmethod
+    def configure(cls, llm_config=None):
+        """从 config.yaml 的 llm 段加载传输参数"""
+        if llm_config:
+            cls.settings = {**cls.settings, **llm_config}
+            llm_cache.configure(llm_config.get('cache'))
+            llm_recorder.configure(llm_config.get('call_log'))
+
     def __init__(self):
         # Support multiple API keys separated by commas for rotation
         api_keys_str = os.getenv("LLM_API_KEY", "")
         self.api_keys = [k.strip() for k in api_keys_str.split(',') if k.strip()]
         self.base_url = os.getenv("LLM_BASE_URL")
         self.model_name = os.getenv("LLM_MODEL_ID", "Qwen/Qwen3-8B")
-        
+
         if not self.api_keys:
             logging.warning("No LLM_API_KEY found")
             self.clients = []
             self.client_cycle = None
         else:
+            # 重试由 call_llm 自行控制 (轮换 Key + 抖动退避)，关闭 SDK 内置重试
             self.clients = [
-                OpenAI(api_key=k, base_url=self.base_url) 
+                OpenAI(api_key=k, base_url=self.base_url, max_retries=0)
                 for k in self.api_keys
             ]
-            self.client_cycle = itertools.cycle(self.clients)
+            # 轮换的是 Key 下标，同步/异步客户端共用同一轮换顺序
+            self.client_cycle = itertools.cycle(range(len(self.clients)))
+        self._cycle_lock = threading.Lock()
+
+        # 异步客户端与事件循环绑定，按 loop 分别维护
+        self._async_pools = {}
 
         extra_body = {
             # enable thinking, set to False to disable test
@@ -34,32 +82,234 @@ class BaseAgent:
             # "thinking_budget": 4096
         }
         self.extra_body = extra_body
-        
+
         self.jinja_env = Environment(loader=FileSystemLoader('prompts'))
 
-    def call_llm(self, prompt, json_mode=False):
-        try:
-            if not self.clients or not self.client_cycle:
-                logging.error("No available LLM clients configured")
-                return None
-                
-            # Get next client in rotation
-            client = next(self.client_cycle)
-            
-            response = client.chat.completions.create(
-                model=self.model_name,
-                messages=[{"role": "user", "content": prompt}],
-                response_format={"type": "json_object"} if json_mode else None,
-                extra_body=self.extra_body
-            )
-            content = response.choices[0].message.content
-            if json_mode:
+    def _next_key_index(self):
+        with self._cycle_lock:
+            return next(self.client_cycle)
+
+    def _retry_delay(self, error, attempt, deadline):
+        """返回下次重试前的等待秒数；不可重试或超出总时限时返回 None"""
+        if not isinstance(error, RETRYABLE_ERRORS) or attempt >= self.settings['max_retries']:
+            return None
+        cap = min(self.settings['backoff_max'], self.settings['backoff_base'] * (2 ** attempt))
+        delay = random.uniform(cap / 2, cap)
+        if time.monotonic() + delay >= deadline:
+            return None
+        return delay
+
+    def _request_timeout(self, deadline):
+        return max(1.0, min(self.settings['timeout'], deadline - time.monotonic()))
+
+    def _request_kwargs(self, prompt, json_mode, deadline):
+        return dict(
+            model=self.model_name,
+            messages=[{"role": "user", "content": prompt}],
+            response_format={"type": "json_object"} if json_mode else None,
+            extra_body=self.extra_body,
+            timeout=self._request_timeout(deadline)
+        )
+
+    def _parse_content(self, content, json_mode):
+        if json_mode:
+            try:
                 return json.loads(content)
-            return content
-        except Exception as e:
-            logging.error(f"LLM call failed: {e}")
+            except (TypeError, ValueError) as e:
+                logging.error(f"LLM returned invalid JSON: {e}")
+                return None
+        return content
+
+    def _cached_result(self, prompt, json_mode, template_name):
+        cached = llm_cache.get(self.model_name, template_name, prompt, json_mode)
+        if cached is None:
+            return None
+        return self._parse_content(cached, json_mode)
+
+    def _store_result(self, prompt, json_mode, template_name, content, result):
+        # 仅缓存可正常解析的响应
+        if result is not None:
+            llm_cache.put(self.model_name, template_name, prompt, json_mode, content)
+
+    def _record_call(self, template_name, key_index, attempt, started, prompt, response=None, content=None,
+                     result=None, json_mode=False, error=None, model_name=None, status=None):
+        """记录一次请求尝试 (延迟、tokens、解析结果)；响应未带 usage 时按近似计数估算 tokens"""
+        if error is not None:
+            status = 'ERROR'
+        elif status is None:
+            status = 'INVALID_JSON' if json_mode and result is None else 'OK'
+        usage = getattr(response, 'usage', None)
+        if usage is not None:
+            prompt_tokens, completion_tokens = usage.prompt_tokens, usage.completion_tokens
+        elif status in ('OK', 'INVALID_JSON'):
+            prompt_tokens, completion_tokens = count_tokens(prompt), count_tokens(content)
+        else:
+            prompt_tokens = completion_tokens = 0
+        llm_recorder.record(template_name, model_name or self.model_name, key_index, attempt,
+                            (time.monotonic() - started) * 1000, status,
+                            prompt_tokens, completion_tokens, error)
+
+    def _call_backend(self, backend, prompt, json_mode, template_name):
+        started = time.monotonic()
+        result = backend(prompt, json_mode, template_name)
+        content = json.dumps(result, ensure_ascii=False) if json_mode and result is not None else result
+        self._record_call(template_name, None, 0, started, prompt, content=content, result=result,
+                          json_mode=json_mode, model_name=getattr(backend, '__name__', type(backend).__name__))
+        return result
+
+    def _cached_call(self, prompt, json_mode, template_name):
+        started = time.monotonic()
+        cached = self._cached_result(prompt, json_mode, template_name)
+        if cached is not None:
+            self._record_call(template_name, None, 0, started, prompt, status='CACHED')
+        return cached
+
+    @traced('llm')
+    def call_llm(self, prompt, json_mode=False, template_name=None):
+        backend = type(self).llm_backend  # 经类访问，避免普通函数被绑定为方法
+        if backend is not None:
+            return self._call_backend(backend, prompt, json_mode, template_name)
+
+        if not self.clients or not self.client_cycle:
+            logging.error("No available LLM clients configured")
             return None
 
-    def render_prompt(self, template_name, **kwargs):
+        cached = self._cached_call(prompt, json_mode, template_name)
+        if cached is not None:
+            return cached
+
+        deadline = time.monotonic() + self.settings['deadline']
+        attempt = 0
+        while True:
+            # Get next client in rotation (重试时自动换 Key)
+            key_index = self._next_key_index()
+            started = time.monotonic()
+            try:
+                response = self.clients[key_index].chat.completions.create(
+                    **self._request_kwargs(prompt, json_mode, deadline)
+                )
+                content = response.choices[0].message.content
+                result = self._parse_content(content, json_mode)
+                self._record_call(template_name, key_index, attempt, started, prompt, response, content, result, json_mode)
+                self._store_result(prompt, json_mode, template_name, content, result)
+                return result
+            except Exception as e:
+                self._record_call(template_name, key_index, attempt, started, prompt, error=e)
+                delay = self._retry_delay(e, attempt, deadline)
+                if delay is None:
+                    logging.error(f"LLM call failed (key #{key_index}, attempt {attempt + 1}): {e}")
+                    return None
+                logging.warning(f"LLM transient error (key #{key_index}): {e}. Retrying in {delay:.1f}s")
+                time.sleep(delay)
+                attempt += 1
+
+    def _get_async_pool(self):
+        """当前事件循环下的 [(AsyncOpenAI, Semaphore)]，每个 Key 一组"""
+        loop = asyncio.get_running_loop()
+        pool = self._async_pools.get(loop)
+        if pool is None:
+            limit = max(1, int(self.settings['max_inflight_per_key']))
+            pool = [
+                (AsyncOpenAI(api_key=k, base_url=self.base_url, max_retries=0), asyncio.Semaphore(limit))
+                for k in self.api_keys
+            ]
+            self._async_pools[loop] = pool
+        return pool
+
+    async def _close_async_pool(self):
+        pool = self._async_pools.pop(asyncio.get_running_loop(), None)
+        for client, _ in pool or []:
+            await client.close()
+
+    async def _acall_with_retry(self, prompt, json_mode, template_name, deadline):
+        pool = self._get_async_pool()
+        attempt = 0
+        while True:
+            key_index = self._next_key_index()
+            client, semaphore = pool[key_index]
+            started = time.monotonic()
+            try:
+                async with semaphore:
+                    started = time.monotonic()  # 延迟不含等待信号量的时间
+                    response = await client.chat.completions.create(
+                        **self._request_kwargs(prompt, json_mode, deadline)
+                    )
+                content = response.choices[0].message.content
+                result = self._parse_content(content, json_mode)
+                self._record_call(template_name, key_index, attempt, started, prompt, response, content, result, json_mode)
+                self._store_result(prompt, json_mode, template_name, content, result)
+                return result
+            except Exception as e:
+                self._record_call(template_name, key_index, attempt, started, prompt, error=e)
+                delay = self._retry_delay(e, attempt, deadline)
+                if delay is None:
+                    logging.error(f"Async LLM call failed (key #{key_index}, attempt {attempt + 1}): {e}")
+                    return None
+                logging.warning(f"Async LLM transient error (key #{key_index}): {e}. Retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    @traced('llm')
+    async def acall_llm(self, prompt, json_mode=False, template_name=None):
+        """异步调用: 每个 Key 限制并发，瞬时错误抖动退避重试，并强制总时限"""
+        backend = type(self).llm_backend  # 经类访问，避免普通函数被绑定为方法
+        if backend is not None:
+            return self._call_backend(backend, prompt, json_mode, template_name)
+
+        if not self.api_keys:
+            logging.error("No available LLM clients configured")
+            return None
+
+        cached = self._cached_call(prompt, json_mode, template_name)
+        if cached is not None:
+            return cached
+
+        total = self.settings['deadline']
+        deadline = time.monotonic() + total
+        try:
+            return await asyncio.wait_for(self._acall_with_retry(prompt, json_mode, template_name, deadline), timeout=total)
+        except asyncio.TimeoutError:
+            logging.error(f"LLM call exceeded total deadline of {total}s")
+            return None
+
+    @traced('llm')
+    def call_llm_many(self, prompts, json_mode=False, template_name=None):
+        """并发提交多个 Prompt 并按输入顺序返回结果 (失败项为 None)"""
+        prompts = list(prompts)
+        if not prompts:
+            return []
+
+        async def _gather():
+            try:
+                return await asyncio.gather(*(self.acall_llm(p, json_mode=json_mode, template_name=template_name) for p in prompts))
+            finally:
+                await self._close_async_pool()
+
+        return list(asyncio.run(_gather()))
+
+    def prompt_budget(self, template_name):
+        budgets = self.settings.get('prompt_budgets') or {}
+        return budgets.get(template_name, budgets.get('default'))
+
+    @traced('jinja')
+    def render_prompt(self, template_name, truncate=None, **kwargs):
+        """
+        渲染 Prompt 并按模板的 token 预算确定性裁剪，token 数计入当前流程
+        :param truncate: [(变量名, keep, header)]，这些变量以行列表传入，超预算时按顺序裁剪
+                         (keep='head' 保留开头，'tail' 保留末尾；header 为始终保留的表头行数)
+        """
         template = self.jinja_env.get_template(template_name)
-        return template.render(**kwargs)
+        sections = [(name, list(kwargs.pop(name) or []), keep, header) for name, keep, header in truncate or []]
+        before = [None]
+
+        def render(**overrides):
+            text = template.render(**kwargs, **overrides)
+            if before[0] is None:
+                before[0] = count_tokens(text)
+            return text
+
+        prompt, after, truncated = fit_prompt(render, sections, self.prompt_budget(template_name))
+        if truncated:
+            logging.info(f"Prompt {template_name} truncated: {before[0]} -> {after} tokens")
+        routine_context.record_prompt(template_name, before[0], after, truncated)
+        return prompt
@@ -1,5 +1,6 @@
 from agents.base import BaseAgent
-from core.db_models import Account, Position
+from core.ledger import ledger
+from core.prompt_codec import encode_reports
 import logging
 
 class DecisionMakerAgent(BaseAgent):
@@ -13,10 +14,14 @@ class DecisionMakerAgent(BaseAgent):
         
         if not buy_candidates:
             return []
+        # 按信心分数从高到低，超出 Prompt 预算时裁掉分数最低的
+        buy_candidates.sort(key=lambda r: float(r.get('confidence', 0)), reverse=True)
 
-        account = Account.select().first()
-        if not account:
-            logging.error("Account not found!")
+        # 账本快照: 资金与持仓取自同一版本 (不读库)
+        try:
+            account = ledger.snapshot()
+        except RuntimeError as e:
+            logging.error(f"Account not found! {e}")
             return []
         
         # 计算总资产和单只个股限额
@@ -24,19 +29,19 @@ class DecisionMakerAgent(BaseAgent):
         max_single_position = round(total_assets * max_position_pct, 2)
         
         # 获取当前持仓用于上下文(避免重复买入同类?)
-        positions = Position.select()
-        holdings_summary = ", ".join([p.ts_code for p in positions])
+        holdings_summary = ", ".join(account.holdings())
 
         # 渲染Prompt
         prompt = self.render_prompt('decision_maker.j2',
+                                    truncate=[('analyst_reports', 'head', 1)],
                                     cash=account.cash,
                                     holdings_summary=holdings_summary,
-                                    analyst_reports=str(buy_candidates),
+                                    analyst_reports=encode_reports(buy_candidates),
                                     max_buy_count=5,
                                     max_single_position=max_single_position) # 假设每次最多买5只
 
         logging.info("Decision Maker evaluating buy candidates...")
-        result = self.call_llm(prompt, json_mode=True)
+        result = self.call_llm(prompt, json_mode=True, template_name='decision_maker.j2')
         
         if result and 'orders' in result:
             orders = result['orders']
@@ -84,8 +89,8 @@ class DecisionMakerAgent(BaseAgent):
         if action == 'BUY':
              # 简单的风控：单笔不超过 20% 现金 或 50000
              try:
-                 account = Account.select().first()
-                 if account and account.cash > 5000:
+                 account = ledger.snapshot()
+                 if account.cash > 5000:
                      budget = min(50000, account.cash * 0.2)
                      orders.append({
                          'ts_code': ts_code,
@@ -99,12 +104,12 @@ class DecisionMakerAgent(BaseAgent):
 
         elif action in ['SELL', 'STOP_LOSS', 'TAKE_PROFIT']:
              try:
-                 pos = Position.select().where(Position.ts_code == ts_code).first()
-                 if pos and pos.volume_available > 0:
+                 pos = ledger.snapshot().position(ts_code)
+                 if pos and pos['volume_available'] > 0:
                      orders.append({
                          'ts_code': ts_code,
                          'action': 'SELL',
-                         'volume': pos.volume_available, # 默认清仓，后续可精细化
+                         'volume': pos['volume_available'], # 默认清仓，后续可精细化
                          'price': limit_price,
                          'reason': f"Trigger Exec: {reason}"
                      })
@@ -0,0 +1,81 @@
+"""价格监控检查性能: 逐条扫描 (旧版 run_check) vs 内存二分索引 MonitorIndex
+
+用法 (在项目根目录):
+    python -m benchmarks.bench_monitor_index --codes 500 --monitors 5000
+"""
+import os
+import time
+import argparse
+import tempfile
+import numpy as np
+from peewee import SqliteDatabase
+from core.db_models import PriceMonitor
+from core.monitor import MonitorIndex
+
+def seed(n_codes, n_monitors, rng):
+    codes = [f"{i:06d}.SZ" for i in range(n_codes)]
+    base = {c: float(p) for c, p in zip(codes, rng.uniform(5, 100, n_codes).round(2))}
+    rows = []
+    for i in range(n_monitors):
+        code = codes[i % n_codes]
+        operator = 'gt' if rng.random() < 0.5 else 'lt'
+        offset = rng.uniform(0.002, 0.08) * (1 if operator == 'gt' else -1)
+        rows.append({'ts_code': code, 'operator': operator,
+                     'trigger_price': round(base[code] * (1 + offset), 2), 'monitor_type': 'signal'})
+    PriceMonitor.insert_many(rows).execute()
+    return base
+
+def legacy_scan(prices):
+    """基线: 每次全表查询并逐条比较 (与优化前 run_check 相同)"""
+    triggered, warnings = [], []
+    for m in PriceMonitor.select().where((PriceMonitor.status == 'ACTIVE') & PriceMonitor.is_active):
+        price = prices.get(m.ts_code)
+        if price is None:
+            continue
+        if (m.operator == 'gt' and price >= m.trigger_price) or (m.operator == 'lt' and price <= m.trigger_price):
+            triggered.append(m.id)
+        elif not m.warning_sent and abs(price - m.trigger_price) / m.trigger_price * 100 <= 1.0:
+            warnings.append(m.id)
+    return sorted(triggered), sorted(warnings)
+
+def index_scan(index, prices):
+    index.refresh()
+    triggered, warnings = index.scan(prices)
+    return sorted(m.id for m, _ in triggered), sorted(m.id for m, _, _ in warnings)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="PriceMonitor check benchmark")
+    parser.add_argument('--codes', type=int, default=500)
+    parser.add_argument('--monitors', type=int, default=5000)
+    parser.add_argument('--ticks', type=int, default=20)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(7)
+    with tempfile.TemporaryDirectory() as tmp:
+        database = SqliteDatabase(os.path.join(tmp, 'bench.db'), pragmas={'journal_mode': 'wal'})
+        with database.bind_ctx([PriceMonitor]):
+            database.create_tables([PriceMonitor])
+            base = seed(args.codes, args.monitors, rng)
+            ticks = [{c: round(p * (1 + rng.normal(0, 0.02)), 2) for c, p in base.items()}
+                     for _ in range(args.ticks)]
+
+            index = MonitorIndex()
+            start = time.perf_counter()
+            index.refresh()
+            build = time.perf_counter() - start
+
+            start = time.perf_counter()
+            expected = [legacy_scan(t) for t in ticks]
+            legacy = (time.perf_counter() - start) / args.ticks
+
+            start = time.perf_counter()
+            actual = [index_scan(index, t) for t in ticks]
+            indexed = (time.perf_counter() - start) / args.ticks
+            assert actual == expected, "index results differ from linear scan"
+        database.close()
+
+    print(f"{args.monitors} monitors / {args.codes} codes")
+    print(f"index build   {build * 1000:8.2f} ms")
+    print(f"legacy check  {legacy * 1000:8.2f} ms/tick")
+    print(f"index check   {indexed * 1000:8.2f} ms/tick  (incl. change detection)")
+    print(f"speedup: {legacy / indexed:.1f}x")
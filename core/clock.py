@@ -0,0 +1,38 @@
+import datetime
+import threading
+
+class SystemClock:
+    """系统时钟 (默认)"""
+    def now(self):
+        return datetime.datetime.now()
+
+class SimulatedClock:
+    """模拟时钟: 仅在显式 set/advance 时前进，用于历史回放"""
+    def __init__(self, start=None):
+        self._now = start or datetime.datetime.now()
+        self._lock = threading.Lock()
+
+    def set(self, dt):
+        with self._lock:
+            self._now = dt
+
+    def advance(self, **kwargs):
+        with self._lock:
+            self._now += datetime.timedelta(**kwargs)
+
+    def now(self):
+        with self._lock:
+            return self._now
+
+_clock = SystemClock()
+
+def now():
+    """业务逻辑统一使用的当前时间 (回放时为模拟时间)"""
+    return _clock.now()
+
+def set_clock(clock):
+    global _clock
+    _clock = clock
+
+def reset_clock():
+    set_clock(SystemClock())
@@ -1,7 +1,11 @@
 from peewee import *
 from playhouse.migrate import *
 import datetime
+import itertools
+import sqlite3
+import logging
 import os
+from core import clock
 
 # 确保 data 目录存在
 os.makedirs('data', exist_ok=True)
@@ -31,6 +35,78 @@ class StockDaily(BaseModel):
             (('ts_code', 'trade_date'), True), # 联合唯一索引
         )
 
+class StockDailyBasic(BaseModel):
+    """每日指标 (daily_basic)"""
+    ts_code = CharField(index=True)
+    trade_date = CharField(index=True)  # YYYYMMDD
+    close = FloatField(null=True)
+    turnover_rate = FloatField(null=True)   # 换手率
+    turnover_rate_f = FloatField(null=True) # 换手率(自由流通股)
+    volume_ratio = FloatField(null=True)    # 量比
+    pe = FloatField(null=True)
+    pe_ttm = FloatField(null=True)
+    pb = FloatField(null=True)
+    total_share = FloatField(null=True)     # 总股本(万股)
+    float_share = FloatField(null=True)     # 流通股本(万股)
+    total_mv = FloatField(null=True)        # 总市值(万元)
+    circ_mv = FloatField(null=True)         # 流通市值(万元)
+
+    class Meta:
+        indexes = (
+            (('ts_code', 'trade_date'), True),
+        )
+
+class StockIndicator(BaseModel):
+    """日线技术指标 (由 IndicatorEngine 批量计算落库)"""
+    ts_code = CharField(index=True)
+    trade_date = CharField(index=True)  # YYYYMMDD
+    close = FloatField(null=True)
+    ma5 = FloatField(null=True)
+    ma10 = FloatField(null=True)
+    ma20 = FloatField(null=True)
+    ma60 = FloatField(null=True)
+    ema12 = FloatField(null=True)
+    ema26 = FloatField(null=True)
+    macd_dif = FloatField(null=True)
+    macd_dea = FloatField(null=True)
+    macd_hist = FloatField(null=True)
+    rsi14 = FloatField(null=True)
+    atr14 = FloatField(null=True)
+    boll_upper = FloatField(null=True)
+    boll_mid = FloatField(null=True)
+    boll_lower = FloatField(null=True)
+    vol_ratio = FloatField(null=True)   # 当日量 / 前5日均量
+    high20 = FloatField(null=True)      # 20日最高
+    low20 = FloatField(null=True)       # 20日最低
+
+    class Meta:
+        indexes = (
+            (('ts_code', 'trade_date'), True),
+        )
+
+class DataSyncLog(BaseModel):
+    """全市场数据同步记录 (用于停机后自动补齐)"""
+    trade_date = CharField()
+    dataset = CharField()               # daily / daily_basic / security_master (证券主表全量刷新)
+    rows = IntegerField(default=0)
+    synced_at = DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        indexes = (
+            (('trade_date', 'dataset'), True),
+        )
+
+class SecurityMaster(BaseModel):
+    """证券主表 (stock_basic 全量快照，每日刷新)"""
+    ts_code = CharField(primary_key=True)
+    symbol = CharField(null=True)       # 代码 (不含后缀)
+    name = CharField(null=True)         # 股票名称
+    industry = CharField(null=True)     # 所属行业
+    market = CharField(null=True)       # 市场类型 (主板/创业板/科创板...)
+    list_status = CharField(null=True)  # L上市 D退市 P暂停上市
+    list_date = CharField(null=True)    # 上市日期
+    updated_at = DateTimeField(default=datetime.datetime.now)
+
 class Position(BaseModel):
     """当前持仓"""
     ts_code = CharField(unique=True)    # 股票代码
@@ -41,7 +117,7 @@ class Position(BaseModel):
     current_price = FloatField(null=True) # 最新价格(更新用)
     market_value = FloatField(null=True)  # 最新市值
     profit = FloatField(default=0.0)      # 浮动盈亏
-    last_updated = DateTimeField(default=datetime.datetime.now)
+    last_updated = DateTimeField(default=clock.now)
 
 class Order(BaseModel):
     """交易记录"""
@@ -53,7 +129,7 @@ class Order(BaseModel):
     commission = FloatField(default=0.0)# 手续费
     reason = TextField(null=True)       # 交易理由 (LLM产生)
     status = CharField(default='FILLED')# FILLED, CANCELLED
-    time = DateTimeField(default=datetime.datetime.now)
+    time = DateTimeField(default=clock.now)
 
 class PriceMonitor(BaseModel):
     """价格监控配置"""
@@ -63,23 +139,169 @@ class PriceMonitor(BaseModel):
     monitor_type = CharField(default='signal') # signal/profit/loss
     reason = TextField(null=True)      # 监控理由
     status = CharField(default='ACTIVE') # ACTIVE, TRIGGERED, EXPIRED, COOLDOWN
-    created_at = DateTimeField(default=datetime.datetime.now)
+    created_at = DateTimeField(default=clock.now)
     triggered_at = DateTimeField(null=True)
     last_checked_at = DateTimeField(null=True) # 上次检查时间
     is_active = BooleanField(default=True)
     warning_sent = BooleanField(default=False) # 是否已发送即将触发预警
 
+class StockMinute(BaseModel):
+    """1 分钟 K 线 (由盘中轮询的实时行情聚合)"""
+    ts_code = CharField()
+    trade_date = CharField()
+    minute = IntegerField()    # HHMM, 如 931
+    open = FloatField()
+    high = FloatField()
+    low = FloatField()
+    close = FloatField()
+    volume = FloatField(default=0.0)  # 该分钟成交量 (股)
+    amount = FloatField(default=0.0)  # 该分钟成交额 (元)
+
+    class Meta:
+        indexes = (
+            (('ts_code', 'trade_date', 'minute'), True),
+        )
+
+class IntradayTick(BaseModel):
+    """盘中实时行情采样 (tick 环形缓冲在时段结束时落库)"""
+    ts_code = CharField()
+    ts = DateTimeField()
+    price = FloatField()
+    volume = FloatField(null=True)  # 当日累计成交量
+    bid1 = FloatField(null=True)
+    ask1 = FloatField(null=True)
+
+    class Meta:
+        indexes = (
+            (('ts_code', 'ts'), True),
+        )
+
+class TriggerEvent(BaseModel):
+    """监控触发处理记录 (检测到下单的时延)"""
+    monitor_id = IntegerField(index=True)
+    ts_code = CharField(index=True)
+    detected_at = DateTimeField()
+    detect_price = FloatField()
+    order_price = FloatField(null=True)
+    action = CharField(null=True)       # 分析师建议
+    outcome = CharField()               # EXECUTED / REJECTED / NO_ORDER / NO_ANALYSIS / EXPIRED / ERROR
+    queue_ms = FloatField(null=True)    # 检测 -> 开始处理 (等待线程与同股锁)
+    analysis_ms = FloatField(null=True) # 行情 + LLM 分析耗时
+    order_ms = FloatField(null=True)    # 检测 -> 下单
+    total_ms = FloatField()
+    over_budget = BooleanField(default=False)
+
+class NotificationOutbox(BaseModel):
+    """待发送的通知 (先落库再投递，重启后继续发送未送达的消息)"""
+    kind = CharField()                  # text / markdown
+    title = CharField(null=True)
+    body = TextField()
+    coalesce_key = CharField(null=True) # 相同 key 的消息在合并窗口内合并为一条摘要
+    status = CharField(default='PENDING', index=True)  # PENDING / SENT / FAILED
+    owner_pid = IntegerField(null=True) # 负责投递的进程
+    attempts = IntegerField(default=0)
+    last_error = TextField(null=True)
+    created_at = DateTimeField(default=datetime.datetime.now)
+    sent_at = DateTimeField(null=True)
+
 class Account(BaseModel):
     """账户资金"""
     id = IntegerField(primary_key=True)
     total_assets = FloatField(default=0.0) # 总资产
     cash = FloatField(default=0.0)         # 可用资金
     market_value = FloatField(default=0.0) # 持仓市值
+    version = IntegerField(default=0)      # 每次写入递增 (账本乐观锁)
     updated_at = DateTimeField(default=datetime.datetime.now)
 
+class LLMCacheEntry(BaseModel):
+    """LLM 响应缓存 (内容寻址)"""
+    cache_key = CharField(unique=True)  # sha256(model, template, prompt, json_mode)
+    template_name = CharField(null=True)
+    model_name = CharField(null=True)
+    response = TextField()              # 原始响应文本
+    created_at = DateTimeField(default=datetime.datetime.now)
+    expires_at = DateTimeField(index=True)
+    last_accessed_at = DateTimeField(default=datetime.datetime.now, index=True) # LRU 淘汰依据
+    hit_count = IntegerField(default=0)
+
+class LLMCallLog(BaseModel):
+    """LLM 调用记录 (每次请求尝试一行，缓存命中也记一行)"""
+    created_at = DateTimeField(default=datetime.datetime.now, index=True)
+    routine = CharField(null=True, index=True)  # 发起调用的流程 (pre_market / midday / pre_close / trigger)
+    template_name = CharField(null=True)
+    model_name = CharField(null=True)
+    key_index = IntegerField(null=True)       # API Key 下标 (缓存命中/替身实现为空)
+    attempt = IntegerField(default=0)         # 第几次尝试 (0 为首次)
+    prompt_tokens = IntegerField(default=0)
+    completion_tokens = IntegerField(default=0)
+    latency_ms = FloatField()
+    status = CharField()                      # OK / INVALID_JSON / ERROR / CACHED
+    error = TextField(null=True)
+
+def sqlite_max_variables():
+    """SQLite 单条语句可绑定的变量上限 (3.32.0 起默认 32766，之前为 999)"""
+    return 32766 if sqlite3.sqlite_version_info >= (3, 32, 0) else 999
+
+def bulk_upsert_frame(model, df, fields, conflict_fields):
+    """列式批量 Upsert: 直接从 DataFrame 列数组构造参数，executemany 写入
+
+    每条 INSERT 携带 (变量上限 // 列数) 行，冲突时用新值覆盖 (修订后的数据会被更新)。
+    NOT NULL 且无默认值的列为空 (NaN) 的行会被丢弃并记录日志，避免单行违反约束使整批写入失败。
+    返回写入行数。
+    """
+    if df is None or df.empty:
+        return 0
+
+    meta = model._meta
+    required = [f for f in fields if not meta.fields[f].null and meta.fields[f].default is None]
+    if required:
+        invalid = df[required].isna().any(axis=1)
+        if invalid.any():
+            sample = df.loc[invalid, 'ts_code'].head(5).tolist() if 'ts_code' in df.columns else []
+            logging.warning(f"{meta.table_name}: dropped {int(invalid.sum())} rows with missing "
+                            f"{[c for c in required if df.loc[invalid, c].isna().any()]} {sample}")
+            df = df[~invalid]
+            if df.empty:
+                return 0
+
+    database = meta.database
+    columns = [meta.fields[f].column_name for f in fields]
+    conflict_columns = [meta.fields[f].column_name for f in conflict_fields]
+    update_columns = [c for c in columns if c not in conflict_columns]
+
+    # 列 -> Python 原生值列表 (numpy tolist 在 C 层完成转换)，再按行拼成元组
+    rows = list(zip(*[df[f].tolist() for f in fields]))
+
+    rows_per_stmt = max(1, sqlite_max_variables() // len(columns))
+    row_sql = '(' + ','.join(['?'] * len(columns)) + ')'
+    prefix = 'INSERT INTO "%s" (%s) VALUES ' % (meta.table_name, ','.join(f'"{c}"' for c in columns))
+    if update_columns:
+        suffix = ' ON CONFLICT (%s) DO UPDATE SET %s' % (
+            ','.join(f'"{c}"' for c in conflict_columns),
+            ','.join(f'"{c}"=excluded."{c}"' for c in update_columns))
+    else:
+        suffix = ' ON CONFLICT DO NOTHING'
+
+    def statement(n_rows):
+        return prefix + ','.join([row_sql] * n_rows) + suffix
+
+    full_count = len(rows) // rows_per_stmt * rows_per_stmt
+    with database.atomic():
+        conn = database.connection()
+        if full_count:
+            params = (
+                list(itertools.chain.from_iterable(rows[i:i + rows_per_stmt]))
+                for i in range(0, full_count, rows_per_stmt)
+            )
+            conn.executemany(statement(rows_per_stmt), params)
+        if full_count < len(rows):
+            rest = rows[full_count:]
+            conn.execute(statement(len(rest)), list(itertools.chain.from_iterable(rest)))
+    return len(rows)
+
 def init_db(CONFIG=None):
     db.connect()
-    db.create_tables([StockDaily, Position, Order, Account, PriceMonitor], safe=True)
+    db.create_tables([StockDaily, StockDailyBasic, StockIndicator, DataSyncLog, SecurityMaster, Position, Order, Account, PriceMonitor, TriggerEvent, NotificationOutbox, IntradayTick, StockMinute, LLMCacheEntry, LLMCallLog], safe=True)
     
     # 自动迁移: 检查是否存在 volume_available 列
     try:
@@ -95,6 +317,18 @@ def init_db(CONFIG=None):
     except Exception as e:
         print(f"Migration check failed (safe to ignore if new DB): {e}")
 
+    # 自动迁移: Account.version (账本写入的乐观锁)
+    try:
+        columns = [c.name for c in db.get_columns('account')]
+        if 'version' not in columns:
+            print("Migrating: Adding version to Account table...")
+            migrator = SqliteMigrator(db)
+            migrate(
+                migrator.add_column('account', 'version', IntegerField(default=0))
+            )
+    except Exception as e:
+        print(f"Migration check failed (safe to ignore if new DB): {e}")
+
     # 初始化账户资金 (如果不存在)
     if Account.select().count() == 0:
         # 从配置读取初始资金
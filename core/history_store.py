@@ -0,0 +1,174 @@
+import os
+import json
+import logging
+import numpy as np
+import pandas as pd
+from core.db_models import StockDaily
+
+FIELDS = ['open', 'high', 'low', 'close', 'pre_close', 'change', 'pct_chg', 'vol', 'amount']
+
+class ColumnarHistoryStore:
+    """StockDaily 的列式内存映射副本
+
+    每个字段一个 (code, date) 二维 float64 数组，以 .npy 文件内存映射到磁盘，
+    缺失值(停牌/未上市)为 NaN。代码与交易日各自维护一条轴，并预留容量以便增量追加。
+    单只股票最近 N 根 K 线是零拷贝视图；多只股票的窗口一次 fancy-index 取出。
+    """
+
+    CODE_GROWTH = 1024
+    DATE_GROWTH = 512
+    # 每次同步都重新读取最近 N 个交易日，以接收 upsert 修订的日线 (rowid 不变)
+    RECHECK_DATES = 5
+
+    def __init__(self, root='data/history'):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.codes = []
+        self.dates = []
+        self.code_capacity = 0
+        self.date_capacity = 0
+        self.last_rowid = 0
+        self.arrays = {}
+        self._code_index = {}
+        self._load()
+
+    # ---- 存储布局 ----
+    def _meta_path(self):
+        return os.path.join(self.root, 'meta.json')
+
+    def _array_path(self, field):
+        return os.path.join(self.root, f'{field}.npy')
+
+    def _load(self):
+        if not os.path.exists(self._meta_path()):
+            return
+        with open(self._meta_path()) as f:
+            meta = json.load(f)
+        self.codes = meta['codes']
+        self.dates = meta['dates']
+        self.code_capacity = meta['code_capacity']
+        self.date_capacity = meta['date_capacity']
+        self.last_rowid = meta['last_rowid']
+        self.arrays = {
+            field: np.lib.format.open_memmap(self._array_path(field), mode='r+')
+            for field in FIELDS
+        }
+        self._code_index = {c: i for i, c in enumerate(self.codes)}
+
+    def _save_meta(self):
+        tmp_path = self._meta_path() + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'codes': self.codes,
+                'dates': self.dates,
+                'code_capacity': self.code_capacity,
+                'date_capacity': self.date_capacity,
+                'last_rowid': self.last_rowid,
+            }, f)
+        os.replace(tmp_path, self._meta_path())
+
+    def _reallocate(self, codes, dates):
+        """按新的轴重新分配数组，并把旧数据搬到新位置 (仅在容量不足或插入历史日期时发生)"""
+        code_capacity = self.code_capacity
+        if len(codes) > code_capacity:
+            code_capacity = len(codes) + self.CODE_GROWTH
+        date_capacity = self.date_capacity
+        if len(dates) > date_capacity:
+            date_capacity = len(dates) + self.DATE_GROWTH
+
+        old_dates = np.array(self.dates, dtype=object)
+        date_pos = np.searchsorted(np.array(dates, dtype=object), old_dates) if self.dates else None
+        n_old_codes = len(self.codes)
+
+        arrays = {}
+        for field in FIELDS:
+            tmp_path = self._array_path(field) + '.tmp'
+            arr = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float64,
+                                            shape=(code_capacity, date_capacity))
+            arr[:] = np.nan
+            if date_pos is not None and n_old_codes:
+                # 代码轴只追加不重排，旧行号保持不变
+                arr[:n_old_codes, date_pos] = self.arrays[field][:n_old_codes, :len(self.dates)]
+            arr.flush()
+            del arr
+            os.replace(tmp_path, self._array_path(field))
+            arrays[field] = np.lib.format.open_memmap(self._array_path(field), mode='r+')
+
+        self.arrays = arrays
+        self.code_capacity = code_capacity
+        self.date_capacity = date_capacity
+        logging.info(f"History store reallocated: {code_capacity} codes x {date_capacity} dates")
+
+    def _extend_axes(self, new_codes, new_dates):
+        codes = self.codes + sorted(set(new_codes) - set(self._code_index))
+        unseen_dates = sorted(set(new_dates) - set(self.dates))
+        dates_appended = not unseen_dates or not self.dates or unseen_dates[0] > self.dates[-1]
+        dates = self.dates + unseen_dates if dates_appended else sorted(set(self.dates) | set(unseen_dates))
+
+        if (not self.arrays or len(codes) > self.code_capacity
+                or len(dates) > self.date_capacity or not dates_appended):
+            self._reallocate(codes, dates)
+        self.codes = codes
+        self.dates = dates
+        self._code_index = {c: i for i, c in enumerate(codes)}
+
+    # ---- 同步 ----
+    def sync_from_db(self):
+        """从 StockDaily 增量同步 (新增行 + 最近几个交易日的修订)，返回写入行数"""
+        condition = StockDaily.id > self.last_rowid
+        if self.dates:
+            recheck_from = self.dates[max(0, len(self.dates) - self.RECHECK_DATES)]
+            condition = condition | (StockDaily.trade_date >= recheck_from)
+
+        columns = ['id', 'ts_code', 'trade_date'] + FIELDS
+        query = StockDaily.select(*[getattr(StockDaily, c) for c in columns]).where(condition).tuples()
+        df = pd.DataFrame(list(query), columns=columns)
+        if df.empty:
+            return 0
+
+        self._extend_axes(df['ts_code'].unique().tolist(), df['trade_date'].unique().tolist())
+
+        code_idx = df['ts_code'].map(self._code_index).to_numpy()
+        date_lookup = {d: i for i, d in enumerate(self.dates)}
+        date_idx = df['trade_date'].map(date_lookup).to_numpy()
+        for field in FIELDS:
+            arr = self.arrays[field]
+            arr[code_idx, date_idx] = df[field].to_numpy(dtype=np.float64)
+            arr.flush()
+
+        self.last_rowid = max(self.last_rowid, int(df['id'].max()))
+        self._save_meta()
+        logging.info(f"History store synced {len(df)} rows ({len(self.codes)} codes, {len(self.dates)} dates).")
+        return len(df)
+
+    # ---- 读取 ----
+    def bars(self, ts_code, n, field='close'):
+        """单只股票最近 n 个交易日 (零拷贝视图)，不存在返回 None"""
+        row = self._code_index.get(ts_code)
+        if row is None:
+            return None
+        end = len(self.dates)
+        return self.arrays[field][row, max(0, end - n):end]
+
+    def window(self, n, codes=None, fields=('close',)):
+        """最近 n 个交易日的多股票窗口
+
+        :return: (dates, codes, {field: ndarray(len(codes), n)})
+                 codes 为 None 时返回全部代码的零拷贝视图；否则按给定顺序取出，不存在的代码为 NaN 行
+        """
+        end = len(self.dates)
+        start = max(0, end - n)
+        dates = self.dates[start:end]
+
+        if codes is None:
+            n_codes = len(self.codes)
+            return dates, list(self.codes), {f: self.arrays[f][:n_codes, start:end] for f in fields}
+
+        rows = np.array([self._code_index.get(c, -1) for c in codes], dtype=np.int64)
+        missing = rows < 0
+        result = {}
+        for f in fields:
+            block = self.arrays[f][np.where(missing, 0, rows), start:end]
+            block[missing] = np.nan
+            result[f] = block
+        return dates, list(codes), result
@@ -0,0 +1,165 @@
+import logging
+import datetime
+import numpy as np
+import pandas as pd
+from numpy.lib.stride_tricks import sliding_window_view
+from peewee import fn
+from core.db_models import StockDaily, StockIndicator, bulk_upsert_frame
+
+INDICATOR_FIELDS = [
+    'close', 'ma5', 'ma10', 'ma20', 'ma60', 'ema12', 'ema26',
+    'macd_dif', 'macd_dea', 'macd_hist', 'rsi14', 'atr14',
+    'boll_upper', 'boll_mid', 'boll_lower', 'vol_ratio', 'high20', 'low20'
+]
+
+def _pad_left(values, width):
+    """滑动窗口结果左侧补 NaN，恢复到原始长度"""
+    pad = np.full(values.shape[:-1] + (width - values.shape[-1],), np.nan)
+    return np.concatenate([pad, values], axis=-1)
+
+def rolling(x, window, reducer):
+    """沿时间轴(axis=1)的滑动窗口统计，窗口内含 NaN 时结果为 NaN"""
+    if x.shape[1] < window:
+        return np.full(x.shape, np.nan)
+    windows = sliding_window_view(x, window, axis=1)
+    return _pad_left(reducer(windows, axis=-1), x.shape[1])
+
+def ema(x, alpha):
+    """指数平滑，每行从第一个有效值开始递推 (对所有股票同时计算)"""
+    out = np.full(x.shape, np.nan)
+    prev = np.full(x.shape[0], np.nan)
+    for t in range(x.shape[1]):
+        cur = x[:, t]
+        prev = np.where(np.isnan(prev), cur, alpha * cur + (1 - alpha) * prev)
+        out[:, t] = prev
+    return out
+
+def compute_indicators(panel):
+    """对 (codes, bars) 面板一次性计算全部指标
+
+    :param panel: {'open','high','low','close','pre_close','vol'} -> ndarray(n_codes, n_bars)，
+                  每行按时间右对齐，左侧不足部分为 NaN
+    :return: {indicator: ndarray(n_codes, n_bars)}
+    """
+    close, high, low = panel['close'], panel['high'], panel['low']
+    pre_close, vol = panel['pre_close'], panel['vol']
+
+    out = {'close': close}
+    for w in (5, 10, 20, 60):
+        out[f'ma{w}'] = rolling(close, w, np.mean)
+
+    out['ema12'] = ema(close, 2 / 13)
+    out['ema26'] = ema(close, 2 / 27)
+    out['macd_dif'] = out['ema12'] - out['ema26']
+    out['macd_dea'] = ema(out['macd_dif'], 2 / 10)
+    out['macd_hist'] = 2 * (out['macd_dif'] - out['macd_dea'])
+
+    # RSI / ATR 使用 Wilder 平滑 (alpha = 1/14)
+    delta = close - pre_close
+    avg_gain = ema(np.where(np.isnan(delta), np.nan, np.maximum(delta, 0)), 1 / 14)
+    avg_loss = ema(np.where(np.isnan(delta), np.nan, np.maximum(-delta, 0)), 1 / 14)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        out['rsi14'] = np.where(avg_loss == 0, 100.0, 100 - 100 / (1 + avg_gain / avg_loss))
+    out['rsi14'][np.isnan(avg_gain)] = np.nan
+
+    true_range = np.fmax(high - low, np.fmax(np.abs(high - pre_close), np.abs(low - pre_close)))
+    out['atr14'] = ema(true_range, 1 / 14)
+
+    std20 = rolling(close, 20, np.std)
+    out['boll_mid'] = out['ma20']
+    out['boll_upper'] = out['ma20'] + 2 * std20
+    out['boll_lower'] = out['ma20'] - 2 * std20
+
+    prev_ma5_vol = np.roll(rolling(vol, 5, np.mean), 1, axis=1)
+    prev_ma5_vol[:, 0] = np.nan
+    with np.errstate(divide='ignore', invalid='ignore'):
+        out['vol_ratio'] = np.where(prev_ma5_vol > 0, vol / prev_ma5_vol, np.nan)
+
+    out['high20'] = rolling(high, 20, np.max)
+    out['low20'] = rolling(low, 20, np.min)
+    return out
+
+class IndicatorEngine:
+    """基于 StockDaily 的向量化技术指标引擎，结果增量写入 StockIndicator"""
+
+    def __init__(self, lookback=150, initial_days=20):
+        self.lookback = lookback          # 每只股票参与计算的K线数 (含指标预热)
+        self.initial_days = initial_days  # 首次计算时落库的最近交易日数
+
+    def load_panel(self, ts_codes=None):
+        """读取各股票最近 lookback 根日线，组装为右对齐的二维面板"""
+        latest = StockDaily.select(fn.MAX(StockDaily.trade_date)).scalar()
+        if not latest:
+            return [], None, {}
+        # 交易日约为自然日的 2/3，多取一些保证每只股票都有 lookback 根
+        start = (datetime.datetime.strptime(latest, '%Y%m%d')
+                 - datetime.timedelta(days=int(self.lookback * 1.6) + 10)).strftime('%Y%m%d')
+
+        columns = ['ts_code', 'trade_date', 'open', 'high', 'low', 'close', 'pre_close', 'vol']
+        query = StockDaily.select(*[getattr(StockDaily, c) for c in columns]).where(StockDaily.trade_date >= start)
+        if ts_codes is not None:
+            query = query.where(StockDaily.ts_code.in_(list(ts_codes)))
+        df = pd.DataFrame(list(query.tuples()), columns=columns)
+        if df.empty:
+            return [], None, {}
+
+        df = df.sort_values(['ts_code', 'trade_date'])
+        # 每只股票自身的K线右对齐 (停牌日不占位)
+        from_end = df.groupby('ts_code').cumcount(ascending=False).to_numpy()
+        keep = from_end < self.lookback
+        df = df[keep]
+        col = self.lookback - 1 - from_end[keep]
+
+        codes, row = np.unique(df['ts_code'].to_numpy(), return_inverse=True)
+        shape = (len(codes), self.lookback)
+        dates = np.full(shape, None, dtype=object)
+        dates[row, col] = df['trade_date'].to_numpy()
+        panel = {}
+        for field in columns[2:]:
+            arr = np.full(shape, np.nan)
+            arr[row, col] = df[field].to_numpy(dtype=np.float64)
+            panel[field] = arr
+        return codes.tolist(), dates, panel
+
+    def update(self, ts_codes=None):
+        """计算并落库尚未物化的指标 (ts_codes 为 None 时处理全部股票)，返回写入行数"""
+        codes, dates, panel = self.load_panel(ts_codes)
+        if not codes:
+            return 0
+        results = compute_indicators(panel)
+
+        last_stored = dict(StockIndicator
+                           .select(StockIndicator.ts_code, fn.MAX(StockIndicator.trade_date))
+                           .where(StockIndicator.ts_code.in_(codes))
+                           .group_by(StockIndicator.ts_code)
+                           .tuples())
+        # 仅写入比已物化日期更新的K线；首次计算只保留最近 initial_days 根
+        date_str = np.where(pd.isna(dates), '', dates).astype(str)
+        threshold = np.array([last_stored.get(c, '') for c in codes], dtype=str)[:, None]
+        mask = date_str > threshold
+        first_time = np.array([c not in last_stored for c in codes])[:, None]
+        mask &= ~first_time | (np.arange(self.lookback) >= self.lookback - self.initial_days)[None, :]
+
+        row, col = np.nonzero(mask)
+        if len(row) == 0:
+            return 0
+        frame = pd.DataFrame({
+            'ts_code': np.array(codes, dtype=object)[row],
+            'trade_date': dates[row, col],
+        })
+        for name in INDICATOR_FIELDS:
+            frame[name] = np.round(results[name][row, col], 4)
+
+        written = bulk_upsert_frame(StockIndicator, frame, ['ts_code', 'trade_date'] + INDICATOR_FIELDS,
+                                    ['ts_code', 'trade_date'])
+        logging.info(f"Indicators updated: {written} rows for {len(set(frame['ts_code']))} codes.")
+        return written
+
+def get_latest_indicators(ts_code):
+    """读取某股票最新一日的指标 (dict)，无数据返回 None"""
+    return (StockIndicator
+            .select()
+            .where(StockIndicator.ts_code == ts_code)
+            .order_by(StockIndicator.trade_date.desc())
+            .dicts()
+            .first())
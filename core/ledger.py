@@ -0,0 +1,259 @@
+import uuid
+import logging
+import threading
+from core import clock, signals
+from core.db_models import db, Account, Position, Order
+
+LEDGER_CHANGED = 'ledger_changed'
+
+POSITION_FIELDS = ['ts_code', 'symbol_name', 'volume', 'volume_available', 'avg_price',
+                   'current_price', 'market_value', 'profit', 'last_updated']
+ACCOUNT_FIELDS = ['total_assets', 'cash', 'market_value']
+
+SELL_ACTIONS = ('SELL', 'SELL_HALF', 'SELL_ALL', 'STOP_LOSS', 'TAKE_PROFIT')
+
+class LedgerConflict(Exception):
+    """账户版本号与内存状态不一致 (其他进程已写入)"""
+
+class LedgerSnapshot:
+    """账本的只读快照 (某一版本下账户与持仓的一致视图)，读取不访问数据库"""
+
+    def __init__(self, account, positions, version):
+        self.account = account      # dict: total_assets / cash / market_value
+        self.positions = positions  # {ts_code: dict}
+        self.version = version
+
+    @property
+    def cash(self):
+        return self.account['cash']
+
+    @property
+    def total_assets(self):
+        return self.account['total_assets']
+
+    def position(self, ts_code):
+        return self.positions.get(ts_code)
+
+    def holdings(self):
+        return sorted(self.positions)
+
+class Ledger:
+    """进程内账本: 账户与持仓常驻内存，所有资金/持仓变更由单一写者串行执行
+
+    每批变更先在内存副本上计算，然后在一个 IMMEDIATE 事务内写入 Account/Position/Order。
+    事务提交成功后才替换内存状态 (先落库后生效)，失败时内存保持原样。
+    Account.version 随每次写入递增: 其他进程 (独立监控进程) 写入后版本不一致，
+    本进程重新加载后重算该批。写入后发出 ledger_changed 信号，对端下次读取快照前重新加载。
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.watcher = signals.SignalWatcher(LEDGER_CHANGED)
+        self._snapshot = None
+
+    # ---- 状态 ----
+    def invalidate(self):
+        """丢弃内存状态 (切换数据库或外部直接改库后调用)，下次访问时重新加载"""
+        with self.lock:
+            self._snapshot = None
+
+    def _load(self):
+        account = Account.select().first()
+        if account is None:
+            raise RuntimeError("Account not initialized (run init_db first)")
+        positions = {
+            row['ts_code']: row
+            for row in Position.select(*[getattr(Position, f) for f in POSITION_FIELDS]).dicts()
+        }
+        state = {f: getattr(account, f) for f in ACCOUNT_FIELDS}
+        self._snapshot = LedgerSnapshot(state, positions, account.version)
+        return self._snapshot
+
+    def snapshot(self):
+        """当前一致快照；其他进程写入过 (信号) 或尚未加载时才读库"""
+        snapshot = self._snapshot
+        if snapshot is not None and not self.watcher.changed():
+            return snapshot
+        with self.lock:
+            return self._load()
+
+    # ---- 写入 ----
+    def _commit(self, base, account, positions, touched, orders):
+        """把变更写入数据库 (单事务，版本校验)，成功后替换内存快照"""
+        now = clock.now()
+        with db.atomic('IMMEDIATE'):
+            updated = (Account
+                       .update(**account, version=Account.version + 1, updated_at=now)
+                       .where((Account.id == 1) & (Account.version == base.version))
+                       .execute())
+            if not updated:
+                raise LedgerConflict(f"Account version {base.version} is stale")
+            deleted = [c for c in touched if c not in positions]
+            if deleted:
+                Position.delete().where(Position.ts_code.in_(deleted)).execute()
+            rows = [positions[c] for c in touched if c in positions]
+            if rows:
+                (Position
+                 .insert_many(rows)
+                 .on_conflict(conflict_target=[Position.ts_code],
+                              preserve=[getattr(Position, f) for f in POSITION_FIELDS[1:]])
+                 .execute())
+            if orders:
+                Order.insert_many(orders).execute()
+        self._snapshot = LedgerSnapshot(account, positions, base.version + 1)
+        signals.notify(LEDGER_CHANGED)
+        self.watcher.changed()  # 自己发出的信号不触发重新加载
+
+    def _transact(self, stage):
+        """stage(snapshot) -> (account, positions, touched, orders, result)；版本冲突时重新加载后重算一次"""
+        with self.lock:
+            for attempt in range(2):
+                base = self.snapshot()
+                account, positions, touched, orders, result = stage(base)
+                if not touched and not orders and account == base.account:
+                    return result
+                try:
+                    self._commit(base, account, positions, touched, orders)
+                    return result
+                except LedgerConflict as e:
+                    if attempt:
+                        raise
+                    logging.warning(f"{e}, reloading ledger.")
+                    self._load()
+
+    @staticmethod
+    def _revalue_account(account, positions):
+        market_value = sum(p['volume'] * (p['current_price'] or p['avg_price']) for p in positions.values())
+        account['market_value'] = market_value
+        account['total_assets'] = account['cash'] + market_value
+
+    # ---- 订单 ----
+    def _fill_buy(self, account, positions, order, now):
+        ts_code, price = order['ts_code'], order.get('price', 0)
+        name_str = f"({order['stock_name']})" if order.get('stock_name') else ""
+        if price <= 0:
+            logging.error(f"Cannot execute BUY for {ts_code}: Price estimate is invalid ({price})")
+            return None
+        budget = order.get('budget', 0)
+        volume = int(budget / price / 100) * 100  # 向下取整到100股
+        if volume == 0:
+            logging.warning(f"Budget {budget} too low for {ts_code} at {price}")
+            return None
+        cost = volume * price
+        if account['cash'] < cost:
+            logging.warning("Insufficient funds")
+            return None
+
+        account['cash'] -= cost
+        pos = positions.get(ts_code)
+        if pos:
+            pos = dict(pos)
+            new_total_cost = pos['avg_price'] * pos['volume'] + cost
+            pos['volume'] += volume  # volume_available 保持不变 (T+1规则)
+            pos['avg_price'] = new_total_cost / pos['volume']
+        else:
+            pos = {'ts_code': ts_code, 'symbol_name': order.get('stock_name'), 'volume': volume,
+                   'volume_available': 0, 'avg_price': price, 'profit': 0.0}
+        pos.update(current_price=price, market_value=pos['volume'] * price,
+                   profit=pos['volume'] * (price - pos['avg_price']), last_updated=now)
+        positions[ts_code] = pos
+        logging.info(f"Executed BUY {ts_code}{name_str}: {volume} shares at {price}")
+        return volume, f"BUY {ts_code}{name_str}: {volume} @ {price}"
+
+    def _fill_sell(self, account, positions, order, now):
+        ts_code, price, action = order['ts_code'], order.get('price', 0), order['action']
+        name_str = f"({order['stock_name']})" if order.get('stock_name') else ""
+        if price <= 0:
+            logging.error(f"Cannot execute SELL for {ts_code}: Price estimate is invalid ({price})")
+            return None
+        pos = positions.get(ts_code)
+        if not pos:
+            return None
+        available = pos['volume_available']
+        if action == 'SELL_HALF':
+            sell_volume = available // 2
+        elif action == 'SELL' and order.get('volume'):
+            sell_volume = min(int(order['volume']), available)
+        else:
+            # SELL_ALL / STOP_LOSS / TAKE_PROFIT / 未指定数量的 SELL
+            sell_volume = available
+        if sell_volume == 0:
+            logging.warning(f"Cannot sell {ts_code}: available volume is 0 (T+1).")
+            return None
+
+        account['cash'] += sell_volume * price
+        pos = dict(pos, volume=pos['volume'] - sell_volume, volume_available=available - sell_volume,
+                   last_updated=now)
+        if pos['volume'] == 0:
+            del positions[ts_code]
+        else:
+            mark = pos['current_price'] or price
+            pos.update(market_value=pos['volume'] * mark, profit=pos['volume'] * (mark - pos['avg_price']))
+            positions[ts_code] = pos
+        logging.info(f"Executed SELL {ts_code}{name_str}: {sell_volume} shares at {price}")
+        return sell_volume, f"SELL {ts_code}{name_str}: {sell_volume} @ {price}"
+
+    def execute(self, orders):
+        """原子执行一批订单，返回与 orders 一一对应的结果 (成交描述或 None)
+
+        单笔订单不满足条件 (资金不足、T+1 不可卖等) 只跳过该笔；整批在一个事务内落库。
+        """
+        def stage(base):
+            account, positions = dict(base.account), dict(base.positions)
+            touched, rows, results = [], [], []
+            now = clock.now()
+            for order in orders:
+                action = order.get('action')
+                try:
+                    if action == 'BUY':
+                        fill = self._fill_buy(account, positions, order, now)
+                    elif action in SELL_ACTIONS:
+                        fill = self._fill_sell(account, positions, order, now)
+                    else:
+                        fill = None
+                except Exception as e:
+                    logging.error(f"Failed to execute order {order}: {e}")
+                    fill = None
+                if not fill:
+                    results.append(None)
+                    continue
+                volume, text = fill
+                touched.append(order['ts_code'])
+                rows.append({'order_id': str(uuid.uuid4()), 'ts_code': order['ts_code'],
+                             'action': 'BUY' if action == 'BUY' else 'SELL', 'price': order['price'],
+                             'volume': volume, 'reason': order.get('reason', ''), 'time': now})
+                results.append(text)
+            self._revalue_account(account, positions)
+            return account, positions, list(dict.fromkeys(touched)), rows, results
+
+        return self._transact(stage)
+
+    def settle(self):
+        """盘前/盘后结算: 将所有持仓转为可用 (T+1 -> T)，返回更新的持仓数"""
+        def stage(base):
+            positions = dict(base.positions)
+            touched = [c for c, p in positions.items() if p['volume_available'] != p['volume']]
+            for code in touched:
+                positions[code] = dict(positions[code], volume_available=positions[code]['volume'])
+            return dict(base.account), positions, touched, [], len(positions)
+
+        return self._transact(stage)
+
+    def mark(self, prices):
+        """按 {ts_code: price} 给持仓估值并重算账户；prices 中没有持仓时不写入，返回估值摘要或 None"""
+        def stage(base):
+            account, positions = dict(base.account), dict(base.positions)
+            now = clock.now()
+            touched = [c for c in prices if c in positions and prices[c] and prices[c] > 0]
+            for code in touched:
+                pos, price = positions[code], prices[code]
+                positions[code] = dict(pos, current_price=price, market_value=pos['volume'] * price,
+                                       profit=pos['volume'] * (price - pos['avg_price']), last_updated=now)
+            self._revalue_account(account, positions)
+            if prices and not touched:
+                return base.account, base.positions, [], [], None
+            return account, positions, touched, [], {'positions': len(touched), **account}
+
+        return self._transact(stage)
+
+ledger = Ledger()
@@ -0,0 +1,119 @@
+import re
+import hashlib
+import logging
+import datetime
+import threading
+from core import clock
+from core.db_models import LLMCacheEntry
+
+# Prompt 中的当前时间精确到秒，会让相同内容的 Prompt 永远无法命中缓存；
+# 计算缓存键时只保留日期部分，新鲜度由 TTL 控制。
+_TIMESTAMP_RE = re.compile(r'(\d{4}-\d{2}-\d{2}) \d{2}:\d{2}:\d{2}')
+
+class LLMResponseCache:
+    """LLM 响应持久化缓存: 按模板 TTL 过期，按最近访问时间 (LRU) 限制条目数"""
+
+    def __init__(self):
+        self.enabled = True
+        self.max_entries = 2000
+        self.default_ttl = 300
+        # 各模板 TTL(秒)，0 表示不缓存
+        self.ttls = {
+            'analysis_trigger.j2': 60,
+            'analysis_intra_day.j2': 300,
+            'analysis_pre_close.j2': 300,
+            'decision_maker.j2': 600,
+            'analysis_pre_market.j2': 4 * 3600,
+        }
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def configure(self, cache_config=None):
+        """从 config.yaml 的 llm.cache 段加载参数"""
+        if not cache_config:
+            return
+        self.enabled = cache_config.get('enabled', self.enabled)
+        self.max_entries = cache_config.get('max_entries', self.max_entries)
+        self.default_ttl = cache_config.get('default_ttl', self.default_ttl)
+        self.ttls.update(cache_config.get('ttls') or {})
+
+    def ttl_for(self, template_name):
+        return self.ttls.get(template_name, self.default_ttl)
+
+    def make_key(self, model_name, template_name, prompt, json_mode):
+        normalized = _TIMESTAMP_RE.sub(r'\1', prompt)
+        raw = '\x1f'.join([model_name or '', template_name or '', normalized, '1' if json_mode else '0'])
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get(self, model_name, template_name, prompt, json_mode):
+        """返回缓存的原始响应文本，未命中返回 None"""
+        if not self.enabled or self.ttl_for(template_name) <= 0:
+            return None
+
+        key = self.make_key(model_name, template_name, prompt, json_mode)
+        now = clock.now()
+        try:
+            entry = LLMCacheEntry.get_or_none(
+                (LLMCacheEntry.cache_key == key) & (LLMCacheEntry.expires_at > now)
+            )
+            if entry:
+                LLMCacheEntry.update(
+                    last_accessed_at=now,
+                    hit_count=LLMCacheEntry.hit_count + 1
+                ).where(LLMCacheEntry.id == entry.id).execute()
+        except Exception as e:
+            logging.warning(f"LLM cache lookup failed: {e}")
+            entry = None
+
+        with self._lock:
+            if entry:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if entry:
+            logging.info(f"LLM cache hit ({template_name})")
+            return entry.response
+        return None
+
+    def put(self, model_name, template_name, prompt, json_mode, response):
+        ttl = self.ttl_for(template_name)
+        if not self.enabled or ttl <= 0 or response is None:
+            return
+
+        key = self.make_key(model_name, template_name, prompt, json_mode)
+        now = clock.now()
+        try:
+            LLMCacheEntry.insert(
+                cache_key=key,
+                template_name=template_name,
+                model_name=model_name,
+                response=response,
+                created_at=now,
+                expires_at=now + datetime.timedelta(seconds=ttl),
+                last_accessed_at=now,
+                hit_count=0
+            ).on_conflict_replace().execute()
+            self.evict()
+        except Exception as e:
+            logging.warning(f"LLM cache store failed: {e}")
+
+    def evict(self):
+        """清理过期条目，并按 LRU 淘汰超出容量的部分"""
+        LLMCacheEntry.delete().where(LLMCacheEntry.expires_at <= clock.now()).execute()
+        overflow = LLMCacheEntry.select().count() - self.max_entries
+        if overflow > 0:
+            oldest = (LLMCacheEntry
+                      .select(LLMCacheEntry.id)
+                      .order_by(LLMCacheEntry.last_accessed_at.asc())
+                      .limit(overflow))
+            LLMCacheEntry.delete().where(LLMCacheEntry.id.in_(oldest)).execute()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            hit_rate = round(self.hits / total * 100, 1) if total else 0.0
+            return {'hits': self.hits, 'misses': self.misses, 'hit_rate': hit_rate}
+
+# 进程内共享实例
+llm_cache = LLMResponseCache()
@@ -0,0 +1,149 @@
+import atexit
+import logging
+import datetime
+import threading
+import pandas as pd
+from core import clock, routine_context
+from core.db_models import LLMCallLog
+
+class LLMCallRecorder:
+    """LLM 调用记录器
+
+    调用线程 (含 call_llm_many 所在的事件循环) 只把记录追加到内存缓冲，不访问数据库；
+    后台线程在攒满一批时被唤醒、或每 flush_interval 秒批量写入 LLMCallLog；进程退出时写入剩余记录。
+    记录所属流程取自 core.routine_context。
+    """
+
+    def __init__(self, batch_size=50, flush_interval=10):
+        self.enabled = True
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pricing = {}  # {model_name | 'default': {'prompt': 元/百万 tokens, 'completion': 元/百万 tokens}}
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._worker = None
+
+    def configure(self, config=None):
+        """从 config.yaml 的 llm.call_log 段加载参数"""
+        if not config:
+            return
+        self.enabled = config.get('enabled', self.enabled)
+        self.batch_size = config.get('batch_size', self.batch_size)
+        self.flush_interval = config.get('flush_interval', self.flush_interval)
+        self.pricing = config.get('pricing') or self.pricing
+
+    def record(self, template_name, model_name, key_index, attempt, latency_ms, status,
+               prompt_tokens=0, completion_tokens=0, error=None):
+        if not self.enabled:
+            return
+        stats = routine_context.current()
+        row = {'created_at': clock.now(), 'routine': stats.name if stats else None,
+               'template_name': template_name, 'model_name': model_name, 'key_index': key_index,
+               'attempt': attempt, 'prompt_tokens': prompt_tokens or 0, 'completion_tokens': completion_tokens or 0,
+               'latency_ms': latency_ms, 'status': status, 'error': str(error)[:500] if error else None}
+        with self._lock:
+            self._buffer.append(row)
+            full = len(self._buffer) >= self.batch_size
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name='llm-call-log', daemon=True)
+                self._worker.start()
+        if full:
+            self._wakeup.set()
+
+    def _run(self):
+        """后台写入线程: 缓冲攒满时被唤醒，否则每 flush_interval 秒写入一次"""
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """把缓冲中的记录写入数据库 (在调用线程同步执行)，返回写入行数"""
+        with self._lock:
+            rows, self._buffer = self._buffer, []
+        if not rows:
+            return 0
+        try:
+            LLMCallLog.insert_many(rows).execute()
+        except Exception as e:
+            logging.warning(f"Failed to write LLM call log ({len(rows)} rows): {e}")
+            return 0
+        return len(rows)
+
+llm_recorder = LLMCallRecorder()
+atexit.register(llm_recorder.flush)
+
+def load_calls(since=None):
+    query = LLMCallLog.select()
+    if since is not None:
+        query = query.where(LLMCallLog.created_at >= since)
+    return pd.DataFrame(list(query.dicts()))
+
+def _cost(df, pricing):
+    """按模型单价 (元/百万 tokens) 计算每行费用，未配置单价时为 0"""
+    default = pricing.get('default') or {}
+    prompt_price = df['model_name'].map(lambda m: (pricing.get(m) or default).get('prompt', 0))
+    completion_price = df['model_name'].map(lambda m: (pricing.get(m) or default).get('completion', 0))
+    return (df['prompt_tokens'] * prompt_price + df['completion_tokens'] * completion_price) / 1e6
+
+def _latency_table(df, by):
+    """按 by 分组: 请求数、缓存命中、tokens、费用与延迟分位 (延迟不含缓存命中)"""
+    df = df.assign(**{by: df[by].fillna('-')})
+    requests = df[df['status'] != 'CACHED']
+    table = pd.DataFrame({
+        'requests': requests.groupby(by).size(),
+        'cached': df[df['status'] == 'CACHED'].groupby(by).size(),
+        'failed': requests[requests['status'] != 'OK'].groupby(by).size(),
+        'prompt_tokens': df.groupby(by)['prompt_tokens'].sum(),
+        'completion_tokens': df.groupby(by)['completion_tokens'].sum(),
+        'cost': df.groupby(by)['cost'].sum(),
+        'p50_ms': requests.groupby(by)['latency_ms'].quantile(0.5),
+        'p95_ms': requests.groupby(by)['latency_ms'].quantile(0.95),
+        'total_s': requests.groupby(by)['latency_ms'].sum() / 1000,
+    })
+    counts = ['requests', 'cached', 'failed', 'prompt_tokens', 'completion_tokens']
+    table[counts] = table[counts].fillna(0).astype(int)
+    return table.sort_values('total_s', ascending=False)
+
+def summarize(df, pricing=None):
+    """调用记录 -> {'overall', 'routine', 'template', 'key'} 汇总表"""
+    df = df.assign(cost=_cost(df, pricing or {}))
+    requests = df[df['status'] != 'CACHED']
+    overall = pd.DataFrame([{
+        'calls': len(df), 'requests': len(requests), 'cached': len(df) - len(requests),
+        'failure_rate': float((requests['status'] != 'OK').mean()) if len(requests) else 0.0,
+        'p50_ms': requests['latency_ms'].quantile(0.5), 'p95_ms': requests['latency_ms'].quantile(0.95),
+        'prompt_tokens': int(df['prompt_tokens'].sum()), 'completion_tokens': int(df['completion_tokens'].sum()),
+        'cost': df['cost'].sum(),
+    }])
+
+    keyed = requests[requests['key_index'].notna()]
+    keys = keyed.groupby(keyed['key_index'].astype(int))
+    key_table = pd.DataFrame({
+        'attempts': keys.size(),
+        'errors': keys['status'].apply(lambda s: (s == 'ERROR').sum()),
+        'invalid_json': keys['status'].apply(lambda s: (s == 'INVALID_JSON').sum()),
+        'failure_rate': keys['status'].apply(lambda s: (s != 'OK').mean()),
+        'p50_ms': keys['latency_ms'].quantile(0.5),
+        'p95_ms': keys['latency_ms'].quantile(0.95),
+    })
+    return {'overall': overall, 'routine': _latency_table(df, 'routine'),
+            'template': _latency_table(df, 'template_name'), 'key': key_table}
+
+def report(days=1, pricing=None):
+    """最近 days 天的 LLM 调用统计 (文本)"""
+    llm_recorder.flush()
+    since = clock.now() - datetime.timedelta(days=days)
+    df = load_calls(since)
+    if df.empty:
+        return f"No LLM calls recorded since {since:%Y-%m-%d %H:%M}."
+    tables = summarize(df, pricing if pricing is not None else llm_recorder.pricing)
+    sections = [f"LLM calls since {since:%Y-%m-%d %H:%M}"]
+    for title, name in (('Overall', 'overall'), ('By routine', 'routine'),
+                        ('By template', 'template'), ('By API key', 'key')):
+        table = tables[name]
+        text = table.to_string(index=(name != 'overall'), float_format=lambda v: f"{v:.2f}",
+                               formatters={'cost': lambda v: f"{v:.4f}"}) if not table.empty else '(none)'
+        sections.append(f"\n[{title}]\n{text}")
+    return '\n'.join(sections)
@@ -0,0 +1,136 @@
+import logging
+import datetime
+import threading
+from peewee import fn, chunked, EXCLUDED
+from core import clock
+from core.db_models import StockMinute, db
+from core.tushare_client import quote_datetime, extract_price
+
+MINUTE_FIELDS = ['ts_code', 'trade_date', 'minute', 'open', 'high', 'low', 'close', 'volume', 'amount']
+
+def _cumulative(quote, key):
+    try:
+        return float(quote.get(key) or 0.0)
+    except (TypeError, ValueError):
+        return 0.0
+
+class MinuteBarAggregator:
+    """把轮询到的实时行情聚合为 1 分钟 K 线并写入 StockMinute
+
+    作为 TushareClient 的行情监听运行：每次行情到达时更新各股票当前分钟的 OHLC，
+    成交量/额由当日累计值的增量得到。当日首根 bar 的成交量包含此前未观测到的累计量，
+    这样全部 bar 的成交额/成交量之比即为全天 VWAP。
+    每批行情后 upsert 本批涉及的 bar (含未收盘的当前分钟)，其他进程可直接读库。
+    冲突时按 high 取大、low 取小、量额取大合并，主进程与独立监控进程同时写入也能收敛。
+    """
+
+    def __init__(self, enabled=True, retention_days=20):
+        self.enabled = enabled
+        self.retention_days = retention_days
+        self._bars = {}  # ts_code -> 当前分钟 bar (dict)
+        self._lock = threading.Lock()
+
+    def configure(self, config=None):
+        config = config or {}
+        self.enabled = config.get('enabled', self.enabled)
+        self.retention_days = config.get('retention_days', self.retention_days)
+
+    def _update(self, ts_code, quote):
+        price = extract_price(quote)
+        if price <= 0:
+            return None
+        at = quote_datetime(quote)
+        trade_date, minute = at.strftime('%Y%m%d'), at.hour * 100 + at.minute
+        cum_volume, cum_amount = _cumulative(quote, 'volume'), _cumulative(quote, 'amount')
+
+        bar = self._bars.get(ts_code)
+        if bar is None or bar['trade_date'] != trade_date:
+            base_volume, base_amount = self._stored_totals(ts_code, trade_date, minute)
+        elif bar['minute'] == minute:
+            bar['high'] = max(bar['high'], price)
+            bar['low'] = min(bar['low'], price)
+            bar['close'] = price
+            bar['volume'] = max(0.0, cum_volume - bar['base_volume'])
+            bar['amount'] = max(0.0, cum_amount - bar['base_amount'])
+            return bar
+        elif minute < bar['minute']:
+            return None  # 乱序的旧行情
+        else:
+            base_volume = bar['base_volume'] + bar['volume']
+            base_amount = bar['base_amount'] + bar['amount']
+
+        bar = {
+            'ts_code': ts_code, 'trade_date': trade_date, 'minute': minute,
+            'open': price, 'high': price, 'low': price, 'close': price,
+            'volume': max(0.0, cum_volume - base_volume), 'amount': max(0.0, cum_amount - base_amount),
+            'base_volume': base_volume, 'base_amount': base_amount,
+        }
+        self._bars[ts_code] = bar
+        return bar
+
+    @staticmethod
+    def _stored_totals(ts_code, trade_date, minute):
+        """当日此前已落库 (本进程重启前或其他进程写入) 的累计量额，作为首根 bar 的基数"""
+        volume, amount = (StockMinute
+                          .select(fn.TOTAL(StockMinute.volume), fn.TOTAL(StockMinute.amount))
+                          .where((StockMinute.ts_code == ts_code) & (StockMinute.trade_date == trade_date)
+                                 & (StockMinute.minute < minute))
+                          .tuples()
+                          .first())
+        return volume, amount
+
+    def _write(self, bars):
+        rows = [{f: bar[f] for f in MINUTE_FIELDS} for bar in bars]
+        with db.atomic():
+            for batch in chunked(rows, 100):
+                (StockMinute
+                 .insert_many(batch)
+                 .on_conflict(conflict_target=[StockMinute.ts_code, StockMinute.trade_date, StockMinute.minute],
+                              update={StockMinute.high: fn.MAX(StockMinute.high, EXCLUDED.high),
+                                      StockMinute.low: fn.MIN(StockMinute.low, EXCLUDED.low),
+                                      StockMinute.close: EXCLUDED.close,
+                                      StockMinute.volume: fn.MAX(StockMinute.volume, EXCLUDED.volume),
+                                      StockMinute.amount: fn.MAX(StockMinute.amount, EXCLUDED.amount)})
+                 .execute())
+
+    def record_quotes(self, quotes):
+        """行情监听回调: {ts_code: quote dict}"""
+        if not self.enabled:
+            return
+        with self._lock:
+            touched = [bar for bar in (self._update(code, q) for code, q in quotes.items()) if bar]
+            if not touched:
+                return
+            self._write(touched)
+
+    def prune(self):
+        """删除超过保留期的分钟线，返回删除行数"""
+        cutoff = (clock.now() - datetime.timedelta(days=self.retention_days)).strftime('%Y%m%d')
+        deleted = StockMinute.delete().where(StockMinute.trade_date < cutoff).execute()
+        if deleted:
+            logging.info(f"Pruned {deleted} minute bars before {cutoff}.")
+        return deleted
+
+def get_intraday_summary(ts_code, trade_date=None):
+    """由当日分钟线汇总日内 open/high/low/close/VWAP，无数据返回 None"""
+    trade_date = trade_date or clock.now().strftime('%Y%m%d')
+    rows = list(StockMinute
+                .select(StockMinute.open, StockMinute.high, StockMinute.low, StockMinute.close,
+                        StockMinute.volume, StockMinute.amount)
+                .where((StockMinute.ts_code == ts_code) & (StockMinute.trade_date == trade_date))
+                .order_by(StockMinute.minute)
+                .tuples())
+    if not rows:
+        return None
+    volume = sum(r[4] for r in rows)
+    amount = sum(r[5] for r in rows)
+    return {
+        'open': rows[0][0],
+        'high': max(r[1] for r in rows),
+        'low': min(r[2] for r in rows),
+        'close': rows[-1][3],
+        'vwap': round(amount / volume, 3) if volume > 0 else None,
+        'bars': len(rows),
+    }
+
+minute_bars = MinuteBarAggregator()
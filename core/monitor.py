@@ -1,141 +1,352 @@
-import logging
-import datetime
 import time
-from core.db_models import PriceMonitor, db
+import bisect
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from peewee import fn, chunked
+from core.db_models import PriceMonitor, TriggerEvent, db
+from core import clock, routine_context
 from core.tushare_client import TushareClient
+from core.poll_scheduler import AdaptivePollScheduler
 from agents.analyst import AnalystAgent
 from agents.decision_maker import DecisionMakerAgent
 from core.trader import Trader
-from core.notifier import DingTalkNotifier
+from core.portfolio import PortfolioValuer
+from core.notifier import DingTalkNotifier, PRE_ALERT
 
 logger = logging.getLogger(__name__)
 
-class PriceMonitorService:
+class MonitorIndex:
+    """活跃监控单的内存索引
+
+    每只股票按 operator 分为 gt / lt 两组，组内按触发价排序。价格更新时用二分查找
+    直接定位已触发区间和预警区间，无需逐条扫描。索引只保存 (触发价, ID)，命中后再批量
+    加载完整记录。与数据库的一致性由一条聚合查询 (数量/最大ID/最新创建时间/触发价合计)
+    判断，变化时整体重建。
+    """
+
+    WARNING_PCT = 1.0  # 距离目标价 1% 以内进入预警区
+    WRITE_BATCH = 500
+
     def __init__(self):
+        self._books = {}     # ts_code -> {'gt': (prices, ids), 'lt': (prices, ids)}
+        self._warned = set() # 已发送预警的监控单 ID
+        self._records = {}   # 已加载的完整记录 (ID -> PriceMonitor)，重建时清空
+        self._fingerprint = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _active():
+        return (PriceMonitor.status == 'ACTIVE') & PriceMonitor.is_active
+
+    def _current_fingerprint(self):
+        return (PriceMonitor
+                .select(fn.COUNT(PriceMonitor.id), fn.MAX(PriceMonitor.id),
+                        fn.MAX(PriceMonitor.created_at), fn.TOTAL(PriceMonitor.trigger_price))
+                .where(self._active())
+                .tuples()
+                .first())
+
+    def invalidate(self):
+        with self._lock:
+            self._fingerprint = None
+
+    def refresh(self):
+        """数据库中的活跃监控单有变化时重建索引，返回是否重建"""
+        fingerprint = self._current_fingerprint()
+        with self._lock:
+            if fingerprint == self._fingerprint:
+                return False
+            self._rebuild(fingerprint)
+        return True
+
+    def _rebuild(self, fingerprint):
+        rows = list(PriceMonitor
+                    .select(PriceMonitor.ts_code, PriceMonitor.operator, PriceMonitor.trigger_price,
+                            PriceMonitor.id, PriceMonitor.warning_sent)
+                    .where(self._active() & PriceMonitor.operator.in_(['gt', 'lt']))
+                    .order_by(PriceMonitor.ts_code, PriceMonitor.trigger_price, PriceMonitor.id)
+                    .tuples())
+        books = {}
+        for ts_code, operator, trigger_price, monitor_id, _ in rows:
+            prices, ids = books.setdefault(ts_code, {'gt': ([], []), 'lt': ([], [])})[operator]
+            prices.append(trigger_price)
+            ids.append(monitor_id)
+        self._books = books
+        self._warned = {row[3] for row in rows if row[4]}
+        self._records = {}
+        self._fingerprint = fingerprint
+        logger.info(f"Monitor index rebuilt: {len(rows)} monitors across {len(books)} codes.")
+
+    def codes(self):
+        with self._lock:
+            return list(self._books)
+
+    def nearest(self, ts_code, price):
+        """距当前价最近的触发价 (gt/lt 两组中取最近)，无监控返回 None"""
+        with self._lock:
+            book = self._books.get(ts_code)
+            if book is None:
+                return None
+            candidates = []
+            for prices, _ in book.values():
+                i = bisect.bisect_left(prices, price)
+                candidates.extend(prices[max(0, i - 1):i + 1])
+        return min(candidates, key=lambda p: abs(p - price), default=None)
+
+    def _load(self, ids):
+        """按需批量加载完整记录 (命中的监控单通常很少)"""
+        missing = sorted(set(ids) - set(self._records))
+        for batch in chunked(missing, self.WRITE_BATCH):
+            self._records.update((m.id, m) for m in PriceMonitor.select().where(PriceMonitor.id.in_(batch)))
+        return self._records
+
+    def scan(self, prices):
+        """
+        :param prices: {ts_code: price}
+        :return: (triggered [(monitor, price)], warnings [(monitor, price, diff_pct)])
+        """
+        hits, near = [], []
+        up = 1 / (1 - self.WARNING_PCT / 100) * (1 + 1e-9)   # gt 预警区上界系数 (略放宽，再精确复核)
+        down = 1 / (1 + self.WARNING_PCT / 100) * (1 - 1e-9)  # lt 预警区下界系数
+        with self._lock:
+            for ts_code, price in prices.items():
+                book = self._books.get(ts_code)
+                if book is None or price is None:
+                    continue
+
+                # gt: 触发价 <= 当前价 的已触发；(当前价, 当前价/0.99] 为预警候选
+                gt_prices, gt_ids = book['gt']
+                i = bisect.bisect_right(gt_prices, price)
+                hits.extend((monitor_id, price) for monitor_id in gt_ids[:i])
+                j = bisect.bisect_right(gt_prices, price * up)
+                near.extend((gt_ids[k], gt_prices[k], price) for k in range(i, j))
+
+                # lt: 触发价 >= 当前价 的已触发；[当前价/1.01, 当前价) 为预警候选
+                lt_prices, lt_ids = book['lt']
+                i = bisect.bisect_left(lt_prices, price)
+                hits.extend((monitor_id, price) for monitor_id in lt_ids[i:])
+                j = bisect.bisect_left(lt_prices, price * down)
+                near.extend((lt_ids[k], lt_prices[k], price) for k in range(j, i))
+
+            near = [(monitor_id, price, abs(price - trigger_price) / trigger_price * 100)
+                    for monitor_id, trigger_price, price in near if monitor_id not in self._warned]
+            near = [item for item in near if item[2] <= self.WARNING_PCT]
+
+            if not hits and not near:
+                return [], []
+            monitors = self._load([monitor_id for monitor_id, _ in hits] + [item[0] for item in near])
+            triggered = [(monitors[i], price) for i, price in hits if i in monitors]
+            warnings = [(monitors[i], price, diff) for i, price, diff in near if i in monitors]
+        return triggered, warnings
+
+    def _claim(self, monitors, values, guard):
+        """批量条件更新，返回实际更新成功的监控单 ID (UPDATE ... RETURNING)"""
+        claimed = set()
+        with db.atomic():
+            for batch in chunked([m.id for m in monitors], self.WRITE_BATCH):
+                query = (PriceMonitor.update(**values)
+                         .where(PriceMonitor.id.in_(batch) & guard)
+                         .returning(PriceMonitor.id))
+                claimed.update(row.id for row in query.execute())
+        return claimed
+
+    def mark_warned(self, monitors):
+        claimed = self._claim(monitors, {'warning_sent': True}, PriceMonitor.warning_sent == False)
+        with self._lock:
+            self._warned.update(m.id for m in monitors)
+        for m in monitors:
+            m.warning_sent = True
+        return claimed
+
+    def claim_triggered(self, monitors):
+        """将监控单由 ACTIVE 锁定为 TRIGGERED，下次检查时重建索引"""
+        now = clock.now()
+        claimed = self._claim(monitors, {'status': 'TRIGGERED', 'triggered_at': now},
+                              PriceMonitor.status == 'ACTIVE')
+        for m in monitors:
+            m.status = 'TRIGGERED'
+            m.triggered_at = now
+        self.invalidate()
+        return claimed
+
+class PriceMonitorService:
+    def __init__(self, trigger_workers=4, latency_budget=30, poll_interval=5, max_poll_interval=120,
+                 mark_to_market=True):
+        self.latency_budget = latency_budget  # 秒: 检测到下单的时延预算
+        self.mark_to_market = mark_to_market  # 用轮询到的价格实时刷新持仓与账户估值
+        self.poller = AdaptivePollScheduler(base_interval=poll_interval, max_interval=max_poll_interval,
+                                            warning_pct=MonitorIndex.WARNING_PCT,
+                                            request_counter=lambda n: self.ts_client.quote_provider.requests_for(n))
+        self.executor = ThreadPoolExecutor(max_workers=trigger_workers, thread_name_prefix='trigger')
+        self._pending = set()  # 未完成的触发处理，完成后自动移除
+        self._pending_lock = threading.Lock()
+        self._symbol_locks = {}
+        self.index = MonitorIndex()
         self.ts_client = TushareClient()
         self.analyst = AnalystAgent()
         self.decision_maker = DecisionMakerAgent()
         self.trader = Trader()
+        self.portfolio = PortfolioValuer()
         self.notifier = DingTalkNotifier()
 
     def run_check(self):
         """执行一次监控循环"""
-        start_time = time.time()
-        # logging.info("Starting Price Monitor Cycle...") # Reduce noise
-        
-        # 1. 获取活跃监控单
-        monitors = list(PriceMonitor.select().where(
-            (PriceMonitor.status == 'ACTIVE') & 
-            PriceMonitor.is_active
-        ))
-        
-        if not monitors:
+        # 1. 活跃监控单有变化时重建内存索引，并重新评估所有股票的轮询频率
+        if self.index.refresh():
+            self.poller.reset()
+        ts_codes = self.poller.due(self.index.codes())
+        if not ts_codes:
             return
 
-        ts_codes = list(set([m.ts_code for m in monitors]))
-        
-        # 2. 批量获取价格
+        # 2. 批量获取到期股票的价格 (距触发线越近轮询越频繁)
         prices = self.ts_client.get_batch_realtime_quotes(ts_codes)
-        
-        triggered_monitors = []
-        
-        # 3. 检查触发条件
-        for m in monitors:
-            curr_price = prices.get(m.ts_code)
-            if curr_price is None:
-                continue
-            
-            is_triggered = False
-            if m.operator == 'gt' and curr_price >= m.trigger_price:
-                is_triggered = True
-            elif m.operator == 'lt' and curr_price <= m.trigger_price:
-                is_triggered = True
-            
-            if is_triggered:
-                triggered_monitors.append((m, curr_price))
-            else:
-                # 检查是否进入预警区 (Warning Zone) - 距离目标价 1% 以内
-                if not m.warning_sent:
-                    # 计算差距百分比
-                    diff_pct = abs(curr_price - m.trigger_price) / m.trigger_price * 100
-                    if diff_pct <= 1.0:
-                        # 使用原子更新防止并发导致重复预警
-                        # atomic update: UPDATE ... SET warning_sent=True WHERE id=... AND warning_sent=False
-                        rows_updated = PriceMonitor.update(warning_sent=True).where(
-                            (PriceMonitor.id == m.id) & 
-                            (PriceMonitor.warning_sent == False)
-                        ).execute()
-                        
-                        if rows_updated > 0:
-                            # 发送预警 (纯文本，不调用LLM)
-                            direction = "approaching UP to" if m.operator == 'gt' else "approaching DOWN to"
-                            msg = f"⚠️ [Pre-Alert] {m.ts_code} is {direction} {m.trigger_price}. Current: {curr_price} (Diff: {diff_pct:.2f}%)"
-                            self.notifier.send_text(msg)
-                            
-                            m.warning_sent = True
-                            logger.info(f"Sent warning for {m.ts_code}: {msg}")
-
-        # 4. 处理触发
-        if triggered_monitors:
-            logger.info(f"Monitor: Triggered {len(triggered_monitors)} signals.")
-            self.handle_triggers(triggered_monitors)
-        else:
-            # logging.info(f"Monitor: Checked {len(monitors)} items, no triggers.")
-            pass
+
+        # 3. 二分定位触发与预警区间
+        triggered, warnings = self.index.scan(prices)
+        for ts_code in {m.ts_code for m, _ in triggered}:
+            self.poller.record_detection(ts_code, self.poller.sample_gap(ts_code))
+        self.poller.record_poll(ts_codes, prices, self.index.nearest)
+
+        # 复用本次行情刷新持仓估值 (仅更新已持有的代码，近实时的账户权益)
+        if self.mark_to_market and prices:
+            try:
+                self.portfolio.apply(prices)
+            except Exception as e:
+                logging.warning(f"Mark-to-market failed: {e}")
+
+        # 预警 (纯文本，不调用LLM)：批量原子更新，只对本次成功置位的监控发送，防止并发导致重复预警
+        if warnings:
+            claimed = self.index.mark_warned([m for m, _, _ in warnings])
+            for m, curr_price, diff_pct in warnings:
+                if m.id not in claimed:
+                    continue
+                direction = "approaching UP to" if m.operator == 'gt' else "approaching DOWN to"
+                msg = f"⚠️ [Pre-Alert] {m.ts_code} is {direction} {m.trigger_price}. Current: {curr_price} (Diff: {diff_pct:.2f}%)"
+                self.notifier.send_text(msg, coalesce_key=PRE_ALERT)
+                logger.info(f"Sent warning for {m.ts_code}: {msg}")
+
+        # 4. 处理触发：先批量锁定状态 (ACTIVE -> TRIGGERED)，防止重入
+        if triggered:
+            claimed = self.index.claim_triggered([m for m, _ in triggered])
+            triggered = [(m, price) for m, price in triggered if m.id in claimed]
+        if triggered:
+            logger.info(f"Monitor: Triggered {len(triggered)} signals.")
+            self.handle_triggers(triggered)
 
     def handle_triggers(self, triggers):
-        """处理触发列表 (串行)"""
-        for monitor, price in triggers:
+        """将触发分派到线程池并行处理 (同一股票串行)，监控单已在 run_check 中锁定为 TRIGGERED"""
+        detected_at = clock.now()
+        detected = time.monotonic()
+        futures = [self.executor.submit(self._process_trigger, monitor, price, detected_at, detected)
+                   for monitor, price in triggers]
+        with self._pending_lock:
+            self._pending.update(futures)
+        for future in futures:
+            future.add_done_callback(self._discard_pending)
+        return futures
+
+    def _discard_pending(self, future):
+        with self._pending_lock:
+            self._pending.discard(future)
+
+    def drain(self, timeout=None):
+        """等待已分派的触发处理完成"""
+        with self._pending_lock:
+            pending, self._pending = self._pending, set()
+        wait(pending, timeout=timeout)
+
+    def _symbol_lock(self, ts_code):
+        with self._pending_lock:
+            return self._symbol_locks.setdefault(ts_code, threading.Lock())
+
+    @staticmethod
+    def _still_triggered(monitor, price):
+        if monitor.operator == 'gt':
+            return price >= monitor.trigger_price
+        return price <= monitor.trigger_price
+
+    @routine_context.track('trigger')
+    def _process_trigger(self, monitor, price, detected_at, detected):
+        event = TriggerEvent(monitor_id=monitor.id, ts_code=monitor.ts_code,
+                             detected_at=detected_at, detect_price=price, outcome='ERROR')
+        elapsed_ms = lambda: (time.monotonic() - detected) * 1000
+
+        with self._symbol_lock(monitor.ts_code):
+            event.queue_ms = elapsed_ms()
             logger.info(f"Processing trigger for {monitor.ts_code}: Current={price} Target={monitor.trigger_price} ({monitor.operator})")
-            
-            # A. 立即锁定状态，防止重入 (冷却/消耗机制)
-            monitor.status = 'TRIGGERED'
-            monitor.triggered_at = datetime.datetime.now()
-            monitor.save()
-            
             try:
-                # B. 获取更详细的盘口数据交给 Analyst
-                quote_data = self.ts_client.get_realtime_quote(monitor.ts_code)
-                
-                # C. 调用分析师进行突发分析
-                # 注意：Analyst 需要新增 analyze_trigger 方法
-                analysis_result = self.analyst.analyze_trigger(monitor, price, quote_data)
-                
-                if not analysis_result:
-                    logging.warning(f"Analyst returned no result for {monitor.ts_code}")
-                    continue
-                
-                # D. 交给决策者
-                # 注意：DecisionMaker 需要新增 decide_on_trigger 方法
-                orders = self.decision_maker.decide_on_trigger(analysis_result)
-                
-                # E. 执行交易 & 通知
-                
-                # 构造消息基础信息
-                stock_name = self.ts_client.get_stock_name(monitor.ts_code) or monitor.ts_code
-                analyst_action = analysis_result.get('action', 'N/A')
-                analyst_conf = analysis_result.get('confidence', 0)
-                reason_text = analysis_result.get('reason', 'No specific reason provided.')
-                
-                msg_title = f"⚡ 盘中监控触发: {stock_name} ({monitor.ts_code})"
-                
-                msg_body = f"**触发价格:** {price} (目标: {monitor.trigger_price})\n\n"
-                msg_body += f"📊 **分析师建议:** {analyst_action} (信心: {analyst_conf})\n"
-                msg_body += f"📝 **逻辑:** {reason_text}\n\n"
-
-                if orders:
-                    results = self.trader.execute_orders(orders)
-                    if results:
-                        msg_body += "✅ **机器人自动执行:** \n" + "\n".join([f"> {r}" for r in results])
-                    else:
-                        msg_body += "⚠️ **机器人尝试执行但在交易环节被拒 (可能余额不足)**"
-                else:
-                    msg_body += "✋ **机器人决策:** 保持观望 (未满足自动交易条件)\n"
-                    msg_body += "> _提示: 即使机器人未交易，由于已触发监控且分析师已给出建议，请关注_."
-                
-                self.notifier.send_markdown(msg_title, msg_body)
-                logging.info(f"Trigger processed for {monitor.ts_code}")
-                    
+                self._analyze_and_execute(monitor, price, event, detected, elapsed_ms)
             except Exception as e:
                 logging.error(f"Error handling trigger for {monitor.ts_code}: {e}", exc_info=True)
                 self.notifier.send_text(f"Error handling trigger for {monitor.ts_code}: {e}")
+            finally:
+                event.total_ms = elapsed_ms()
+                try:
+                    event.save()
+                except Exception as e:
+                    logging.error(f"Failed to record trigger event for {monitor.ts_code}: {e}")
+
+    def _analyze_and_execute(self, monitor, price, event, detected, elapsed_ms):
+        # B. 获取更详细的盘口数据交给 Analyst
+        analysis_started = time.monotonic()
+        quote_data = self.ts_client.get_realtime_quote(monitor.ts_code)
+
+        # C. 调用分析师进行突发分析
+        analysis_result = self.analyst.analyze_trigger(monitor, price, quote_data)
+        event.analysis_ms = (time.monotonic() - analysis_started) * 1000
+
+        if not analysis_result:
+            logging.warning(f"Analyst returned no result for {monitor.ts_code}")
+            event.outcome = 'NO_ANALYSIS'
+            return
+
+        # D. 交给决策者
+        orders = self.decision_maker.decide_on_trigger(analysis_result)
+        event.action = analysis_result.get('action')
+
+        # E. 执行交易 & 通知
+
+        # 构造消息基础信息
+        stock_name = self.ts_client.get_stock_name(monitor.ts_code) or monitor.ts_code
+        analyst_action = analysis_result.get('action', 'N/A')
+        analyst_conf = analysis_result.get('confidence', 0)
+        reason_text = analysis_result.get('reason', 'No specific reason provided.')
+
+        msg_title = f"⚡ 盘中监控触发: {stock_name} ({monitor.ts_code})"
+
+        msg_body = f"**触发价格:** {price} (目标: {monitor.trigger_price})\n\n"
+        msg_body += f"📊 **分析师建议:** {analyst_action} (信心: {analyst_conf})\n"
+        msg_body += f"📝 **逻辑:** {reason_text}\n\n"
+
+        if orders:
+            # 超出时延预算: 重新取价，触发条件已不成立则放弃执行
+            order_price = price
+            if elapsed_ms() > self.latency_budget * 1000:
+                event.over_budget = True
+                order_price = self.ts_client.get_latest_price(monitor.ts_code) or price
+                logging.warning(f"Trigger for {monitor.ts_code} exceeded latency budget "
+                                f"({elapsed_ms():.0f}ms > {self.latency_budget}s), re-priced {price} -> {order_price}")
+            if event.over_budget and not self._still_triggered(monitor, order_price):
+                event.outcome = 'EXPIRED'
+                msg_body += f"⏱️ **超出时延预算且价格已回到触发线内 (现价 {order_price})，放弃执行**"
+            else:
+                for order in orders:
+                    if event.over_budget or not order.get('price'):
+                        order['price'] = order_price
+                event.order_price = order_price
+                event.order_ms = elapsed_ms()
+                results = [r for r in self.trader.execute_orders(orders) if r]
+                if results:
+                    event.outcome = 'EXECUTED'
+                    msg_body += "✅ **机器人自动执行:** \n" + "\n".join([f"> {r}" for r in results])
+                else:
+                    event.outcome = 'REJECTED'
+                    msg_body += "⚠️ **机器人尝试执行但在交易环节被拒 (可能余额不足)**"
+        else:
+            event.outcome = 'NO_ORDER'
+            msg_body += "✋ **机器人决策:** 保持观望 (未满足自动交易条件)\n"
+            msg_body += "> _提示: 即使机器人未交易，由于已触发监控且分析师已给出建议，请关注_."
+
+        self.notifier.send_markdown(msg_title, msg_body)
+        logging.info(f"Trigger processed for {monitor.ts_code} ({event.outcome}, {elapsed_ms():.0f}ms)")
@@ -0,0 +1,87 @@
+import time
+import logging
+import datetime
+import threading
+from core import clock
+from core.signals import SignalWatcher, MONITORS_CHANGED
+from core.tick_buffer import tick_buffer
+
+logger = logging.getLogger(__name__)
+
+# 监控时段 (9:30 - 11:29, 13:00 - 14:49)，尾盘交给 pre_close 流程
+MONITOR_SESSIONS = [
+    (datetime.time(9, 30), datetime.time(11, 29)),
+    (datetime.time(13, 0), datetime.time(14, 49)),
+]
+
+def in_monitor_session(dt):
+    if dt.weekday() > 4:
+        return False
+    now = dt.time()
+    return any(start <= now <= end for start, end in MONITOR_SESSIONS)
+
+class MonitorRunner:
+    """独立的价格监控循环，与 APScheduler 的策略流程解耦
+
+    以固定间隔调用 PriceMonitorService.run_check，流程耗时不影响监控节奏。
+    与主流程经数据库共享监控单，收到 monitors_changed 信号时立即重建索引并检查。
+    既可作为主进程内的专用线程运行，也可作为独立进程运行 (python main.py --monitor)。
+    """
+
+    SIGNAL_POLL = 0.5  # 等待期间检查信号的间隔(秒)
+
+    def __init__(self, service, interval=5, idle_interval=30):
+        self.service = service
+        self.interval = interval            # 交易时段轮询间隔
+        self.idle_interval = idle_interval  # 非交易时段的检查间隔
+        self.watcher = SignalWatcher(MONITORS_CHANGED)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def tick(self):
+        """执行一次检查，返回距下一次检查的秒数"""
+        now = clock.now()
+        if not in_monitor_session(now):
+            self.service.poller.close_session()
+            # 午休只落库；收盘后同时清空缓冲
+            tick_buffer.end_session(clear=now.time() >= MONITOR_SESSIONS[-1][1])
+            return self.idle_interval
+        started = time.monotonic()
+        try:
+            self.service.run_check()
+        except Exception as e:
+            logger.error(f"Monitor task error: {e}", exc_info=True)
+        elapsed = time.monotonic() - started
+        if elapsed > self.interval:
+            logger.warning(f"Monitor check took {elapsed:.2f}s (> interval {self.interval}s)")
+        return max(0.0, self.interval - elapsed)
+
+    def _sleep(self, seconds):
+        """等待到下一次检查，期间收到信号或停止请求时提前返回"""
+        deadline = time.monotonic() + seconds
+        while not self._stop.is_set():
+            if self.watcher.changed():
+                self.service.index.invalidate()
+                return
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            self._stop.wait(min(self.SIGNAL_POLL, remaining))
+
+    def run(self):
+        logger.info(f"Monitor runner started (interval={self.interval}s).")
+        while not self._stop.is_set():
+            self._sleep(self.tick())
+        self.service.drain()
+        logger.info("Monitor runner stopped.")
+
+    def start(self):
+        """在专用守护线程中运行"""
+        self._thread = threading.Thread(target=self.run, name='monitor-runner', daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
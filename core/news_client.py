@@ -2,13 +2,16 @@ import akshare as ak
 import pandas as pd
 import logging
 import time
+from core.tracing import traced
 
 class NewsClient:
-    def get_stock_news(self, ts_code, limit=5):
+    @traced('akshare')
+    def get_stock_news(self, ts_code, limit=5, snippet_chars=60):
         """
         获取个股新闻
         :param ts_code: 股票代码 (e.g. 600519.SH)
         :param limit: 获取最近N条
+        :param snippet_chars: 每条新闻正文摘要的最大字数 (每条一行，按时间倒序)
         :return: string (formatted news summary)
         """
         try:
@@ -31,14 +34,19 @@ class NewsClient:
             # 取最近的N条
             recent_news = df.head(limit)
             
-            news_context = ""
+            lines = []
             for index, row in recent_news.iterrows():
-                title = row.get('新闻标题', 'No Title')
+                title = ' '.join(str(row.get('新闻标题', 'No Title')).split())
                 date = row.get('发布时间', '')
-                content = str(row.get('新闻内容', ''))[:100] # 截取前100字作为摘要
-                news_context += f"- [{date}] {title}: {content}...\n"
-            
-            return news_context
+                date = date.strftime('%m-%d %H:%M') if hasattr(date, 'strftime') else str(date)
+                # 摘要: 压缩空白，与标题重复的开头不再重复
+                content = ' '.join(str(row.get('新闻内容', '')).split())
+                if content.startswith(title):
+                    content = content[len(title):].lstrip(' ，,。')
+                snippet = content[:snippet_chars] + ('…' if len(content) > snippet_chars else '')
+                lines.append(f"- [{date}] {title}" + (f": {snippet}" if snippet else ""))
+
+            return "\n".join(lines)
 
         except Exception as e:
             logging.error(f"Failed to fetch news for {ts_code}: {e}")
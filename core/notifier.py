@@ -1,23 +1,272 @@
 import time
 import hmac
+import queue
 import hashlib
 import base64
+import datetime
+import threading
+import collections
 import urllib.parse
 import requests
 import logging
 import os
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
+from core.db_models import NotificationOutbox
+from core.tracing import traced
 
 load_dotenv()
 
+PRE_ALERT = 'pre_alert'  # 盘中预警 (合并发送)
+
+# 合并摘要的标题
+DIGEST_TITLES = {PRE_ALERT: '⚠️ 盘中预警'}
+
+class TokenBucket:
+    """令牌桶限流: 容量 capacity，每秒补充 rate 个"""
+
+    def __init__(self, rate_per_minute=20, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or rate_per_minute
+        self.tokens = float(self.capacity)
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        """取一个令牌 (不足时阻塞等待)"""
+        self._refill()
+        while self.tokens < 1:
+            time.sleep((1 - self.tokens) / self.rate)
+            self._refill()
+        self.tokens -= 1
+
+def _pid_alive(pid):
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class NotificationQueue:
+    """钉钉消息的后台投递队列 (所有 DingTalkNotifier 实例共享)
+
+    - 调用方只写 NotificationOutbox 并入队，不等待网络；投递由单个后台线程完成
+    - 令牌桶限流 (机器人每分钟 20 条)，失败按指数退避重试，超过次数标记 FAILED
+    - 带 coalesce_key 的消息 (如盘中预警) 在合并窗口内合并为一条 markdown 摘要
+    - 未送达的消息保留为 PENDING，进程重启后 (原投递进程已退出) 继续发送
+    """
+
+    def __init__(self, queue_size=200, rate_per_minute=20, coalesce_window=5, max_attempts=5,
+                 retention_days=7):
+        self.queue_size = queue_size
+        self.coalesce_window = coalesce_window
+        self.max_attempts = max_attempts
+        self.retention_days = retention_days
+        self.bucket = TokenBucket(rate_per_minute)
+        self.transport = None
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._backlog = collections.deque()  # 合并窗口内取到的其他消息
+        self._overflow = False
+        self._stopping = threading.Event()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def configure(self, config=None):
+        config = config or {}
+        self.queue_size = config.get('queue_size', self.queue_size)
+        self._queue = queue.Queue(maxsize=self.queue_size)
+        self.coalesce_window = config.get('coalesce_window', self.coalesce_window)
+        self.max_attempts = config.get('max_attempts', self.max_attempts)
+        self.retention_days = config.get('retention_days', self.retention_days)
+        self.bucket = TokenBucket(config.get('rate_per_minute', 20))
+
+    # ---- 入队 (调用方线程) ----
+    def submit(self, transport, kind, title, body, coalesce_key=None):
+        """落库并入队，立即返回 outbox id (落库失败时为 None，仅内存投递)"""
+        self.transport = transport
+        self._ensure_worker()
+        row_id = None
+        try:
+            row_id = NotificationOutbox.create(kind=kind, title=title, body=body, coalesce_key=coalesce_key,
+                                               owner_pid=os.getpid()).id
+        except Exception as e:
+            logging.warning(f"Failed to persist notification: {e}")
+        item = {'id': row_id, 'kind': kind, 'title': title, 'body': body, 'coalesce_key': coalesce_key,
+                'attempts': 0}
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            # 已落库，队列空闲时重新载入
+            self._overflow = True
+            logging.warning(f"Notification queue full, deferred: {title or body[:30]}")
+        return row_id
+
+    def _ensure_worker(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._stopping.clear()
+                self._thread = threading.Thread(target=self._run, name='dingtalk-delivery', daemon=True)
+                self._thread.start()
+
+    # ---- 投递 (后台线程) ----
+    def _recover(self, orphaned=True):
+        """载入未送达的消息: orphaned=True 时接管已退出进程遗留的，否则载入本进程溢出的"""
+        me = os.getpid()
+        query = NotificationOutbox.select().where(NotificationOutbox.status == 'PENDING').order_by(NotificationOutbox.id)
+        loaded = 0
+        for row in query:
+            if orphaned:
+                if row.owner_pid == me or _pid_alive(row.owner_pid):
+                    continue
+                owner = (NotificationOutbox.owner_pid.is_null() if row.owner_pid is None
+                         else NotificationOutbox.owner_pid == row.owner_pid)
+                claimed = (NotificationOutbox.update(owner_pid=me)
+                           .where((NotificationOutbox.id == row.id) & owner)
+                           .execute())
+                if not claimed:
+                    continue
+            elif row.owner_pid != me:
+                continue
+            self._backlog.append({'id': row.id, 'kind': row.kind, 'title': row.title, 'body': row.body,
+                                  'coalesce_key': row.coalesce_key, 'attempts': row.attempts})
+            loaded += 1
+        if loaded:
+            logging.info(f"Recovered {loaded} undelivered notifications.")
+
+    def _prune(self):
+        cutoff = datetime.datetime.now() - datetime.timedelta(days=self.retention_days)
+        NotificationOutbox.delete().where((NotificationOutbox.status != 'PENDING')
+                                          & (NotificationOutbox.created_at < cutoff)).execute()
+
+    def _next(self, timeout):
+        if self._backlog:
+            return self._backlog.popleft()
+        return self._queue.get(timeout=timeout)
+
+    def _coalesce(self, first):
+        """在合并窗口内收集同 key 的消息，其他消息放回 backlog 按序处理"""
+        items, others = [first], []
+        deadline = time.monotonic() + self.coalesce_window
+        for item in list(self._backlog):
+            (items if item['coalesce_key'] == first['coalesce_key'] else others).append(item)
+        self._backlog.clear()
+        while not self._stopping.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            (items if item['coalesce_key'] == first['coalesce_key'] else others).append(item)
+        self._backlog.extend(others)
+        return items
+
+    @staticmethod
+    def _digest(items):
+        if len(items) == 1:
+            item = items[0]
+            return item['kind'], item['title'], item['body']
+        title = f"{DIGEST_TITLES.get(items[0]['coalesce_key'], '通知汇总')} ({len(items)})"
+        lines = "\n".join(f"- {item['body']}" for item in items)
+        return 'markdown', title, f"**{title}**\n\n{lines}"
+
+    def _mark(self, items, **fields):
+        ids = [item['id'] for item in items if item['id'] is not None]
+        if not ids:
+            return
+        try:
+            NotificationOutbox.update(**fields).where(NotificationOutbox.id.in_(ids)).execute()
+        except Exception as e:
+            logging.warning(f"Failed to update notification outbox: {e}")
+
+    def _deliver(self, items):
+        kind, title, body = self._digest(items)
+        attempts = max(item['attempts'] for item in items)
+        while True:
+            self.bucket.acquire()
+            error = self.transport.deliver(kind, title, body) if self.transport else "no transport"
+            attempts += 1
+            if error is None:
+                self._mark(items, status='SENT', attempts=attempts, sent_at=datetime.datetime.now())
+                return True
+            if attempts >= self.max_attempts:
+                self._mark(items, status='FAILED', attempts=attempts, last_error=str(error))
+                logging.error(f"DingTalk notification dropped after {attempts} attempts: {error}")
+                return False
+            self._mark(items, attempts=attempts, last_error=str(error))
+            if self._stopping.is_set():
+                return False  # 退出时不再等待重试，保留为 PENDING
+            time.sleep(min(60, 2 ** attempts))
+
+    def _run(self):
+        try:
+            self._prune()
+            self._recover(orphaned=True)
+        except Exception as e:
+            logging.warning(f"Notification outbox recovery failed: {e}")
+        while True:
+            try:
+                item = self._next(timeout=0.5)
+            except queue.Empty:
+                if self._stopping.is_set():
+                    return
+                if self._overflow:
+                    self._overflow = False
+                    self._recover(orphaned=False)
+                continue
+            items = self._coalesce(item) if item['coalesce_key'] else [item]
+            try:
+                self._deliver(items)
+            except Exception as e:
+                logging.error(f"Notification delivery error: {e}")
+
+    def pending(self):
+        return self._queue.qsize() + len(self._backlog)
+
+    def close(self, timeout=10):
+        """退出前尽量发送完队列中的消息，未送达的保留在 outbox 中下次启动继续发送"""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        self._stopping.set()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logging.warning(f"Notification queue closed with {self.pending()} messages pending (kept in outbox).")
+
+notification_queue = NotificationQueue()
+
 class DingTalkNotifier:
+    # 所有实例共享的连接池
+    _session = None
+    _session_lock = threading.Lock()
+
     def __init__(self, access_token=None, secret=None):
         self.access_token = access_token or os.getenv("DING_ROBOT_ACCESS_TOKEN")
         self.secret = secret or os.getenv("DING_ROBOT_SECRET")
-        
+
         if not self.access_token or not self.secret:
             logging.warning("DingTalk configuration missing. Notifications will not be sent.")
 
+    @classmethod
+    def _get_session(cls):
+        with cls._session_lock:
+            if cls._session is None:
+                session = requests.Session()
+                session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=2))
+                session.headers.update({'Content-Type': 'application/json'})
+                cls._session = session
+            return cls._session
+
     def _get_signed_url(self):
         timestamp = str(round(time.time() * 1000))
         string_to_sign = f'{timestamp}\n{self.secret}'
@@ -25,55 +274,45 @@ class DingTalkNotifier:
         sign = urllib.parse.quote_plus(base64.b64encode(hmac_code))
         return f'https://oapi.dingtalk.com/robot/send?access_token={self.access_token}&timestamp={timestamp}&sign={sign}'
 
-    def send_text(self, msg, at_user_ids=None, at_mobiles=None, is_at_all=False):
-        """发送纯文本消息"""
+    @traced('dingtalk')
+    def send_text(self, msg, coalesce_key=None):
+        """发送纯文本消息 (异步)；coalesce_key 相同的消息在合并窗口内合并为一条摘要"""
         if not self.access_token: return
-        
-        url = self._get_signed_url()
-        body = {
-            "at": {
-                "isAtAll": is_at_all,
-                "atUserIds": at_user_ids or [],
-                "atMobiles": at_mobiles or []
-            },
-            "text": {
-                "content": msg
-            },
-            "msgtype": "text"
-        }
-        return self._post(url, body)
-
-    def send_markdown(self, title, text, at_user_ids=None, at_mobiles=None, is_at_all=False):
-        """发送Markdown消息"""
+        return notification_queue.submit(self, 'text', None, msg, coalesce_key)
+
+    @traced('dingtalk')
+    def send_markdown(self, title, text, coalesce_key=None):
+        """发送Markdown消息 (异步)"""
         if not self.access_token: return
-        
-        url = self._get_signed_url()
-        body = {
-            "at": {
-                "isAtAll": is_at_all,
-                "atUserIds": at_user_ids or [],
-                "atMobiles": at_mobiles or []
-            },
-            "markdown": {
-                "title": title,
-                "text": text
-            },
-            "msgtype": "markdown"
-        }
-        return self._post(url, body)
+        return notification_queue.submit(self, 'markdown', title, text, coalesce_key)
+
+    @traced('dingtalk')
+    def deliver(self, kind, title, text):
+        """同步发送一条消息 (由投递线程调用)，成功返回 None，失败返回错误信息"""
+        if kind == 'markdown':
+            body = {"markdown": {"title": title, "text": text}, "msgtype": "markdown"}
+        else:
+            body = {"text": {"content": text}, "msgtype": "text"}
+        return self._post(self._get_signed_url(), body)
 
     def _post(self, url, body):
         try:
-            resp = requests.post(url, json=body, headers={'Content-Type': 'application/json'}, timeout=10)
+            resp = self._get_session().post(url, json=body, timeout=10)
             resp.raise_for_status()
+            result = resp.json()
+            # 钉钉以 errcode 表示业务错误 (如 130101 发送过快)
+            if result.get('errcode', 0) != 0:
+                logging.warning(f"DingTalk rejected notification: {result}")
+                return result.get('errmsg') or str(result)
             logging.info(f"DingTalk notification sent: {resp.text}")
-            return resp.json()
+            return None
         except Exception as e:
             logging.error(f"Failed to send DingTalk notification: {e}")
-            return None
+            return str(e)
 
 if __name__ == "__main__":
     # Test
     logging.basicConfig(level=logging.INFO)
     notifier = DingTalkNotifier()
     notifier.send_markdown("Markdown Test", "# Hello \n **Bold Text** \n > Quote")
+    notification_queue.close()
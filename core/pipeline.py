@@ -0,0 +1,67 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from core import routine_context
+from core.tracing import tracer
+
+
+class StagedPipeline:
+    """分阶段有界并发流水线
+
+    每个阶段拥有独立的线程池(并发上限可配置)，条目完成上一阶段后立即进入下一阶段，
+    因此总耗时取决于最慢的单个条目，而不是所有条目耗时之和。
+    阶段函数签名为 func(ctx) -> ctx，ctx 为每个条目独立的 dict。
+    """
+
+    def __init__(self, stages):
+        # stages: [(name, func, max_workers), ...]
+        self.stages = stages
+
+    def run(self, items):
+        """运行流水线，按输入顺序返回每个条目的最终 ctx (失败的条目为 None)"""
+        items = list(items)
+        results = [None] * len(items)
+        if not items:
+            return results
+
+        executors = [
+            ThreadPoolExecutor(max_workers=max(1, int(workers)), thread_name_prefix=f"pipeline-{name}")
+            for name, _, workers in self.stages
+        ]
+        remaining = [len(items)]
+        lock = threading.Lock()
+        done = threading.Event()
+
+        def finish(idx, ctx):
+            results[idx] = ctx
+            with lock:
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    done.set()
+
+        def run_stage(stage_idx, idx, ctx):
+            name, func, _ = self.stages[stage_idx]
+            try:
+                with tracer.span(name, 'pipeline'):
+                    ctx = func(ctx)
+            except Exception as e:
+                logging.error(f"Pipeline stage '{name}' failed for item {items[idx]}: {e}", exc_info=True)
+                finish(idx, None)
+                return
+
+            if ctx is None:
+                finish(idx, None)
+            elif stage_idx + 1 < len(self.stages):
+                routine_context.submit(executors[stage_idx + 1], run_stage, stage_idx + 1, idx, ctx)
+            else:
+                finish(idx, ctx)
+
+        try:
+            for idx, item in enumerate(items):
+                ctx = item if isinstance(item, dict) else {'item': item}
+                routine_context.submit(executors[0], run_stage, 0, idx, ctx)
+            done.wait()
+        finally:
+            for executor in executors:
+                executor.shutdown(wait=True)
+        return results
@@ -0,0 +1,167 @@
+import math
+import logging
+import datetime
+import numpy as np
+import pandas as pd
+from core import clock
+from peewee import fn
+from core.db_models import StockDaily, StockIndicator
+
+logger = logging.getLogger(__name__)
+
+class AdaptivePollScheduler:
+    """按距触发线的远近 (以 ATR 计) 为每只股票分配轮询间隔
+
+    - 处于预警区 (距最近触发价 1% 以内) 或距离不足 0.5 个 ATR: 每个基础间隔都轮询
+    - 距离越远，间隔按档位成倍放大，最长 max_interval
+    - 从未轮询过的股票 (新监控单) 立即轮询
+    按交易时段 (上午/下午) 统计实时行情配额消耗与平均检测延迟。
+    检测延迟按采样间隔估算: 价格在两次采样之间均匀穿越触发线，期望延迟为间隔的一半。
+    """
+
+    # (距离上限 ATR 倍数, 间隔倍数)
+    TIERS = [(0.5, 1), (1.0, 2), (2.0, 4), (4.0, 8)]
+    FAR_MULTIPLIER = 16
+    ATR_PERIOD = 14
+    DEFAULT_ATR_PCT = 0.02  # 无日线时按价格的 2% 估算 ATR
+
+    def __init__(self, base_interval=5, max_interval=120, warning_pct=1.0, request_counter=None):
+        self.base_interval = base_interval
+        self.max_interval = max_interval
+        self.warning_pct = warning_pct
+        # callable(n) -> 获取 n 只股票行情消耗的请求数 (由行情提供者决定)，默认按 80 只一块
+        self.request_counter = request_counter or (lambda n: math.ceil(n / 80))
+        self._next_due = {}   # ts_code -> 下次轮询时间 (timestamp)
+        self._last_poll = {}  # ts_code -> 上次轮询时间
+        self._atr = {}
+        self._atr_date = None
+        self._session = None
+        self._stats = None
+        self.sessions = []    # 已结束时段的统计
+
+    # ---- 波动率 ----
+    def _load_atr(self, ts_codes):
+        """读取 StockIndicator 最新一日的 atr14，无指标的代码再由 StockDaily 计算 ATR(14)，按交易日缓存"""
+        today = clock.now().strftime('%Y%m%d')
+        if today != self._atr_date:
+            self._atr, self._atr_date = {}, today
+        missing = [c for c in ts_codes if c not in self._atr]
+        if not missing:
+            return
+        start = (clock.now() - datetime.timedelta(days=self.ATR_PERIOD * 3)).strftime('%Y%m%d')
+        latest = (StockIndicator
+                  .select(StockIndicator.ts_code, fn.MAX(StockIndicator.trade_date).alias('last_date'))
+                  .where(StockIndicator.ts_code.in_(missing) & (StockIndicator.trade_date >= start)
+                         & (StockIndicator.trade_date < today))
+                  .group_by(StockIndicator.ts_code)
+                  .alias('latest'))
+        rows = (StockIndicator
+                .select(StockIndicator.ts_code, StockIndicator.atr14)
+                .join(latest, on=((StockIndicator.ts_code == latest.c.ts_code)
+                                  & (StockIndicator.trade_date == latest.c.last_date)))
+                .where(StockIndicator.atr14.is_null(False))
+                .tuples())
+        self._atr.update(dict(rows))
+        missing = [c for c in missing if c not in self._atr]
+        if not missing:
+            return
+
+        rows = (StockDaily
+                .select(StockDaily.ts_code, StockDaily.trade_date, StockDaily.high, StockDaily.low, StockDaily.pre_close)
+                .where(StockDaily.ts_code.in_(missing) & (StockDaily.trade_date >= start) & (StockDaily.trade_date < today))
+                .tuples())
+        df = pd.DataFrame(list(rows), columns=['ts_code', 'trade_date', 'high', 'low', 'pre_close'])
+        if not df.empty:
+            df = df.sort_values(['ts_code', 'trade_date'])
+            df['tr'] = np.fmax(df['high'] - df['low'],
+                               np.fmax((df['high'] - df['pre_close']).abs(), (df['low'] - df['pre_close']).abs()))
+            self._atr.update(df.groupby('ts_code')['tr'].apply(lambda s: s.tail(self.ATR_PERIOD).mean()).to_dict())
+        for code in missing:
+            self._atr.setdefault(code, None)
+
+    def interval_for(self, ts_code, price, nearest_trigger):
+        """根据与最近触发价的距离计算该股票的轮询间隔(秒)"""
+        if nearest_trigger is None or not price:
+            return self.max_interval
+        distance = abs(price - nearest_trigger)
+        if distance / nearest_trigger * 100 <= self.warning_pct:
+            return self.base_interval
+        atr = self._atr.get(ts_code) or price * self.DEFAULT_ATR_PCT
+        distance_atr = distance / atr
+        multiplier = next((m for limit, m in self.TIERS if distance_atr < limit), self.FAR_MULTIPLIER)
+        return min(self.base_interval * multiplier, self.max_interval)
+
+    # ---- 调度 ----
+    def reset(self):
+        """监控单变化后全部重新评估 (下一次检查全部轮询)"""
+        self._next_due.clear()
+
+    def due(self, ts_codes):
+        """返回本次需要轮询的股票"""
+        self._roll_session()
+        now = clock.now().timestamp()
+        return [c for c in ts_codes if self._next_due.get(c, 0) <= now]
+
+    def record_poll(self, ts_codes, prices, nearest):
+        """
+        :param ts_codes: 本次请求的股票
+        :param prices: {ts_code: price} 实际返回的价格
+        :param nearest: callable(ts_code, price) -> 最近触发价 (无则 None)
+        """
+        self._load_atr(ts_codes)
+        now = clock.now().timestamp()
+        for code in ts_codes:
+            price = prices.get(code)
+            if not price:
+                # 请求失败或未返回该代码: 不知道价格离触发价多远，按最短间隔重试而不是退避到最长间隔
+                interval = self.base_interval
+            else:
+                interval = self.interval_for(code, price, nearest(code, price))
+            self._next_due[code] = now + interval
+            self._last_poll[code] = now
+
+        stats = self._stats
+        stats['polls'] += 1
+        stats['symbols'] += len(ts_codes)
+        stats['requests'] += self.request_counter(len(ts_codes))
+
+    def record_detection(self, ts_code, sample_gap=None):
+        """记录一次触发检测，估算检测延迟 (采样间隔的一半)"""
+        if sample_gap is None:
+            sample_gap = self.base_interval
+        self._stats['detections'] += 1
+        self._stats['lag_total'] += sample_gap / 2
+
+    def sample_gap(self, ts_code):
+        """本次采样与上一次采样的间隔 (秒)，需在 record_poll 之前调用"""
+        last = self._last_poll.get(ts_code)
+        return clock.now().timestamp() - last if last else None
+
+    # ---- 时段统计 ----
+    def _session_key(self):
+        now = clock.now()
+        return f"{now.strftime('%Y%m%d')}-{'AM' if now.hour < 12 else 'PM'}"
+
+    def _roll_session(self):
+        key = self._session_key()
+        if key != self._session:
+            self.close_session()
+            self._session = key
+            self._stats = {'polls': 0, 'symbols': 0, 'requests': 0, 'detections': 0, 'lag_total': 0.0}
+            # 跨时段的间隔 (午休/隔夜) 不计入检测延迟
+            self._last_poll.clear()
+
+    def close_session(self):
+        """输出并结束当前时段的统计，返回统计 dict"""
+        if self._session is None or not self._stats['polls']:
+            self._session = None
+            return None
+        stats = dict(self._stats, session=self._session)
+        stats['avg_detection_lag'] = round(stats.pop('lag_total') / stats['detections'], 2) if stats['detections'] else None
+        lag_text = f"{stats['avg_detection_lag']}s" if stats['detections'] else 'n/a'
+        logger.info(f"Monitor session {self._session}: {stats['polls']} polls, {stats['symbols']} symbol quotes, "
+                    f"{stats['requests']} quote requests, {stats['detections']} detections, "
+                    f"avg detection lag {lag_text}")
+        self._session = None
+        self.sessions.append(stats)
+        return stats
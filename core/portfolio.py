@@ -0,0 +1,55 @@
+import logging
+from core import clock
+from core.db_models import Position
+from core.ledger import ledger
+
+class PortfolioValuer:
+    """持仓批量估值 (mark-to-market)
+
+    一次批量取价，经账本 (core.ledger) 在单个事务内刷新所有持仓的现价/市值/浮盈，
+    并由持仓汇总重算 Account.market_value 与 total_assets；与下单共用同一写者，不会交错。
+    """
+
+    def __init__(self, ts_client=None):
+        self.ts_client = ts_client
+
+    def quote(self, ts_codes, snapshot=None, fields=('price', 'close', 'trade')):
+        """批量取价 {ts_code: price}: 优先流程行情快照，其次批量实时行情，最后逐只降级"""
+        prices = {}
+        if snapshot is not None:
+            for code in ts_codes:
+                price = snapshot.price(code, fields=fields)
+                if price > 0:
+                    prices[code] = price
+        missing = [c for c in ts_codes if c not in prices]
+        if missing and snapshot is None:
+            prices.update(self.ts_client.get_batch_realtime_quotes(missing))
+            missing = [c for c in ts_codes if c not in prices]
+        for code in missing:
+            price = self.ts_client.get_latest_price(code)
+            if price > 0:
+                prices[code] = price
+        return prices
+
+    def apply(self, prices):
+        """把价格写入持仓并重算账户 (经账本单事务落库)，返回 {'positions', 'market_value', 'total_assets', ...}；
+        prices 中没有持仓的代码会被忽略，没有任何持仓被更新时不写入并返回 None"""
+        return ledger.mark(prices)
+
+    def revalue(self, positions=None, snapshot=None, fields=('price', 'close', 'trade')):
+        """刷新全部 (或给定) 持仓的估值，同步传入的 Position 对象，返回 {ts_code: price}"""
+        positions = list(Position.select()) if positions is None else positions
+        prices = self.quote([pos.ts_code for pos in positions], snapshot, fields)
+        result = self.apply(prices)
+        now = clock.now()
+        for pos in positions:
+            price = prices.get(pos.ts_code)
+            if price:
+                pos.current_price = price
+                pos.market_value = pos.volume * price
+                pos.profit = pos.volume * (price - pos.avg_price)
+                pos.last_updated = now
+        if result:
+            logging.info(f"Revalued {result['positions']} positions: market value {result['market_value']:.2f}, "
+                         f"total assets {result['total_assets']:.2f}")
+        return prices
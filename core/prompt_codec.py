@@ -0,0 +1,114 @@
+"""Prompt 紧凑编码与 token 预算
+
+- 表格数据以 `|` 分隔的表头 + 行输出，数值去掉多余的 0
+- 分析报告只保留决策需要的字段
+- count_tokens 为不依赖分词器的近似计数 (中文按字、英文按约 4 字符、数字按约 3 位计)，
+  用于预算控制与统计，不要求与模型分词完全一致
+- fit_prompt 在超出预算时按给定顺序裁剪可截断的段落 (确定性: 相同输入得到相同结果)
+"""
+import re
+import math
+
+_TOKEN_RE = re.compile(r'[\u3400-\u9fff\uf900-\ufaff]|[A-Za-z]+|\d+|[^\sA-Za-z\d]')
+
+# 决策环节需要的报告字段 (analysis_details / monitor_setup 等不传给决策者)
+REPORT_FIELDS = ('ts_code', 'action', 'confidence', 'reason')
+
+def count_tokens(text):
+    """近似 token 数"""
+    n = 0
+    for tok in _TOKEN_RE.findall(text or ''):
+        if tok.isascii() and tok.isalpha():
+            n += math.ceil(len(tok) / 4)
+        elif tok.isdigit():
+            n += math.ceil(len(tok) / 3)
+        else:
+            n += 1
+    return n
+
+def fmt_num(value, digits=2):
+    """紧凑数值: 最多 digits 位小数并去掉末尾的 0；None/NaN 输出 '-'"""
+    if value is None:
+        return '-'
+    if isinstance(value, str):
+        return value
+    try:
+        if value != value:
+            return '-'
+        text = f"{float(value):.{digits}f}"
+    except (TypeError, ValueError):
+        return str(value)
+    return text.rstrip('0').rstrip('.') if '.' in text else text
+
+def _cell(value, digits):
+    if isinstance(value, (int, float)) or value is None:
+        return fmt_num(value, digits)
+    # 单元格内不允许出现分隔符与换行
+    return ' '.join(str(value).replace('|', '/').split())
+
+def encode_rows(columns, rows, digits=None):
+    """表格 -> 行列表 (首行为表头)；digits 为 {列名: 小数位}，未指定的列保留 2 位"""
+    digits = digits or {}
+    places = [digits.get(c, 2) for c in columns]
+    lines = ['|'.join(columns)]
+    for row in rows:
+        lines.append('|'.join(_cell(v, d) for v, d in zip(row, places)))
+    return lines
+
+def encode_table(columns, rows, digits=None):
+    return '\n'.join(encode_rows(columns, rows, digits))
+
+def prune_report(report, fields=REPORT_FIELDS, max_reason_chars=200):
+    """只保留指定字段，过长的理由截断"""
+    pruned = {k: report.get(k) for k in fields if k in report}
+    reason = pruned.get('reason')
+    if isinstance(reason, str) and len(reason) > max_reason_chars:
+        pruned['reason'] = reason[:max_reason_chars] + '…'
+    return pruned
+
+def encode_reports(reports, fields=REPORT_FIELDS, max_reason_chars=200):
+    """分析报告列表 -> 紧凑表格行"""
+    pruned = [prune_report(r, fields, max_reason_chars) for r in reports]
+    return encode_rows(list(fields), [[r.get(f) for f in fields] for r in pruned], {'confidence': 1})
+
+def fit_prompt(render, sections, budget):
+    """
+    按 token 预算裁剪 Prompt
+    :param render: callable(**overrides) -> str，overrides 为各可裁剪变量裁剪后的文本
+    :param sections: [(变量名, 行列表, keep, header)]，按裁剪优先级排列；keep='head' 保留开头 (丢弃末尾)，
+                     'tail' 保留末尾 (丢弃开头)；header 为始终保留的开头行数 (如表头)
+    :return: (prompt, tokens, truncated)
+    """
+    overrides = {name: '\n'.join(lines) for name, lines, _, _ in sections}
+    text = render(**overrides)
+    tokens = count_tokens(text)
+    if not budget or tokens <= budget:
+        return text, tokens, False
+
+    for name, lines, keep, header_rows in sections:
+        header, body = lines[:header_rows], lines[header_rows:]
+
+        def shrink(k):
+            omitted = len(body) - k
+            kept = body[:k] if keep == 'head' else body[len(body) - k:]
+            note = [f"({omitted} {'later' if keep == 'head' else 'earlier'} rows omitted)"] if omitted else []
+            part = header + (kept + note if keep == 'head' else note + kept)
+            return '\n'.join(part)
+
+        # 二分查找在预算内可保留的最多行数
+        lo, hi = 0, len(body)
+        best = None
+        while lo <= hi:
+            mid = (lo + hi) // 2
+            candidate = render(**dict(overrides, **{name: shrink(mid)}))
+            n = count_tokens(candidate)
+            if n <= budget:
+                best, lo = (mid, candidate, n), mid + 1
+            else:
+                hi = mid - 1
+        if best is not None:
+            return best[1], best[2], True
+        overrides[name] = shrink(0)
+
+    text = render(**overrides)
+    return text, count_tokens(text), True
@@ -0,0 +1,203 @@
+import math
+import time
+import logging
+import threading
+import pandas as pd
+import tushare as ts
+from concurrent.futures import ThreadPoolExecutor
+from core import clock, routine_context
+from core.tracing import traced
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 80  # realtime_quote 单次请求的股票数
+
+# 统一后的行情列 (下游 tick 缓冲、分钟线、analyst 均按这些列名读取)
+QUOTE_COLUMNS = ['price', 'open', 'high', 'low', 'pre_close', 'volume', 'amount', 'bid1', 'ask1', 'date', 'time']
+NUMERIC_COLUMNS = ['price', 'open', 'high', 'low', 'pre_close', 'volume', 'amount', 'bid1', 'ask1']
+
+# 不同接口的列名差异 -> 统一列名
+REALTIME_QUOTE_COLUMNS = {'b1_p': 'bid1', 'a1_p': 'ask1', 'trade': 'price'}
+REALTIME_LIST_COLUMNS = {'close': 'pre_close', 'vol': 'volume', 'b1_p': 'bid1', 'a1_p': 'ask1'}
+
+def _to_float(series):
+    try:
+        return series.astype(float)
+    except (TypeError, ValueError):
+        return pd.to_numeric(series, errors='coerce')
+
+def normalize_quotes(df, rename=None):
+    """把接口返回的行情整理为以 ts_code 为索引的列式 DataFrame (列名小写、数值列转为 float)"""
+    if df is None or df.empty:
+        return empty_frame()
+    columns = [c.lower() for c in df.columns]
+    if rename:
+        columns = [rename[c] if c in rename and rename[c] not in columns else c for c in columns]
+    df.columns = columns
+    code_col = 'ts_code' if 'ts_code' in columns else 'code'
+    df = df.set_index(code_col)
+    df.index.name = 'ts_code'
+    if df.index.hasnans or not df.index.is_unique:
+        df = df[df.index.notna()]
+        df = df[~df.index.duplicated(keep='last')]
+    for col in QUOTE_COLUMNS:
+        if col not in df.columns:
+            df[col] = None
+    for col in NUMERIC_COLUMNS:
+        if df[col].dtype != float:
+            df[col] = _to_float(df[col])
+    return df
+
+def empty_frame():
+    return pd.DataFrame(columns=QUOTE_COLUMNS, index=pd.Index([], name='ts_code'))
+
+def frame_to_quotes(frame):
+    """列式行情 -> {ts_code: quote dict} (NaN 转为 None)，供按 dict 读取的下游使用"""
+    columns = list(frame.columns)
+    quotes = {}
+    for code, row in zip(frame.index.tolist(), frame.to_numpy(dtype=object).tolist()):
+        quote = {col: (None if value != value else value) for col, value in zip(columns, row)}
+        quote['ts_code'] = code
+        quotes[code] = quote
+    return quotes
+
+class ChunkedQuoteProvider:
+    """按指定代码拉取实时行情: ts.realtime_quote 分块并行请求，失败的分块单独重试"""
+
+    def __init__(self, chunk_size=DEFAULT_CHUNK_SIZE, workers=4, retries=2, retry_delay=0.5):
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='quote-chunk')
+
+    def requests_for(self, n):
+        """获取 n 只股票行情消耗的请求数"""
+        return math.ceil(n / self.chunk_size) if n else 0
+
+    @traced('tushare')
+    def _fetch_chunk(self, chunk):
+        return normalize_quotes(ts.realtime_quote(ts_code=','.join(chunk)), REALTIME_QUOTE_COLUMNS)
+
+    def fetch(self, ts_codes):
+        """返回 {ts_code 索引: 行情列} 的 DataFrame，始终重试失败的分块而非整批"""
+        pending = [ts_codes[i:i + self.chunk_size] for i in range(0, len(ts_codes), self.chunk_size)]
+        frames = []
+        for attempt in range(self.retries + 1):
+            if not pending:
+                break
+            if attempt:
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
+            # 单个分块直接在当前线程请求
+            if len(pending) == 1:
+                jobs = [(pending[0], None)]
+            else:
+                jobs = [(chunk, routine_context.submit(self._executor, self._fetch_chunk, chunk)) for chunk in pending]
+            failed = []
+            for chunk, future in jobs:
+                try:
+                    frames.append(future.result() if future else self._fetch_chunk(chunk))
+                except Exception as e:
+                    logger.warning(f"Quote chunk ({len(chunk)} codes) failed (attempt {attempt + 1}): {e}")
+                    failed.append(chunk)
+            pending = failed
+        if pending:
+            logger.error(f"Realtime quotes unavailable for {sum(len(c) for c in pending)} codes after "
+                         f"{self.retries + 1} attempts.")
+        frames = [f for f in frames if not f.empty]
+        return pd.concat(frames) if frames else empty_frame()
+
+class MarketSnapshotProvider:
+    """全市场快照: 一次 ts.realtime_list 调用拿到所有 A 股行情，ttl 内的所有调用共享同一份快照
+
+    监控、盘中扫描与持仓估值同一轮询周期内只拉取一次全市场 (约 MARKET_SIZE / 每页只数 个 HTTP 请求)。
+    快照中缺失的代码 (停牌、新股等) 交给 fallback (默认分块接口) 补齐。
+    获取失败时最多沿用 max_age 秒内的上一份快照，超过后视为无快照 (全部代码走 fallback)，
+    不会把过时行情当作实时行情交给监控、tick 缓冲与分钟线。
+    """
+
+    VOLUME_UNIT = 100  # realtime_list 的成交量单位为手，统一换算为股
+    # realtime_list 按页顺序拉取全市场: dc 每页 200 只 (末尾再多一次空页请求结束翻页)，
+    # sina 每页 80 只 (开始前另有一次总数查询)；首次获取前按 MARKET_SIZE 估算页数
+    PAGE_SIZES = {'dc': 200, 'sina': 80}
+    MARKET_SIZE = 5500
+
+    def __init__(self, ttl=3, src='dc', retries=2, retry_delay=0.5, fallback=None, max_age=None):
+        self.ttl = ttl
+        self.max_age = max_age if max_age is not None else ttl * 3  # 失败时可沿用的旧快照最大年龄(秒)
+        self.src = src
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.fallback = fallback if fallback is not None else ChunkedQuoteProvider()
+        self._frame = None
+        self._fetched_at = None
+        self._lock = threading.Lock()
+        self.pages = self._pages_for(self.MARKET_SIZE)  # 最近一次全市场快照的 HTTP 请求数
+        self.fetches = 0  # 实际发起的 HTTP 请求次数 (按页计)
+
+    def _pages_for(self, rows):
+        return math.ceil(rows / self.PAGE_SIZES.get(self.src, 200)) + 1
+
+    def requests_for(self, n):
+        return self.pages if n else 0
+
+    @traced('tushare')
+    def _fetch_market(self):
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
+            try:
+                df = normalize_quotes(ts.realtime_list(src=self.src), REALTIME_LIST_COLUMNS)
+            except Exception as e:
+                logger.warning(f"Market snapshot failed (attempt {attempt + 1}): {e}")
+                continue
+            if df.empty:
+                continue
+            df['volume'] = df['volume'] * self.VOLUME_UNIT
+            # realtime_list 不带行情时间，以获取时刻为准
+            now = clock.now()
+            df['date'], df['time'] = now.strftime('%Y%m%d'), now.strftime('%H:%M:%S')
+            self.pages = self._pages_for(len(df))
+            self.fetches += self.pages
+            return df
+        return None
+
+    def snapshot(self, force=False):
+        """返回全市场快照 (ttl 内复用)；获取失败时返回 max_age 内的上一份快照，否则返回空表"""
+        with self._lock:
+            age = time.monotonic() - self._fetched_at if self._fetched_at is not None else None
+            if force or age is None or age >= self.ttl:
+                frame = self._fetch_market()
+                if frame is not None:
+                    self._frame, self._fetched_at = frame, time.monotonic()
+                    return frame
+                if age is not None and age < self.max_age:
+                    logger.warning(f"Market snapshot refresh failed, reusing snapshot from {age:.1f}s ago.")
+                else:
+                    if self._frame is not None:
+                        logger.warning(f"Market snapshot older than {self.max_age}s discarded.")
+                    self._frame, self._fetched_at = None, None
+            return self._frame if self._frame is not None else empty_frame()
+
+    def fetch(self, ts_codes):
+        frame = self.snapshot()
+        found = frame.index.intersection(ts_codes)
+        missing = [c for c in ts_codes if c not in found]
+        result = frame.loc[found]
+        if missing and self.fallback:
+            extra = self.fallback.fetch(missing)
+            if not extra.empty:
+                result = pd.concat([result, extra]) if not result.empty else extra
+        return result
+
+def build_provider(config=None):
+    """按 config.yaml 的 quotes 段创建行情提供者 (provider: chunked | market)"""
+    config = config or {}
+    chunked = ChunkedQuoteProvider(chunk_size=config.get('chunk_size', DEFAULT_CHUNK_SIZE),
+                                   workers=config.get('workers', 4),
+                                   retries=config.get('retries', 2))
+    if config.get('provider', 'chunked') == 'market':
+        return MarketSnapshotProvider(ttl=config.get('market_ttl', 3), src=config.get('market_src', 'dc'),
+                                      retries=config.get('retries', 2), fallback=chunked,
+                                      max_age=config.get('market_max_age'))
+    return chunked
@@ -0,0 +1,58 @@
+import time
+import logging
+import threading
+from core.tushare_client import extract_price
+
+class QuoteSnapshot:
+    """单次流程内共享的实时行情快照
+
+    流程开始时一次性批量拉取所有会用到的代码 (完整盘口字段)，之后所有读取走内存。
+    超过 max_age 的行情在读取时按需重新拉取；下单定价使用更严格的 order_max_age。
+    """
+
+    def __init__(self, ts_client, max_age=60, order_max_age=5):
+        self.ts_client = ts_client
+        self.max_age = max_age
+        self.order_max_age = order_max_age
+        self._quotes = {}       # ts_code -> quote dict
+        self._fetched_at = {}   # ts_code -> time.monotonic()
+        self._lock = threading.Lock()
+
+    def _is_fresh(self, ts_code, max_age):
+        fetched_at = self._fetched_at.get(ts_code)
+        return fetched_at is not None and time.monotonic() - fetched_at <= max_age
+
+    def fetch(self, ts_codes, max_age=None, force=False):
+        """批量拉取缺失或过期的代码，返回本次实际请求的数量"""
+        max_age = self.max_age if max_age is None else max_age
+        with self._lock:
+            pending = sorted({c for c in ts_codes if force or not self._is_fresh(c, max_age)})
+            if not pending:
+                return 0
+            quotes = self.ts_client.get_batch_realtime_quotes_full(pending)
+            now = time.monotonic()
+            for code in pending:
+                # 未返回的代码也记录时间，避免同一流程内反复请求
+                self._fetched_at[code] = now
+                if code in quotes:
+                    self._quotes[code] = quotes[code]
+        missing = len(pending) - len(quotes)
+        if missing > 0:
+            logging.warning(f"Quote snapshot: {missing}/{len(pending)} codes returned no quote.")
+        return len(pending)
+
+    def get(self, ts_code, max_age=None):
+        """获取完整行情 dict，过期时自动刷新，取不到返回 None"""
+        self.fetch([ts_code], max_age=max_age)
+        return self._quotes.get(ts_code)
+
+    def price(self, ts_code, fields=('price', 'close', 'trade'), max_age=None):
+        """按字段优先级取价格，取不到返回 0.0"""
+        return extract_price(self.get(ts_code, max_age=max_age), fields)
+
+    def price_for_order(self, ts_code):
+        """下单定价: 强制使用 order_max_age 内的行情，失败时降级到 get_latest_price"""
+        price = self.price(ts_code, max_age=self.order_max_age)
+        if price <= 0:
+            price = self.ts_client.get_latest_price(ts_code)
+        return price
@@ -0,0 +1,415 @@
+"""历史回放引擎: 用本地 StockDaily 驱动真实的早盘/午间/尾盘/监控流程
+
+用法 (在项目根目录):
+    python -m core.replay --start 20250101 --end 20251231
+
+- 模拟时钟按交易日推进到各流程的调度时间点
+- 实时行情由当日日线合成 (开盘 -> 高/低 -> 收盘 的确定性路径)
+- LLM 由确定性规则替身代替，交易在独立的临时数据库上执行
+- 当日日线在 17:10 数据同步时才写入，流程中不会读到未来数据
+"""
+import os
+import re
+import math
+import time
+import sqlite3
+import logging
+import argparse
+import tempfile
+import datetime
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+from core import clock, signals
+from core.db_models import db, init_db, SecurityMaster, Account, Order
+from core.tushare_client import TushareClient, DAILY_FIELDS
+from core.quote_provider import DEFAULT_CHUNK_SIZE, empty_frame
+from core.indicators import get_latest_indicators, IndicatorEngine
+from core.tick_buffer import tick_buffer
+from core.portfolio import PortfolioValuer
+from core.ledger import ledger
+
+def session_progress(t):
+    """交易时段进度 0~1 (午休期间停在 0.5)"""
+    minutes = t.hour * 60 + t.minute
+    if minutes < 9 * 60 + 30:
+        return 0.0
+    if minutes <= 11 * 60 + 30:
+        return (minutes - (9 * 60 + 30)) / 240
+    if minutes < 13 * 60:
+        return 0.5
+    return min(1.0, 0.5 + (minutes - 13 * 60) / 240)
+
+def synth_quote(bar, at):
+    """由日线合成某时刻的实时行情: 阳线走 开->低->高->收，阴线走 开->高->低->收"""
+    o, h, l, c = bar['open'], bar['high'], bar['low'], bar['close']
+    first, second = (l, h) if c >= o else (h, l)
+    xs, ys = [0.0, 0.3, 0.7, 1.0], [o, first, second, c]
+    f = session_progress(at.time())
+    price = round(float(np.interp(f, xs, ys)), 2)
+    seen = [y for x, y in zip(xs, ys) if x <= f] + [price]
+    return {
+        'ts_code': bar['ts_code'],
+        'date': at.strftime('%Y%m%d'),
+        'time': at.strftime('%H:%M:%S'),
+        'open': o,
+        'pre_close': bar['pre_close'],
+        'price': price,
+        'high': max(seen),
+        'low': min(seen),
+        'bid1': round(price - 0.01, 2),
+        'ask1': round(price + 0.01, 2),
+        'volume': bar['vol'] * 100 * f,     # 日线 vol 单位为手
+        'amount': bar['amount'] * 1000 * f, # 日线 amount 单位为千元
+    }
+
+class ReplaySource:
+    """只读访问源数据库中的日线 (按交易日缓存)"""
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(f'file:{path}?mode=ro', uri=True, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self._cache = {}
+
+    def trading_days(self, start, end):
+        rows = self.conn.execute(
+            'SELECT DISTINCT trade_date FROM stockdaily WHERE trade_date BETWEEN ? AND ? ORDER BY trade_date',
+            (start, end)).fetchall()
+        return [r[0] for r in rows]
+
+    def bars(self, trade_date):
+        """{ts_code: bar dict}，只缓存最近用到的两个交易日"""
+        if trade_date not in self._cache:
+            rows = self.conn.execute('SELECT * FROM stockdaily WHERE trade_date = ?', (trade_date,)).fetchall()
+            if len(self._cache) >= 2:
+                self._cache.pop(next(iter(self._cache)))
+            self._cache[trade_date] = {r['ts_code']: dict(r) for r in rows}
+        return self._cache[trade_date]
+
+class ReplayQuoteProvider:
+    """行情提供者的回放替身: 由源库当日日线合成指定代码的行情"""
+
+    def __init__(self, source):
+        self.source = source
+
+    def requests_for(self, n):
+        return math.ceil(n / DEFAULT_CHUNK_SIZE) if n else 0
+
+    def fetch(self, ts_codes):
+        now = clock.now()
+        bars = self.source.bars(now.strftime('%Y%m%d'))
+        rows = [synth_quote(bars[c], now) for c in ts_codes if c in bars]
+        if not rows:
+            return empty_frame()
+        # synth_quote 已是统一列名
+        return pd.DataFrame.from_records(rows, index='ts_code')
+
+class ReplayMarketData(TushareClient):
+    """TushareClient 的回放替身: 行情来自源库日线合成，不发起任何网络请求"""
+
+    def __init__(self, source, trading_days):
+        self.pro = None
+        self._last_trade_date_cache = None
+        self.source = source
+        self.trading_days = trading_days
+        # 行情经统一的 quote_provider 获取，与实盘走同一套批量/监听路径
+        self.quote_provider = ReplayQuoteProvider(source)
+
+    # --- 数据同步 (由回放引擎负责写入日线) ---
+    def get_trade_cal(self, start_date, end_date):
+        return [d for d in self.trading_days if start_date <= d <= end_date]
+
+    def fetch_daily(self, ts_code, start_date, end_date):
+        return None
+
+    def fetch_daily_by_date(self, trade_date):
+        return None
+
+    def fetch_daily_basic_by_date(self, trade_date):
+        return None
+
+    def sync_market_daily(self, backfill_days=90, include_daily_basic=True):
+        return 0
+
+    def refresh_security_master(self, force=False):
+        return 0
+
+    def get_security(self, ts_code):
+        info = self._load_security_cache().get(ts_code)
+        return info or {'ts_code': ts_code, 'name': None, 'industry': None}
+
+class ReplayScanner:
+    """自动挖掘替身: 基于上一交易日日线的同一套筛选思路 (涨幅 3%~9.5%，按成交额排序)"""
+
+    def __init__(self, source, trading_days):
+        self.source = source
+        self.trading_days = trading_days
+
+    def scan_hot_stocks(self, limit=5):
+        today = clock.now().strftime('%Y%m%d')
+        previous = [d for d in self.trading_days if d < today]
+        if not previous:
+            return []
+        bars = self.source.bars(previous[-1]).values()
+        hot = sorted((b for b in bars if 3 < b['pct_chg'] < 9.5), key=lambda b: (-b['amount'], b['ts_code']))
+        return [b['ts_code'] for b in hot[:limit]]
+
+class ReplayNewsClient:
+    def get_stock_news(self, ts_code, limit=5):
+        return "No recent news found."
+
+class NullNotifier:
+    """通知替身: 只计数不发送"""
+    def __init__(self):
+        self.sent = 0
+
+    def send_text(self, msg, **kwargs):
+        self.sent += 1
+
+    def send_markdown(self, title, text, **kwargs):
+        self.sent += 1
+
+_TS_CODE_RE = re.compile(r'''["']ts_code["']:\s*["']([^"']+)["']''')
+_BATCH_BLOCK_RE = re.compile(r'^### (\d{6}\.(?:SH|SZ|BJ))$', re.M)  # 合并分析模板中每只股票的段落标题
+_REPORT_ROW_RE = re.compile(r'^(\d{6}\.(?:SH|SZ|BJ))\|', re.M)  # 紧凑报告表格的行首代码
+
+def _search_float(pattern, text, default=0.0):
+    m = re.search(pattern, text)
+    return float(m.group(1)) if m else default
+
+class RuleBasedLLM:
+    """确定性 LLM 替身: 按模板类型用简单技术规则生成符合 Schema 的 JSON"""
+
+    def __call__(self, prompt, json_mode=False, template_name=None):
+        handler = {
+            'analysis_pre_market.j2': self.pre_market,
+            'analysis_intra_day.j2': self.position_review,
+            'analysis_pre_close.j2': self.position_review,
+            'analysis_intra_day_batch.j2': self.position_review_batch,
+            'analysis_pre_close_batch.j2': self.position_review_batch,
+            'analysis_trigger.j2': self.trigger,
+            'decision_maker.j2': self.decision,
+        }.get(template_name)
+        return handler(prompt) if handler else None
+
+    def pre_market(self, prompt):
+        ts_code = _TS_CODE_RE.search(prompt).group(1)
+        ind = get_latest_indicators(ts_code) or {}
+        values = [ind.get(k) for k in ('close', 'ma5', 'ma10', 'ma20', 'ma60', 'rsi14', 'atr14', 'high20')]
+        report = {'ts_code': ts_code, 'action': 'WAIT', 'confidence': 4.0, 'reason': 'No setup',
+                  'monitor_setup': {'trigger_price': 0}}
+        if any(v is None for v in values):
+            return report
+
+        close, ma5, ma10, ma20, ma60, rsi, atr, high20 = values
+        if ma5 > ma10 > ma20 and 45 <= rsi <= 70:
+            report.update(action='BUY', confidence=8.0, reason='MA bullish alignment')
+            report['monitor_setup'] = {'trigger_price': round(close - 2 * atr, 2), 'operator': 'lt',
+                                       'monitor_type': 'stop_loss', 'reason': '2 ATR stop'}
+        elif ma20 > ma60:
+            report['monitor_setup'] = {'trigger_price': round(high20 * 1.01, 2), 'operator': 'gt',
+                                       'monitor_type': 'buy_signal', 'reason': '20D breakout'}
+        return report
+
+    def position_review(self, prompt):
+        return self._review(_TS_CODE_RE.search(prompt).group(1), prompt)
+
+    def position_review_batch(self, prompt):
+        # 每只股票一段，以 "### <ts_code>" 开头
+        blocks = _BATCH_BLOCK_RE.split(prompt.split('**Output Format')[0])[1:]
+        return {'reports': [self._review(code, text) for code, text in zip(blocks[::2], blocks[1::2])]}
+
+    def _review(self, ts_code, prompt):
+        pnl = _search_float(r'Unrealized PnL: (-?[\d.]+)%', prompt, default=None)
+        action = 'HOLD'
+        if pnl is not None:
+            if pnl <= -5:
+                action = 'SELL_ALL'
+            elif pnl >= 8:
+                action = 'SELL_HALF'
+        return {'ts_code': ts_code, 'action': action, 'confidence': 8.0, 'reason': f'PnL rule ({pnl})'}
+
+    def trigger(self, prompt):
+        ts_code = _TS_CODE_RE.search(prompt).group(1)
+        monitor_type = re.search(r'Monitor Type: (\w+)', prompt).group(1)
+        price = _search_float(r'Current Price: ([\d.]+)', prompt)
+        action = {'buy_signal': 'BUY', 'stop_loss': 'SELL', 'take_profit': 'SELL'}.get(monitor_type, 'HOLD')
+        return {'ts_code': ts_code, 'action': action, 'confidence': 8.0, 'price_limit': price,
+                'reason': f'{monitor_type} hit'}
+
+    def decision(self, prompt):
+        # 只取报告表格中的代码 (持仓行与输出格式示例中的 ts_code 不计入)
+        reports = prompt.split('**Analyst Reports')[-1].split('**Instructions:**')[0]
+        codes = list(dict.fromkeys(_REPORT_ROW_RE.findall(reports)))[:5]
+        if not codes:
+            return {'orders': []}
+        cash = _search_float(r'Available Cash: ([\d.]+)', prompt)
+        max_single = _search_float(r'Single Stock Max Limit: ([\d.]+)', prompt)
+        budget = round(min(cash / len(codes), max_single), 2)
+        return {'orders': [{'ts_code': c, 'budget': budget, 'reason': 'Equal weight'} for c in codes]}
+
+class ReplayEngine:
+    """按交易日驱动 main.py 中的真实流程"""
+
+    DEFAULT_MONITOR_TIMES = ['09:45', '10:15', '10:45', '11:15', '13:15', '13:45', '14:15', '14:45']
+
+    def __init__(self, start, end, source_db='data/strategy.db', work_db=None,
+                 monitor_times=None, llm_backend=None, verbose=False):
+        self.start = start
+        self.end = end
+        self.source_db = os.path.abspath(source_db)
+        self.work_db = work_db or os.path.join(tempfile.mkdtemp(prefix='replay-'), 'replay.db')
+        self.monitor_times = monitor_times or self.DEFAULT_MONITOR_TIMES
+        self.llm_backend = llm_backend or RuleBasedLLM()
+        self.verbose = verbose
+        self.sim_clock = clock.SimulatedClock()
+        self.equity_curve = []
+
+    def _at(self, trade_date, hhmm):
+        return datetime.datetime.strptime(f'{trade_date} {hhmm}', '%Y%m%d %H:%M')
+
+    def _attach_source(self):
+        attached = [row[1] for row in db.execute_sql('PRAGMA database_list').fetchall()]
+        if 'src' not in attached:
+            db.execute_sql('ATTACH DATABASE ? AS src', (self.source_db,))
+
+    def _copy_bars(self, condition, params):
+        self._attach_source()
+        columns = ','.join(f'"{c}"' for c in DAILY_FIELDS)
+        db.execute_sql(
+            f'INSERT OR REPLACE INTO stockdaily ({columns}) SELECT {columns} FROM src.stockdaily WHERE {condition}',
+            params)
+
+    def _prepare_database(self, agent_main):
+        """在独立数据库上建表，并复制回放起点之前的历史 (跨进程信号也改到回放目录)"""
+        signals.set_signal_dir(os.path.join(os.path.dirname(os.path.abspath(self.work_db)), 'signals'))
+        db.init(self.work_db, pragmas={'journal_mode': 'wal'})
+        init_db(agent_main.CONFIG)
+        ledger.invalidate()
+        self._copy_bars('trade_date < ?', (self.start,))
+        self._attach_source()
+        src_tables = [r[0] for r in db.execute_sql("SELECT name FROM src.sqlite_master WHERE type='table'").fetchall()]
+        if 'securitymaster' in src_tables:
+            db.execute_sql('INSERT OR REPLACE INTO securitymaster SELECT * FROM src.securitymaster')
+        TushareClient._security_cache = None
+
+    def _install(self, agent_main, source, trading_days):
+        """把 main.py 的外部依赖替换为回放替身"""
+        from agents.base import BaseAgent
+        from core.llm_cache import llm_cache
+
+        market_data = ReplayMarketData(source, trading_days)
+        notifier = NullNotifier()
+        agent_main.ts_client = market_data
+        agent_main.portfolio.ts_client = market_data
+        agent_main.scanner = ReplayScanner(source, trading_days)
+        agent_main.news_client = ReplayNewsClient()
+        agent_main.notifier = notifier
+        agent_main.monitor_service.ts_client = market_data
+        agent_main.monitor_service.notifier = notifier
+        BaseAgent.llm_backend = self.llm_backend
+        llm_cache.enabled = False
+        clock.set_clock(self.sim_clock)
+        return notifier
+
+    def _mark_equity(self, source, trade_date):
+        """按当日收盘价给持仓估值 (无日线的沿用最近估值)，记录权益曲线"""
+        bars = source.bars(trade_date)
+        held = ledger.snapshot().holdings()
+        result = PortfolioValuer().apply({code: bars[code]['close'] for code in held if code in bars})
+        equity = result['total_assets']
+        self.equity_curve.append((trade_date, equity))
+        return equity
+
+    def run(self):
+        load_dotenv()
+        # main.py 在导入时创建 Tushare 客户端，需要 Token 存在 (回放期间不会发起请求)
+        os.environ.setdefault('TUSHARE_TOKEN', 'replay-offline')
+        os.makedirs('logs', exist_ok=True)
+        import main as agent_main
+        if not self.verbose:
+            # main.py 导入时配置了 INFO 日志，回放默认只保留告警以上
+            logging.getLogger().setLevel(logging.WARNING)
+
+        source = ReplaySource(self.source_db)
+        trading_days = source.trading_days(self.start, self.end)
+        if not trading_days:
+            logging.error(f"No StockDaily data between {self.start} and {self.end} in {self.source_db}")
+            return None
+
+        self._prepare_database(agent_main)
+        notifier = self._install(agent_main, source, trading_days)
+        IndicatorEngine().update(sorted(agent_main.CONFIG.get('watchlist', [])))
+        initial_equity = Account.select().first().total_assets
+
+        started = time.perf_counter()
+        try:
+            for trade_date in trading_days:
+                self.sim_clock.set(self._at(trade_date, agent_main.CONFIG['schedule']['morning_routine']))
+                agent_main.run_pre_market_routine()
+
+                schedule = [(t, None) for t in self.monitor_times] + [
+                    (agent_main.CONFIG['schedule']['midday_routine'], agent_main.run_midday_routine),
+                    (agent_main.CONFIG['schedule']['afternoon_routine'], agent_main.run_pre_close_routine),
+                ]
+                for hhmm, routine in sorted(schedule, key=lambda item: item[0]):
+                    self.sim_clock.set(self._at(trade_date, hhmm))
+                    if routine:
+                        routine()
+                    else:
+                        agent_main.monitor_service.run_check()
+                        agent_main.monitor_service.drain()
+                agent_main.monitor_service.poller.close_session()
+                tick_buffer.end_session(clear=True)
+
+                # 盘后: 写入当日日线后执行数据同步流程 (指标等)
+                self.sim_clock.set(self._at(trade_date, agent_main.CONFIG['schedule']['data_sync']))
+                self._copy_bars('trade_date = ?', (trade_date,))
+                agent_main.run_data_sync_routine()
+                self._mark_equity(source, trade_date)
+        finally:
+            clock.reset_clock()
+            signals.reset_signal_dir()
+        elapsed = time.perf_counter() - started
+
+        return self.report(initial_equity, elapsed, notifier, agent_main.monitor_service.poller.sessions)
+
+    def report(self, initial_equity, elapsed, notifier, monitor_sessions):
+        equities = np.array([e for _, e in self.equity_curve])
+        peaks = np.maximum.accumulate(equities)
+        max_drawdown = float(np.max((peaks - equities) / peaks)) * 100 if len(equities) else 0.0
+        buys = Order.select().where(Order.action == 'BUY').count()
+        sells = Order.select().where(Order.action == 'SELL').count()
+        final_equity = float(equities[-1]) if len(equities) else initial_equity
+        return {
+            'days': len(self.equity_curve),
+            'elapsed_sec': round(elapsed, 2),
+            'days_per_sec': round(len(self.equity_curve) / elapsed, 3) if elapsed else 0.0,
+            'initial_equity': round(initial_equity, 2),
+            'final_equity': round(final_equity, 2),
+            'return_pct': round((final_equity / initial_equity - 1) * 100, 2) if initial_equity else 0.0,
+            'max_drawdown_pct': round(max_drawdown, 2),
+            'buy_orders': buys,
+            'sell_orders': sells,
+            'monitor_quote_requests': sum(s['requests'] for s in monitor_sessions),
+            'notifications': notifier.sent,
+            'work_db': self.work_db,
+        }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Historical replay of the strategy routines")
+    parser.add_argument('--start', required=True, help='起始交易日 YYYYMMDD')
+    parser.add_argument('--end', required=True, help='结束交易日 YYYYMMDD')
+    parser.add_argument('--source', default='data/strategy.db', help='提供 StockDaily 的源数据库')
+    parser.add_argument('--work-db', default=None, help='回放使用的独立数据库 (默认临时目录)')
+    parser.add_argument('--verbose', action='store_true', help='输出流程内的 INFO 日志')
+    args = parser.parse_args()
+
+    engine = ReplayEngine(args.start, args.end, source_db=args.source, work_db=args.work_db,
+                          verbose=args.verbose)
+    result = engine.run()
+    if result:
+        print("Replay finished:")
+        for key, value in result.items():
+            print(f"  {key}: {value}")
@@ -0,0 +1,79 @@
+"""当前流程 (routine) 的上下文: 按流程汇总 Prompt token 统计
+
+流程入口用 routine(name) / track(name) 建立上下文，期间渲染的 Prompt 都计入该流程。
+contextvars 不会自动传入线程池，向线程池提交任务时需用 submit() 复制上下文；
+asyncio.run / gather 创建的任务会自动复制当前上下文。
+"""
+import logging
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+from core.tracing import tracer
+
+_current = contextvars.ContextVar('routine', default=None)
+
+class RoutineStats:
+    """单次流程的 Prompt 统计 (可被多个线程同时记录)"""
+
+    def __init__(self, name):
+        self.name = name
+        self.prompts = 0
+        self.tokens_before = 0  # 裁剪前
+        self.tokens_after = 0   # 实际发送
+        self.truncated = 0
+        self.templates = {}     # template_name -> [prompts, tokens_before, tokens_after]
+        self._lock = threading.Lock()
+
+    def record(self, template_name, before, after, truncated=False):
+        with self._lock:
+            self.prompts += 1
+            self.tokens_before += before
+            self.tokens_after += after
+            self.truncated += int(truncated)
+            entry = self.templates.setdefault(template_name, [0, 0, 0])
+            entry[0] += 1
+            entry[1] += before
+            entry[2] += after
+
+    def summary(self):
+        per_template = ', '.join(f"{name} x{n} {before}->{after}"
+                                 for name, (n, before, after) in sorted(self.templates.items()))
+        return (f"Routine {self.name}: {self.prompts} prompts, tokens {self.tokens_before} -> {self.tokens_after} "
+                f"({self.truncated} truncated) [{per_template}]")
+
+def current():
+    return _current.get()
+
+def record_prompt(template_name, before, after, truncated=False):
+    """把一次 Prompt 渲染计入当前流程 (不在流程内时忽略)"""
+    stats = _current.get()
+    if stats is not None:
+        stats.record(template_name, before, after, truncated)
+
+@contextmanager
+def routine(name):
+    stats = RoutineStats(name)
+    token = _current.set(stats)
+    try:
+        with tracer.routine(name):
+            yield stats
+    finally:
+        _current.reset(token)
+        if stats.prompts:
+            logging.info(stats.summary())
+
+def track(name):
+    """流程函数装饰器"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with routine(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def submit(executor, fn, *args, **kwargs):
+    """向线程池提交任务并携带当前上下文 (剖析模式下任务计入所属流程的 CPU 剖析)"""
+    ctx = contextvars.copy_context()
+    return executor.submit(ctx.run, tracer.profiled(fn), *args, **kwargs)
@@ -3,6 +3,7 @@ import logging
 import tushare as ts
 import os
 from dotenv import load_dotenv
+from core import clock
 
 load_dotenv()
 
@@ -17,7 +18,7 @@ class MarketScanner:
         """扫描热门潜力股 (简化版逻辑)"""
         # 获取上一交易日（因开盘前数据未出，需看昨日表现）
         # 实际逻辑应获取最近一个有数据的交易日
-        today = datetime.datetime.now().strftime('%Y%m%d')
+        today = clock.now().strftime('%Y%m%d')
         # 简单回推几天寻找最近交易日（Tushare API 如果当天没数据返回空）
         trade_date = self._get_last_trade_date()
         
@@ -55,7 +56,7 @@ class MarketScanner:
     def _get_last_trade_date(self):
         # 简单逻辑：如果是周一早上，取上周五。这里不做复杂日历计算，
         # 如果获取不到数据 Tushare 会报错或空，实际可以用 trade_cal 优化
-        now = datetime.datetime.now()
+        now = clock.now()
         if now.hour < 15: # 如果是盘中或盘前，取昨天
              delta = 1
         else:
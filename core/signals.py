@@ -0,0 +1,53 @@
+"""基于文件 mtime 的轻量跨进程信号
+
+主流程与监控进程通过数据库共享状态；数据变化后 notify 一个命名信号 (更新标记文件的
+修改时间)，对端用 SignalWatcher 低成本轮询 mtime 即可立即感知，无需额外的消息中间件。
+"""
+import os
+import time
+
+DEFAULT_SIGNAL_DIR = 'data/signals'
+SIGNAL_DIR = DEFAULT_SIGNAL_DIR
+
+MONITORS_CHANGED = 'monitors_changed'
+
+def _path(name):
+    return os.path.join(SIGNAL_DIR, name)
+
+def set_signal_dir(path):
+    """切换信号目录 (回放使用独立目录，避免惊动同机运行的实盘进程)"""
+    global SIGNAL_DIR
+    SIGNAL_DIR = path
+
+def reset_signal_dir():
+    set_signal_dir(DEFAULT_SIGNAL_DIR)
+
+def notify(name):
+    """发出信号 (线程/进程安全，重复调用只会刷新时间戳)"""
+    os.makedirs(SIGNAL_DIR, exist_ok=True)
+    path = _path(name)
+    with open(path, 'a'):
+        pass
+    now_ns = time.time_ns()
+    os.utime(path, ns=(now_ns, now_ns))
+
+class SignalWatcher:
+    """轮询某个信号是否在上次检查之后被触发"""
+
+    def __init__(self, name):
+        self.name = name
+        self._last = self._mtime()
+
+    def _mtime(self):
+        # 每次按当前信号目录解析路径，切换目录后已创建的 watcher 随之生效
+        try:
+            return os.stat(_path(self.name)).st_mtime_ns
+        except FileNotFoundError:
+            return 0
+
+    def changed(self):
+        mtime = self._mtime()
+        if mtime != self._last:
+            self._last = mtime
+            return True
+        return False
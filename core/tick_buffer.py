@@ -0,0 +1,155 @@
+import logging
+import datetime
+import threading
+import numpy as np
+import pandas as pd
+from core.db_models import IntradayTick, bulk_upsert_frame
+from core.tushare_client import quote_datetime
+
+TICK_DTYPE = np.dtype([('ts', 'f8'), ('price', 'f8'), ('volume', 'f8'), ('bid1', 'f8'), ('ask1', 'f8')])
+
+def _quote_float(quote, key):
+    try:
+        value = float(quote.get(key))
+    except (TypeError, ValueError):
+        return np.nan
+    return value if np.isfinite(value) else np.nan
+
+class TickRingBuffer:
+    """盘中行情的定长环形缓冲 (每只股票固定 capacity 条，按结构化 numpy 数组存储)
+
+    由实时行情监听自动写入，相同时间戳的重复采样会被忽略。
+    时段结束时可把尚未落库的部分写入 IntradayTick。
+    """
+
+    def __init__(self, capacity=240, prompt_ticks=10, spill_enabled=True):
+        self.capacity = capacity
+        self.prompt_ticks = prompt_ticks    # trigger prompt 中展示的 tick 数
+        self.spill_enabled = spill_enabled  # 时段结束时是否落库
+        self._rings = {}    # ts_code -> ndarray(capacity, TICK_DTYPE)
+        self._count = {}    # ts_code -> 累计写入条数
+        self._spilled = {}  # ts_code -> 已落库的累计条数
+        self._lock = threading.Lock()
+
+    def configure(self, config=None):
+        """按 config.yaml 的 ticks 段调整 (会清空已缓冲的数据)"""
+        config = config or {}
+        with self._lock:
+            self.capacity = config.get('capacity', self.capacity)
+            self.prompt_ticks = config.get('prompt_ticks', self.prompt_ticks)
+            self.spill_enabled = config.get('spill', self.spill_enabled)
+            self._rings.clear()
+            self._count.clear()
+            self._spilled.clear()
+
+    def record_quotes(self, quotes):
+        """行情监听回调: {ts_code: quote dict}"""
+        with self._lock:
+            for ts_code, quote in quotes.items():
+                price = _quote_float(quote, 'price')
+                if not price > 0:
+                    continue
+                ts = quote_datetime(quote).timestamp()
+                ring = self._rings.get(ts_code)
+                if ring is None:
+                    ring = self._rings[ts_code] = np.zeros(self.capacity, dtype=TICK_DTYPE)
+                    self._count[ts_code] = 0
+                    self._spilled[ts_code] = 0
+                count = self._count[ts_code]
+                if count and ring[(count - 1) % self.capacity]['ts'] >= ts:
+                    continue
+                ring[count % self.capacity] = (ts, price, _quote_float(quote, 'volume'),
+                                               _quote_float(quote, 'bid1'), _quote_float(quote, 'ask1'))
+                self._count[ts_code] = count + 1
+
+    def _tail(self, ts_code, n):
+        """最近 n 条 (按时间升序)，调用方需持有锁"""
+        ring = self._rings.get(ts_code)
+        if ring is None:
+            return np.zeros(0, dtype=TICK_DTYPE)
+        count = self._count[ts_code]
+        n = min(n, count, self.capacity)
+        idx = np.arange(count - n, count) % self.capacity
+        return ring[idx].copy()
+
+    def last(self, ts_code, n=10):
+        with self._lock:
+            return self._tail(ts_code, n)
+
+    def micro_trend(self, ticks):
+        """由最近 tick 推导的微观趋势摘要 (dict)"""
+        prices = ticks['price']
+        minutes = (ticks['ts'][-1] - ticks['ts'][0]) / 60
+        change_pct = (prices[-1] / prices[0] - 1) * 100
+        slope_pct = np.polyfit(np.arange(len(prices)), prices, 1)[0] / prices[0] * 100 if len(prices) > 2 else change_pct
+        direction = 'UP' if change_pct > 0.1 else 'DOWN' if change_pct < -0.1 else 'FLAT'
+        volume = ticks['volume']
+        return {
+            'direction': direction,
+            'change_pct': round(change_pct, 2),
+            'minutes': round(minutes, 1),
+            'slope_pct_per_tick': round(slope_pct, 3),
+            'high': round(float(prices.max()), 2),
+            'low': round(float(prices.min()), 2),
+            'volume_delta': float(np.nan_to_num(volume[-1] - volume[0])),
+            'spread': round(float(np.nan_to_num(ticks['ask1'][-1] - ticks['bid1'][-1])), 3),
+        }
+
+    def format_history(self, ts_code, n=None):
+        """trigger prompt 用的最近 n 条 tick 与微观趋势文本，无数据返回 N/A"""
+        ticks = self.last(ts_code, n or self.prompt_ticks)
+        if len(ticks) < 2:
+            return "N/A"
+        lines = [f"Last {len(ticks)} ticks (time, price, volume change, bid1/ask1):"]
+        prev_volume = ticks['volume'][0]
+        for tick in ticks:
+            volume_delta = np.nan_to_num(tick['volume'] - prev_volume)
+            prev_volume = tick['volume']
+            t = datetime.datetime.fromtimestamp(tick['ts']).strftime('%H:%M:%S')
+            lines.append(f"- {t} {tick['price']:.2f} {volume_delta:+,.0f} {tick['bid1']:.2f}/{tick['ask1']:.2f}")
+        trend = self.micro_trend(ticks)
+        lines.append(f"Micro-trend: {trend['direction']} {trend['change_pct']:+.2f}% over {trend['minutes']}min "
+                     f"(slope {trend['slope_pct_per_tick']:+.3f}%/tick), range {trend['low']}-{trend['high']}, "
+                     f"volume {trend['volume_delta']:+,.0f}, spread {trend['spread']}")
+        return "\n".join(lines)
+
+    def spill(self):
+        """把尚未落库的 tick 写入 IntradayTick (超出容量被覆盖的部分无法找回)，返回写入行数"""
+        frames = []
+        with self._lock:
+            for ts_code, count in self._count.items():
+                pending = count - self._spilled[ts_code]
+                if pending <= 0:
+                    continue
+                ticks = self._tail(ts_code, pending)
+                frame = pd.DataFrame(ticks)
+                frame.insert(0, 'ts_code', ts_code)
+                frames.append(frame)
+                self._spilled[ts_code] = count
+        if not frames:
+            return 0
+
+        df = pd.concat(frames, ignore_index=True)
+        # 与 DateTimeField 一致的本地时间文本；NaN 由 SQLite 存为 NULL
+        df['ts'] = [datetime.datetime.fromtimestamp(t).strftime('%Y-%m-%d %H:%M:%S') for t in df['ts']]
+        written = bulk_upsert_frame(IntradayTick, df, ['ts_code', 'ts', 'price', 'volume', 'bid1', 'ask1'],
+                                    ['ts_code', 'ts'])
+        logging.info(f"Spilled {written} intraday ticks for {len(frames)} codes.")
+        return written
+
+    def end_session(self, clear=False):
+        """时段结束: 按配置落库，收盘后 clear=True 清空 (次日不混入隔夜数据)"""
+        written = 0
+        if self.spill_enabled:
+            try:
+                written = self.spill()
+            except Exception as e:
+                logging.error(f"Failed to spill intraday ticks: {e}")
+        if clear:
+            with self._lock:
+                self._rings.clear()
+                self._count.clear()
+                self._spilled.clear()
+        return written
+
+tick_buffer = TickRingBuffer()
@@ -0,0 +1,258 @@
+"""轻量级分段计时 (span) 与性能剖析
+
+- tracer.span(name, cat) 记录一段耗时；category 用于按来源汇总 (tushare / akshare / sqlite / jinja / llm / dingtalk / trade ...)
+- @traced(cat) 装饰函数 (支持 async)；未开启时只多一次属性判断，开销可忽略
+- tracer.routine(name) 由 routine_context.routine 调用：流程结束时输出
+  Chrome trace JSON (chrome://tracing 或 Perfetto 打开)、折叠栈 (flamegraph.pl / speedscope 可读)，
+  并在日志中打印各类别的自耗时汇总；开启 cpu 时另存该流程的 cProfile 结果 (.prof)
+- span 的父子关系经 contextvars 传递，线程池任务需经 routine_context.submit 提交才能归入所属流程
+"""
+import os
+import json
+import time
+import pstats
+import asyncio
+import logging
+import cProfile
+import datetime
+import itertools
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+
+_routine = contextvars.ContextVar('trace_routine', default=None)
+_parent = contextvars.ContextVar('trace_span', default=None)
+
+def _tid():
+    """线程 id；在 asyncio 任务内以任务区分，避免并发协程的 span 在时间线上交叠"""
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    if task is not None:
+        return id(task), f"{threading.current_thread().name}/{task.get_name()}"
+    thread = threading.current_thread()
+    return thread.ident, thread.name
+
+class RoutineTrace:
+    """单次流程内收集的 span 与 CPU 剖析结果"""
+
+    def __init__(self, name):
+        self.name = name
+        self.started_at = datetime.datetime.now()
+        self.events = []    # Chrome trace 事件
+        self.folded = {}    # 折叠栈 -> 自耗时(微秒)
+        self.threads = {}   # tid -> 线程/任务名
+        self.stats = None   # pstats.Stats
+        self.lock = threading.Lock()
+
+    def add_profile(self, profile):
+        with self.lock:
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NOOP = _NoopSpan()
+
+class _Span:
+    __slots__ = ('tracer', 'name', 'cat', 'args', 'start', 'child_ns', 'tid', 'stack', 'parent', 'token')
+
+    def __init__(self, tracer, name, cat, args):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        self.parent = _parent.get()
+        self.tid, thread_name = _tid()
+        self.stack = f"{self.parent.stack};{self.name}" if self.parent else self.name
+        self.child_ns = 0
+        self.token = _parent.set(self)
+        trace = _routine.get() or self.tracer.background
+        trace.threads.setdefault(self.tid, thread_name)
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter_ns()
+        _parent.reset(self.token)
+        duration = end - self.start
+        # 只有同一线程/任务内的子 span 才从父 span 的自耗时中扣除 (跨线程的是并行时间)
+        if self.parent is not None and self.parent.tid == self.tid:
+            self.parent.child_ns += duration
+        self_us = max(0, duration - self.child_ns) // 1000
+        args = dict(self.args, self_ms=round(self_us / 1000, 3))
+        if exc_type is not None:
+            args['error'] = exc_type.__name__
+        trace = _routine.get() or self.tracer.background
+        trace.events.append({'name': self.name, 'cat': self.cat, 'ph': 'X', 'pid': os.getpid(), 'tid': self.tid,
+                             'ts': (self.start - self.tracer.epoch) // 1000, 'dur': duration // 1000, 'args': args})
+        with trace.lock:
+            trace.folded[self.stack] = trace.folded.get(self.stack, 0) + self_us
+        return False
+
+class Tracer:
+    def __init__(self):
+        self.enabled = False
+        self.cpu = False                   # 同时采集 cProfile
+        self.output_dir = 'logs/profile'
+        self.top = 15                      # 日志中汇总的条目数
+        self.epoch = time.perf_counter_ns()
+        self.background = RoutineTrace('background')  # 不属于任何流程的 span (如通知投递线程)
+        self._profiling = threading.local()
+        self._seq = itertools.count(1)  # 同一秒内结束的流程 (如多个 trigger) 不互相覆盖
+
+    def configure(self, config=None, enabled=True, cpu=False):
+        """开启追踪；config 为 config.yaml 的 profiling 段"""
+        config = config or {}
+        self.output_dir = config.get('output_dir', self.output_dir)
+        self.top = config.get('top', self.top)
+        self.cpu = cpu
+        self.enabled = enabled
+
+    def span(self, name, cat='app', **args):
+        if not self.enabled:
+            return _NOOP
+        return _Span(self, name, cat, args)
+
+    def install_sqlite(self, database):
+        """为 peewee 数据库的每条 SQL 记录 span (仅在开启时调用，未开启时不做任何包装)"""
+        execute_sql = database.execute_sql
+
+        @functools.wraps(execute_sql)
+        def traced_execute_sql(sql, *args, **kwargs):
+            with self.span(sql.split(None, 1)[0].upper() if sql else 'SQL', 'sqlite', sql=sql[:200]):
+                return execute_sql(sql, *args, **kwargs)
+
+        database.execute_sql = traced_execute_sql
+
+    # ---- CPU 剖析 ----
+    def profiled(self, func):
+        """在当前流程的 cProfile 下运行 func (线程池任务用)；未开启 cpu 时原样返回"""
+        if not (self.enabled and self.cpu):
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self._profile():
+                return func(*args, **kwargs)
+        return wrapper
+
+    @contextmanager
+    def _profile(self):
+        trace = _routine.get()
+        # 同一线程只能有一个活动的 profiler，嵌套时由外层统计
+        if trace is None or getattr(self._profiling, 'active', False):
+            yield
+            return
+        profile = cProfile.Profile()
+        self._profiling.active = True
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self._profiling.active = False
+            trace.add_profile(profile)
+
+    # ---- 流程 ----
+    @contextmanager
+    def routine(self, name):
+        if not self.enabled:
+            yield
+            return
+        trace = RoutineTrace(name)
+        token = _routine.set(trace)
+        try:
+            with self.span(name, 'routine'):
+                if self.cpu:
+                    with self._profile():
+                        yield
+                else:
+                    yield
+        finally:
+            _routine.reset(token)
+            self._dump(trace)
+
+    def close(self):
+        """输出未归属流程的 span (进程退出前调用)"""
+        if self.enabled and self.background.events:
+            trace, self.background = self.background, RoutineTrace('background')
+            self._dump(trace)
+
+    # ---- 输出 ----
+    def summary(self, trace):
+        """按类别与 span 汇总自耗时 (毫秒)"""
+        by_cat, by_name = {}, {}
+        for event in trace.events:
+            self_ms = event['args']['self_ms']
+            cat = by_cat.setdefault(event['cat'], [0, 0.0])
+            cat[0] += 1
+            cat[1] += self_ms
+            entry = by_name.setdefault((event['cat'], event['name']), [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += self_ms
+            entry[2] += event['dur'] / 1000
+        wall = max((e['dur'] for e in trace.events if e['cat'] == 'routine'), default=0) / 1000
+        lines = [f"Trace {trace.name}: wall {wall:.1f}ms, {len(trace.events)} spans"]
+        for cat, (n, self_ms) in sorted(by_cat.items(), key=lambda kv: -kv[1][1]):
+            lines.append(f"  {cat:<10} x{n:<5} self {self_ms:10.1f}ms")
+        lines.append("  top spans (self / total ms):")
+        for (cat, name), (n, self_ms, total_ms) in sorted(by_name.items(), key=lambda kv: -kv[1][1])[:self.top]:
+            lines.append(f"    [{cat}] {name} x{n}: {self_ms:.1f} / {total_ms:.1f}")
+        return '\n'.join(lines)
+
+    def _dump(self, trace):
+        if not trace.events:
+            return
+        try:
+            os.makedirs(self.output_dir, exist_ok=True)
+            base = os.path.join(self.output_dir, f"{trace.name}-{trace.started_at:%Y%m%d-%H%M%S}-{os.getpid()}-{next(self._seq)}")
+            metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': name}}
+                        for tid, name in trace.threads.items()]
+            with open(f"{base}.trace.json", 'w') as f:
+                json.dump({'traceEvents': metadata + trace.events, 'displayTimeUnit': 'ms'}, f)
+            with open(f"{base}.folded", 'w') as f:
+                f.writelines(f"{stack} {us}\n" for stack, us in sorted(trace.folded.items()) if us)
+            logging.info(f"{self.summary(trace)}\n  trace written to {base}.trace.json")
+            if trace.stats is not None:
+                trace.stats.dump_stats(f"{base}.prof")
+                logging.info(f"CPU profile written to {base}.prof")
+        except Exception as e:
+            logging.warning(f"Failed to write trace for {trace.name}: {e}")
+
+tracer = Tracer()
+
+def traced(cat, name=None):
+    """函数级 span 装饰器，name 默认为函数的限定名"""
+    def decorator(func):
+        span_name = name or func.__qualname__
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if not tracer.enabled:
+                    return await func(*args, **kwargs)
+                with _Span(tracer, span_name, cat, {}):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return func(*args, **kwargs)
+            with _Span(tracer, span_name, cat, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
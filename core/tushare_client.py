@@ -4,13 +4,62 @@ import datetime
 import time
 import logging
 import os
+import threading
 from dotenv import load_dotenv
-from peewee import IntegrityError, chunked
-from core.db_models import StockDaily, db
+from core import clock
+from core.tracing import traced
+from peewee import IntegrityError, chunked, fn
+from core.db_models import StockDaily, StockDailyBasic, DataSyncLog, SecurityMaster, db, bulk_upsert_frame
+from core.quote_provider import ChunkedQuoteProvider, empty_frame, frame_to_quotes
 
 load_dotenv()
 
+def extract_price(quote, fields=('price', 'close', 'trade')):
+    """按字段优先级从行情 dict 中取第一个有效(>0)价格，取不到返回 0.0"""
+    if not quote:
+        return 0.0
+    for col in fields:
+        try:
+            val = float(quote.get(col, 0) or 0)
+        except (TypeError, ValueError):
+            continue
+        if val > 0:
+            return val
+    return 0.0
+
+def quote_datetime(quote):
+    """行情自带的 date/time 优先，缺失或无法解析时使用当前(模拟)时间"""
+    date, time_str = quote.get('date'), quote.get('time')
+    if date and time_str:
+        for fmt in ('%Y%m%d %H:%M:%S', '%Y-%m-%d %H:%M:%S'):
+            try:
+                return datetime.datetime.strptime(f"{date} {time_str}", fmt)
+            except ValueError:
+                continue
+    return clock.now()
+
+DAILY_FIELDS = [
+    'ts_code', 'trade_date', 'open', 'high', 'low', 'close',
+    'pre_close', 'change', 'pct_chg', 'vol', 'amount'
+]
+
+DAILY_BASIC_FIELDS = [
+    'ts_code', 'trade_date', 'close', 'turnover_rate', 'turnover_rate_f', 'volume_ratio',
+    'pe', 'pe_ttm', 'pb', 'total_share', 'float_share', 'total_mv', 'circ_mv'
+]
+
+SECURITY_FIELDS = ['ts_code', 'symbol', 'name', 'industry', 'market', 'list_status', 'list_date']
+
 class TushareClient:
+    # 证券主表的进程内缓存 {ts_code: dict}，所有实例共享
+    _security_cache = None
+    _security_lock = threading.Lock()
+    # 实时行情监听 (如盘中 tick 环形缓冲)，每次获取实时行情后以 {ts_code: quote} 回调
+    _quote_listeners = []
+    # 实时行情提供者，所有实例共享 (main 按 config.yaml 的 quotes 段设置)
+    quote_provider = ChunkedQuoteProvider()
+    HEAD_GAP_DAYS = 15  # 本地最早日线晚于窗口起点超过该天数才视为缺少历史 (春节等长假约 10 天)
+
     def __init__(self):
         token = os.getenv("TUSHARE_TOKEN")
         if not token:
@@ -18,22 +67,97 @@ class TushareClient:
         else:
             ts.set_token(token)
         self.pro = ts.pro_api()
+        # (cutoff_date, last_trade_date)，避免同一天反复查询交易日历
+        self._last_trade_date_cache = None
+
+    @traced('tushare')
+    def refresh_security_master(self, force=False):
+        """全量刷新证券主表 (每个交易日一次)，返回写入条数
+
+        以 DataSyncLog 中的全量刷新记录为准 (get_security 的单只补录不算)：最近一个完整交易日收盘后
+        已刷新过 (如前一日盘后 data_sync) 则视为最新，次日盘前不再重复拉取。
+        """
+        now = clock.now()
+        if not force:
+            last_close = datetime.datetime.strptime(self.get_last_complete_trade_date(), '%Y%m%d').replace(hour=15)
+            if DataSyncLog.select().where(DataSyncLog.dataset == 'security_master',
+                                          DataSyncLog.synced_at >= last_close).exists():
+                return 0
+
+        frames = []
+        for status in ['L', 'D', 'P']:
+            try:
+                df = self.pro.stock_basic(exchange='', list_status=status, fields=','.join(SECURITY_FIELDS))
+                if df is not None and not df.empty:
+                    df['list_status'] = status
+                    frames.append(df)
+            except Exception as e:
+                logging.error(f"Failed to fetch stock_basic (list_status={status}): {e}")
+
+        if not frames:
+            logging.warning("Security master refresh returned no data, keeping existing table.")
+            return 0
+
+        df = pd.concat(frames, ignore_index=True)
+        df = df.reindex(columns=SECURITY_FIELDS).astype(object).where(df.notna(), None)
+        rows = [dict(zip(SECURITY_FIELDS, values), updated_at=now) for values in df.itertuples(index=False, name=None)]
+
+        with db.atomic():
+            for batch in chunked(rows, 100):
+                SecurityMaster.insert_many(batch).on_conflict_replace().execute()
+            DataSyncLog.insert(trade_date=now.strftime('%Y%m%d'), dataset='security_master', rows=len(rows),
+                               synced_at=now).on_conflict_replace().execute()
+
+        self._load_security_cache(reload=True)
+        logging.info(f"Security master refreshed: {len(rows)} securities.")
+        return len(rows)
+
+    def _load_security_cache(self, reload=False):
+        cls = TushareClient
+        with cls._security_lock:
+            if cls._security_cache is None or reload:
+                cls._security_cache = {
+                    row['ts_code']: row for row in SecurityMaster.select().dicts()
+                }
+            return cls._security_cache
+
+    def get_security(self, ts_code):
+        """从证券主表获取基础信息 (dict)，本地缺失时回退到单只查询"""
+        cache = self._load_security_cache()
+        info = cache.get(ts_code)
+        if info is not None:
+            return info
 
-    def get_stock_name(self, ts_code):
-        """获取股票名称"""
         try:
-            df = self.pro.stock_basic(ts_code=ts_code, fields='ts_code,name')
+            df = self.pro.stock_basic(ts_code=ts_code, fields=','.join(SECURITY_FIELDS))
             if not df.empty:
-                return df.iloc[0]['name']
+                row = df.iloc[0]
+                info = {f: (row[f] if f in row and pd.notna(row[f]) else None) for f in SECURITY_FIELDS}
+                SecurityMaster.insert(**info, updated_at=clock.now()).on_conflict_replace().execute()
+                with TushareClient._security_lock:
+                    cache[ts_code] = info
+                return info
         except Exception as e:
-            logging.error(f"Failed to get name for {ts_code}: {e}")
+            logging.error(f"Failed to get security info for {ts_code}: {e}")
         return None
 
+    def get_stock_name(self, ts_code):
+        """获取股票名称"""
+        info = self.get_security(ts_code)
+        return info['name'] if info else None
+
+    def get_stock_industry(self, ts_code):
+        """获取所属行业"""
+        info = self.get_security(ts_code)
+        return info['industry'] if info else None
+
+    @traced('tushare')
     def get_trade_cal(self, start_date, end_date):
         """获取交易日历"""
         df = self.pro.trade_cal(exchange='', start_date=start_date, end_date=end_date)
         return df[df['is_open'] == 1]['cal_date'].tolist()
 
+    @traced('tushare')
     def fetch_daily(self, ts_code, start_date, end_date):
         """获取日线行情"""
         try:
@@ -50,37 +174,160 @@ class TushareClient:
             return None
 
     def save_to_db(self, df):
-        """将DataFrame数据保存到StockDaily"""
+        """将DataFrame数据保存到StockDaily (已存在的日线以新数据覆盖，用于接收修订)"""
         if df is None or df.empty:
-            return
-
-        data_source = []
-        for index, row in df.iterrows():
-            data_source.append({
-                'ts_code': row['ts_code'],
-                'trade_date': row['trade_date'],
-                'open': row['open'],
-                'high': row['high'],
-                'low': row['low'],
-                'close': row['close'],
-                'pre_close': row['pre_close'],
-                'change': row['change'],
-                'pct_chg': row['pct_chg'],
-                'vol': row['vol'],
-                'amount': row['amount']
-            })
+            return 0
+        return bulk_upsert_frame(StockDaily, df, DAILY_FIELDS, ['ts_code', 'trade_date'])
 
-        with db.atomic():
-            # 使用 chunked 批量插入以避免 SQL 变量限制
-            for batch in chunked(data_source, 100):
-                # 这里的 conflict handling 很重要
-                StockDaily.insert_many(batch).on_conflict_ignore().execute()
+    def get_stored_date_ranges(self, ts_codes):
+        """一次查询获取各代码本地日线的首末交易日, 返回 {ts_code: ('YYYYMMDD', 'YYYYMMDD')}"""
+        if not ts_codes:
+            return {}
+        query = (StockDaily
+                 .select(StockDaily.ts_code, fn.MIN(StockDaily.trade_date), fn.MAX(StockDaily.trade_date))
+                 .where(StockDaily.ts_code.in_(list(ts_codes)))
+                 .group_by(StockDaily.ts_code)
+                 .tuples())
+        return {code: (first_date, last_date) for code, first_date, last_date in query}
+
+    def get_last_complete_trade_date(self):
+        """最近一个日线数据已可获取的交易日 (当日日线在收盘后才发布)"""
+        now = clock.now()
+        cutoff = now if now.hour >= 16 else now - datetime.timedelta(days=1)
+        cutoff_str = cutoff.strftime('%Y%m%d')
+
+        if self._last_trade_date_cache and self._last_trade_date_cache[0] == cutoff_str:
+            return self._last_trade_date_cache[1]
+
+        try:
+            start = (cutoff - datetime.timedelta(days=30)).strftime('%Y%m%d')
+            open_days = self.get_trade_cal(start, cutoff_str)
+            last_trade_date = max(open_days) if open_days else cutoff_str
+        except Exception as e:
+            logging.warning(f"Trade calendar unavailable, using {cutoff_str} as sync target: {e}")
+            return cutoff_str
+
+        self._last_trade_date_cache = (cutoff_str, last_trade_date)
+        return last_trade_date
+
+    def plan_history_sync(self, ts_codes, years=1):
+        """计算需要补齐的日线区间, 返回 {ts_code: (start_date, end_date)}; 已完整且最新的代码不在结果中
+
+        除补齐最新交易日外，本地最早日线晚于 years 窗口起点 (如仅由全市场按日同步写入了近期日线) 时
+        一并回补窗口头部；窗口起点不早于上市日期，并留出 HEAD_GAP_DAYS 天容忍节假日与停牌。
+        """
+        target = self.get_last_complete_trade_date()
+        stored = self.get_stored_date_ranges(ts_codes)
+        window_start = clock.now() - datetime.timedelta(days=365 * years)
+        securities = self._load_security_cache()
+
+        plan = {}
+        for ts_code in ts_codes:
+            start = window_start.strftime('%Y%m%d')
+            if ts_code not in stored:
+                plan[ts_code] = (start, target)
+                continue
+            first_date, last_date = stored[ts_code]
+            list_date = (securities.get(ts_code) or {}).get('list_date')
+            expected_first = max(window_start, datetime.datetime.strptime(list_date, '%Y%m%d')) if list_date else window_start
+            head_missing = datetime.datetime.strptime(first_date, '%Y%m%d') - expected_first > datetime.timedelta(days=self.HEAD_GAP_DAYS)
+            if head_missing:
+                # 头部缺失: 整个窗口重新拉取 (已有日线按 upsert 覆盖)，末尾已最新时只补到最早日线之前
+                plan[ts_code] = (start, target if last_date < target else first_date)
+            elif last_date < target:
+                start = (datetime.datetime.strptime(last_date, '%Y%m%d') + datetime.timedelta(days=1)).strftime('%Y%m%d')
+                plan[ts_code] = (start, target)
+
+        logging.info(f"History sync plan: {len(plan)}/{len(ts_codes)} codes need update (target {target}).")
+        return plan
+
+    def sync_history(self, ts_code, start_date, end_date):
+        """仅拉取并保存缺失区间的日线"""
+        df = self.fetch_daily(ts_code, start_date, end_date)
+        if df is not None:
+            self.save_to_db(df)
+            logging.info(f"Synced {len(df)} records for {ts_code} ({start_date}-{end_date}).")
+        else:
+            logging.info(f"No new history for {ts_code} ({start_date}-{end_date}).")
+
+    @traced('tushare')
+    def fetch_daily_by_date(self, trade_date):
+        """获取某交易日全市场日线 (单次请求)"""
+        try:
+            df = self.pro.daily(trade_date=trade_date)
+            if df is None or df.empty:
+                return None
+            return df
+        except Exception as e:
+            logging.error(f"Tushare daily failed for trade_date {trade_date}: {e}")
+            time.sleep(1)
+            return None
+
+    @traced('tushare')
+    def fetch_daily_basic_by_date(self, trade_date):
+        """获取某交易日全市场每日指标 (单次请求)"""
+        try:
+            df = self.pro.daily_basic(ts_code='', trade_date=trade_date, fields=','.join(DAILY_BASIC_FIELDS))
+            if df is None or df.empty:
+                return None
+            return df
+        except Exception as e:
+            logging.error(f"Tushare daily_basic failed for trade_date {trade_date}: {e}")
+            time.sleep(1)
+            return None
+
+    def save_daily_basic_to_db(self, df):
+        """将每日指标保存到StockDailyBasic"""
+        if df is None or df.empty:
+            return 0
+        df = df.reindex(columns=DAILY_BASIC_FIELDS)
+        return bulk_upsert_frame(StockDailyBasic, df, DAILY_BASIC_FIELDS, ['ts_code', 'trade_date'])
+
+    def sync_market_daily(self, backfill_days=90, include_daily_basic=True):
+        """按交易日批量同步全市场日线 (及每日指标)，自动补齐停机期间缺失的交易日"""
+        target = self.get_last_complete_trade_date()
+        start = (datetime.datetime.strptime(target, '%Y%m%d') - datetime.timedelta(days=backfill_days)).strftime('%Y%m%d')
+        try:
+            open_days = sorted(self.get_trade_cal(start, target))
+        except Exception as e:
+            logging.error(f"Trade calendar unavailable, market sync aborted: {e}")
+            return 0
+
+        datasets = [('daily', self.fetch_daily_by_date, self.save_to_db)]
+        if include_daily_basic:
+            datasets.append(('daily_basic', self.fetch_daily_basic_by_date, self.save_daily_basic_to_db))
+
+        synced = set(DataSyncLog
+                     .select(DataSyncLog.trade_date, DataSyncLog.dataset)
+                     .where(DataSyncLog.trade_date >= start)
+                     .tuples())
+
+        synced_batches = 0
+        for trade_date in open_days:
+            for dataset, fetch, save in datasets:
+                if (trade_date, dataset) in synced:
+                    continue
+                df = fetch(trade_date)
+                if df is None:
+                    # 数据未发布或请求失败，下次同步时重试
+                    logging.info(f"No {dataset} data for {trade_date} yet.")
+                    continue
+                try:
+                    rows = save(df)
+                    DataSyncLog.insert(trade_date=trade_date, dataset=dataset, rows=rows).on_conflict_replace().execute()
+                except Exception as e:
+                    # 单个交易日写入失败不影响其余交易日，未记入 DataSyncLog 的下次同步时重试
+                    logging.error(f"Failed to save market {dataset} for {trade_date}: {e}")
+                    continue
+                logging.info(f"Market {dataset} synced for {trade_date}: {rows} rows.")
+                synced_batches += 1
+        return synced_batches
 
     def init_history_data(self, ts_code, years=3):
         """初始化历史数据"""
         logging.info(f"Initializing history data for {ts_code} ({years} years)...")
-        end_date = datetime.datetime.now().strftime('%Y%m%d')
-        start_date = (datetime.datetime.now() - datetime.timedelta(days=365 * years)).strftime('%Y%m%d')
+        end_date = clock.now().strftime('%Y%m%d')
+        start_date = (clock.now() - datetime.timedelta(days=365 * years)).strftime('%Y%m%d')
         
         df = self.fetch_daily(ts_code, start_date, end_date)
         if df is not None:
@@ -92,7 +339,7 @@ class TushareClient:
     def append_daily_data(self, ts_code, execution_date=None):
         """追加单日数据"""
         if not execution_date:
-            execution_date = datetime.datetime.now().strftime('%Y%m%d')
+            execution_date = clock.now().strftime('%Y%m%d')
         
         logging.info(f"Appending daily data for {ts_code} on {execution_date}...")
         df = self.fetch_daily(ts_code, start_date=execution_date, end_date=execution_date)
@@ -102,37 +349,52 @@ class TushareClient:
         else:
             logging.info(f"No data for {ts_code} on {execution_date} (Market might be closed or data delay).")
 
-    def get_realtime_quote(self, ts_code):
-        """获取实时行情所有数据(dict)"""
+    @classmethod
+    def add_quote_listener(cls, listener):
+        if listener not in cls._quote_listeners:
+            cls._quote_listeners.append(listener)
+
+    def _emit_quotes(self, quotes):
+        for listener in self._quote_listeners:
+            try:
+                listener(quotes)
+            except Exception as e:
+                logging.warning(f"Quote listener failed: {e}")
+
+    @classmethod
+    def set_quote_provider(cls, provider):
+        """替换实时行情提供者 (分块接口 / 全市场快照 / 回放替身)"""
+        cls.quote_provider = provider
+
+    @traced('tushare')
+    def get_quote_frame(self, ts_code_list):
+        """批量获取实时行情，返回以 ts_code 为索引的列式 DataFrame (仅包含请求的代码)"""
+        codes = list(dict.fromkeys(ts_code_list))
+        if not codes:
+            return empty_frame()
         try:
-            df = ts.realtime_quote(ts_code=ts_code)
-            if df is not None and not df.empty:
-                # 统一列名小写
-                data = df.iloc[0].to_dict()
-                return {k.lower(): v for k, v in data.items()}
+            frame = self.quote_provider.fetch(codes)
         except Exception as e:
-            logging.warning(f"Realtime full quote failed for {ts_code}: {e}")
-        return None
+            logging.error(f"Batch realtime quote failed: {e}")
+            return empty_frame()
+        if self._quote_listeners and not frame.empty:
+            self._emit_quotes(frame_to_quotes(frame))
+        return frame
+
+    def get_realtime_quote(self, ts_code):
+        """获取实时行情所有数据(dict)"""
+        quotes = self.get_batch_realtime_quotes_full([ts_code])
+        return quotes.get(ts_code)
 
     def get_latest_price(self, ts_code):
         """获取最新价格 (优先使用实时接口)"""
-        # 1. 尝试使用实时接口 (需要 tushare >= 1.3.3)
-        try:
-            # ts.realtime_quote 是爬虫接口，数据实时性较好
-            df = ts.realtime_quote(ts_code=ts_code)
-            if df is not None and not df.empty:
-                row = df.iloc[0]
-                # 不同版本/来源可能列名不同，常见为 price 或 close
-                for col in ['price', 'PRICE', 'close', 'CLOSE', 'trade']:
-                    if col in row:
-                        val = float(row[col])
-                        if val > 0:
-                            return val
-        except Exception as e:
-            logging.warning(f"Realtime quote failed for {ts_code}, falling back to daily: {e}")
+        # 1. 实时行情 (经 quote_provider，全市场快照模式下与监控共享同一快照)
+        price = extract_price(self.get_realtime_quote(ts_code))
+        if price > 0:
+            return price
 
         # 2. 降级: Daily 接口 (可能有延迟或需盘后)
-        today = datetime.datetime.now().strftime('%Y%m%d')
+        today = clock.now().strftime('%Y%m%d')
         df = self.fetch_daily(ts_code, start_date=today, end_date=today)
         if df is None or df.empty:
             # 尝试获取上一交易日
@@ -143,54 +405,23 @@ class TushareClient:
             return 0.0
         return float(df.iloc[0]['close'])
 
+    def get_batch_realtime_quotes_full(self, ts_code_list):
+        """批量获取实时行情所有字段, 返回 {ts_code: dict}"""
+        frame = self.get_quote_frame(ts_code_list)
+        return frame_to_quotes(frame) if not frame.empty else {}
+
     def get_batch_realtime_quotes(self, ts_code_list):
-        """批量获取实时行情, 返回 {ts_code: price}"""
-        if not ts_code_list:
-            return {}
-        try:
-            # tushare realtime_quote interface works best with joined string of full codes (e.g. "000001.SZ,600000.SH")
-            # It returns a DataFrame with 'TS_CODE' (or 'ts_code') column matching the input.
-            all_dfs = []
-            chunk_size = 80 
-            
-            for i in range(0, len(ts_code_list), chunk_size):
-                chunk = ts_code_list[i:i+chunk_size]
-                codes_str = ','.join(chunk)
-                try:
-                    sub_df = ts.realtime_quote(ts_code=codes_str)
-                    if sub_df is not None and not sub_df.empty:
-                        all_dfs.append(sub_df)
-                except Exception as chunk_e:
-                    logging.warning(f"Batch quote chunk failed: {chunk_e}")
-
-            if not all_dfs:
-                return {}
-            
-            df = pd.concat(all_dfs, ignore_index=True)
-            if df.empty:
-                return {}
-            
-            result = {}
-            df.columns = [c.lower() for c in df.columns]
-            
-            for _, row in df.iterrows():
-                # Prefer 'ts_code', fallback to 'code' if necessary (though ts_code should be present)
-                code = row.get('ts_code', row.get('code'))
-                # Handle price column variations
-                price = 0.0
-                for col in ['price', 'close', 'trade']:
-                    if col in row:
-                        val = float(row[col])
-                        if val > 0:
-                            price = val
-                            break
-                            
-                if code and price > 0:
-                    result[code] = price
-            return result
-        except Exception as e:
-            logging.error(f"Batch realtime quote failed: {e}")
+        """批量获取实时行情, 返回 {ts_code: price}
+
+        只保留成交价 > 0 的代码；停牌或尚未成交的代码不返回 (不以昨收代替，避免监控按昨收触发/下单)。
+        需要参考价的调用方应显式读取 pre_close。
+        """
+        frame = self.get_quote_frame(ts_code_list)
+        if frame.empty:
             return {}
+        price = frame['price']
+        price = price[price > 0]
+        return dict(zip(price.index, price.astype(float)))
 
 if __name__ == "__main__":
     from core.db_models import init_db
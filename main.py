@@ -3,17 +3,35 @@ import time
 import logging
 import datetime
 import os
+import sys
+import signal
 import argparse
+import subprocess
 from apscheduler.schedulers.blocking import BlockingScheduler
 from apscheduler.triggers.cron import CronTrigger
 
 from core.tushare_client import TushareClient
 from core.scanner import MarketScanner
-from core.notifier import DingTalkNotifier
+from core.notifier import DingTalkNotifier, notification_queue
 from core.trader import Trader
 from core.news_client import NewsClient
-from core.db_models import init_db, Position, PriceMonitor
+from core.db_models import db, init_db, Position, PriceMonitor
 from core.monitor import PriceMonitorService
+from core.monitor_runner import MonitorRunner
+from core import signals
+from core.pipeline import StagedPipeline
+from core.quote_snapshot import QuoteSnapshot
+from core.quote_provider import build_provider
+from core.portfolio import PortfolioValuer
+from core.history_store import ColumnarHistoryStore
+from core.indicators import IndicatorEngine
+from core import clock, routine_context
+from core.llm_cache import llm_cache
+from core import llm_stats
+from core.tracing import tracer
+from core.tick_buffer import tick_buffer
+from core.minute_bars import minute_bars
+from agents.base import BaseAgent
 from agents.analyst import AnalystAgent
 from agents.decision_maker import DecisionMakerAgent
 
@@ -26,30 +44,51 @@ logging.basicConfig(
         logging.StreamHandler()
     ]
 )
-# 自定义日志过滤器：屏蔽 run_monitor_task 的 apscheduler 日志
-class MonitorTaskFilter(logging.Filter):
-    def filter(self, record):
-        return "run_monitor_task" not in record.getMessage()
-
-# 必须添加到具体的子 logger，因为 logging 的 filter 不会向下传播，
-# 而 apscheduler 的日志是从 apscheduler.executors.default 发出的，会向上传播到 root
-logging.getLogger('apscheduler.executors.default').addFilter(MonitorTaskFilter())
-logging.getLogger('apscheduler.scheduler').addFilter(MonitorTaskFilter())
-
 # 加载配置
 with open("config.yaml", "r") as f:
     CONFIG = yaml.safe_load(f)
 
+# LLM 传输参数 (超时/重试/并发)
+BaseAgent.configure(CONFIG.get('llm'))
+
+# 钉钉消息后台投递 (限流、合并、落库重试)
+notification_queue.configure(CONFIG.get('notifier'))
+
+# 实时行情提供者: 分块并行 (chunked) 或全市场快照 (market)
+TushareClient.set_quote_provider(build_provider(CONFIG.get('quotes')))
+
+# 盘中 tick 环形缓冲与 1 分钟 K 线: 所有实时行情获取 (监控/流程) 自动写入
+tick_buffer.configure(CONFIG.get('ticks'))
+TushareClient.add_quote_listener(tick_buffer.record_quotes)
+minute_bars.configure(CONFIG.get('minute_bars'))
+TushareClient.add_quote_listener(minute_bars.record_quotes)
+
 # 初始化组件
 ts_client = TushareClient()
 scanner = MarketScanner()
 news_client = NewsClient()
 notifier = DingTalkNotifier() # 确保 .env 配置了 Token
 trader = Trader()
+portfolio = PortfolioValuer(ts_client)
 analyst = AnalystAgent()
 decision_maker = DecisionMakerAgent()
-monitor_service = PriceMonitorService()
+monitor_service = PriceMonitorService(
+    trigger_workers=CONFIG.get('monitor', {}).get('trigger_workers', 4),
+    latency_budget=CONFIG.get('monitor', {}).get('latency_budget', 30),
+    poll_interval=CONFIG.get('monitor', {}).get('interval', 5),
+    max_poll_interval=CONFIG.get('monitor', {}).get('max_interval', 120),
+    mark_to_market=CONFIG.get('monitor', {}).get('mark_to_market', True),
+)
+indicator_engine = IndicatorEngine(lookback=CONFIG.get('indicators', {}).get('lookback', 150))
+
+def new_quote_snapshot():
+    """创建单次流程共享的行情快照"""
+    quote_cfg = CONFIG.get('quotes', {})
+    return QuoteSnapshot(ts_client,
+                         max_age=quote_cfg.get('snapshot_max_age', 60),
+                         order_max_age=quote_cfg.get('order_max_age', 5))
 
+@routine_context.track('pre_market')
 def run_pre_market_routine(test_mode=False):
     """早盘流程: 扫描 -> 分析 -> 决策 -> 买入"""
     logging.info(">>> Starting Pre-Market Routine")
@@ -58,42 +97,9 @@ def run_pre_market_routine(test_mode=False):
     # 每天开盘前，将所有持仓标记为可用
     trader.settle_positions()
 
-    # 0.5 更新持仓状态 (刷新最新价格/开盘价)
-    try:
-        current_positions = Position.select()
-        updated_count = 0
-        for pos in current_positions:
-            # 尝试获取实时行情(含竞价开盘)
-            quote = ts_client.get_realtime_quote(pos.ts_code)
-            current_price = 0.0
-            
-            if quote:
-                try:
-                    # 优先取当前价(price)，如果是0(集合竞价刚开始可能)，则取open，还不行取pre_close
-                    current_price = float(quote.get('price', 0))
-                    if current_price <= 0:
-                        current_price = float(quote.get('open', 0))
-                    if current_price <= 0:
-                        current_price = float(quote.get('pre_close', 0))
-                except: 
-                    pass
-            
-            # 降级
-            if current_price <= 0:
-                current_price = ts_client.get_latest_price(pos.ts_code)
-
-            if current_price > 0:
-                pos.current_price = current_price
-                pos.market_value = pos.volume * current_price
-                if pos.volume > 0:
-                    pos.profit = pos.market_value - (pos.avg_price * pos.volume)
-                pos.last_updated = datetime.datetime.now()
-                pos.save()
-                updated_count += 1
-        logging.info(f"Updated status for {updated_count} positions.")
-    except Exception as e:
-        logging.error(f"Failed to update positions in pre-market: {e}")
-    
+    # 0.1 刷新证券主表 (上一交易日盘后 data_sync 已刷新则跳过)
+    ts_client.refresh_security_master()
+
     # 0.6 清理旧监控 (每天都是新的开始)
     try:
         deleted = PriceMonitor.delete().where(PriceMonitor.status == 'ACTIVE').execute()
@@ -121,59 +127,100 @@ def run_pre_market_routine(test_mode=False):
         candidates.update(scanned_stocks)
         logging.info(f"Added scanned stocks: {scanned_stocks}")
 
-    candidates = list(candidates)
+    # 排序保证流水线输出与后续监控设置顺序确定
+    candidates = sorted(candidates)
     
-    # 3. 逐个分析
-    analyst_reports = []
-    for ts_code in candidates:
-        # 获取最新历史数据 (如不存在则初始化)
-        ts_client.init_history_data(ts_code, years=1)
-        
+    # 2.5 行情快照: 本流程涉及的所有代码一次性批量拉取 (含竞价开盘)
+    snapshot = new_quote_snapshot()
+    snapshot.fetch(candidates)
+
+    # 更新持仓状态 (刷新最新价格/开盘价): 批量估值，单事务写入持仓与账户
+    try:
+        # 优先取当前价(price)，如果是0(集合竞价刚开始可能)，则取open，还不行取pre_close
+        portfolio.revalue(snapshot=snapshot, fields=('price', 'open', 'pre_close'))
+    except Exception as e:
+        logging.error(f"Failed to update positions in pre-market: {e}")
+    
+    # 3. 分阶段并发分析 (数据 -> 新闻 -> LLM)
+    pipeline_cfg = CONFIG.get('pipeline', {})
+
+    # 仅补齐本地缺失的日线区间 (已是最新的代码不发请求)
+    sync_plan = ts_client.plan_history_sync(candidates, years=1)
+
+    def fetch_data_stage(ctx):
+        # 补齐历史数据 (如不存在则初始化) + 实时竞价行情
+        if ctx['ts_code'] in sync_plan:
+            ts_client.sync_history(ctx['ts_code'], *sync_plan[ctx['ts_code']])
+        # 物化尚未计算的技术指标 (已最新时不写库)
+        indicator_engine.update([ctx['ts_code']])
+        ctx['quote'] = snapshot.get(ctx['ts_code'])
+        return ctx
+
+    def fetch_news_stage(ctx):
         # 获取个股新闻 (AkShare)
-        news = news_client.get_stock_news(ts_code, limit=3)
-        
-        # 获取实时竞价行情
-        quote = ts_client.get_realtime_quote(ts_code)
-        
-        report = analyst.analyze_pre_market(ts_code, news, realtime_quote=quote)
-        if report:
-             logging.info(f"Report for {ts_code}: {report}")
-             analyst_reports.append(report)
-
-             # Setup Price Monitor (New Feature)
-             # Restriction: All candidates (whitelist + auto-mined) are eligible for monitoring
-             if 'monitor_setup' in report and isinstance(report['monitor_setup'], dict):
-                 setup = report['monitor_setup']
-                 try:
-                     trig_price = float(setup.get('trigger_price', 0))
-                     if trig_price > 0:
-                         # 过滤掉过于接近当前价的无效监控 (比如偏差 < 0.5%)
-                         current_p = 0.0
-                         try:
-                             if quote:
-                                 current_p = float(quote.get('price', quote.get('open', 0)))
-                         except Exception:
-                             pass
-                         
-                         is_valid = True
-                         if current_p > 0:
-                             diff_pct = abs(trig_price - current_p) / current_p * 100
-                             if diff_pct < 0.5:
-                                logging.warning(f"Monitor skipped for {ts_code}: Target {trig_price} is too close to current {current_p} (<0.5%)")
-                                is_valid = False
-                         
-                         if is_valid:
-                             PriceMonitor.create(
-                                ts_code=ts_code,
-                                trigger_price=trig_price,
-                                operator=setup.get('operator', 'gt'),
-                                monitor_type=setup.get('monitor_type', 'signal'),
-                                reason=setup.get('reason', 'Pre-market setup'),
-                                status='ACTIVE'
-                             )
-                             logging.info(f"Monitor SETUP: {ts_code} at {trig_price}")
-                 except Exception as e:
-                     logging.error(f"Failed to create monitor: {e}")
+        ctx['news'] = news_client.get_stock_news(ctx['ts_code'], limit=3)
+        return ctx
+
+    def analyze_stage(ctx):
+        ctx['report'] = analyst.analyze_pre_market(ctx['ts_code'], ctx['news'], realtime_quote=ctx['quote'])
+        return ctx
+
+    pipeline = StagedPipeline([
+        ('data', fetch_data_stage, pipeline_cfg.get('data_workers', 4)),
+        ('news', fetch_news_stage, pipeline_cfg.get('news_workers', 4)),
+        ('llm', analyze_stage, pipeline_cfg.get('llm_workers', 4)),
+    ])
+    pipeline_results = pipeline.run([{'ts_code': ts_code} for ts_code in candidates])
+
+    # 按候选顺序串行收集报告并设置监控
+    analyst_reports = []
+    for ctx in pipeline_results:
+        if not ctx or not ctx.get('report'):
+            continue
+        ts_code = ctx['ts_code']
+        report = ctx['report']
+        quote = ctx.get('quote')
+
+        logging.info(f"Report for {ts_code}: {report}")
+        analyst_reports.append(report)
+
+        # Setup Price Monitor (New Feature)
+        # Restriction: All candidates (whitelist + auto-mined) are eligible for monitoring
+        if 'monitor_setup' in report and isinstance(report['monitor_setup'], dict):
+            setup = report['monitor_setup']
+            try:
+                trig_price = float(setup.get('trigger_price', 0))
+                if trig_price > 0:
+                    # 过滤掉过于接近当前价的无效监控 (比如偏差 < 0.5%)
+                    current_p = 0.0
+                    try:
+                        if quote:
+                            current_p = float(quote.get('price', quote.get('open', 0)))
+                    except Exception:
+                        pass
+                    
+                    is_valid = True
+                    if current_p > 0:
+                        diff_pct = abs(trig_price - current_p) / current_p * 100
+                        if diff_pct < 0.5:
+                            logging.warning(f"Monitor skipped for {ts_code}: Target {trig_price} is too close to current {current_p} (<0.5%)")
+                            is_valid = False
+                    
+                    if is_valid:
+                        PriceMonitor.create(
+                            ts_code=ts_code,
+                            trigger_price=trig_price,
+                            operator=setup.get('operator', 'gt'),
+                            monitor_type=setup.get('monitor_type', 'signal'),
+                            reason=setup.get('reason', 'Pre-market setup'),
+                            status='ACTIVE'
+                        )
+                        logging.info(f"Monitor SETUP: {ts_code} at {trig_price}")
+            except Exception as e:
+                logging.error(f"Failed to create monitor: {e}")
+
+    # 通知监控循环 (可能在独立进程中) 立即重建索引
+    signals.notify(signals.MONITORS_CHANGED)
 
     # 4. 决策
     max_pos_pct = CONFIG['settings'].get('max_position_per_stock', 1.0)
@@ -190,21 +237,21 @@ def run_pre_market_routine(test_mode=False):
             recommendations_msg.append(f"**{stock_name} ({ts_code})** - 信心: {report.get('confidence')}\n   _Reason: {report.get('reason')}_")
 
     if buy_orders:
+        orders = []
         for order in buy_orders:
-            ts_code = order['ts_code']
-            budget = order['budget']
-            reason = order['reason']
-            # 获取参考价格 (昨收)
-            price = ts_client.get_latest_price(ts_code)
-            stock_name = ts_client.get_stock_name(ts_code)
-            
+            # 获取参考价格 (下单前确保行情足够新)
+            price = snapshot.price_for_order(order['ts_code'])
             if price > 0:
-                res = trader.execute_buy(ts_code, budget, reason, price, stock_name=stock_name)
-                if res: 
-                    # 增加理由到通知
-                    execution_logs.append(f"{res}")
-                else:
-                    execution_logs.append(f"❌ Failed to buy {stock_name}: Check logs for details.")
+                orders.append({'ts_code': order['ts_code'], 'action': 'BUY', 'budget': order['budget'],
+                               'reason': order['reason'], 'price': price,
+                               'stock_name': ts_client.get_stock_name(order['ts_code'])})
+
+        # 所有买单一次性提交 (单个事务落库)
+        for order, res in zip(orders, trader.execute_orders(orders)):
+            if res:
+                execution_logs.append(f"{res}")
+            else:
+                execution_logs.append(f"❌ Failed to buy {order['stock_name']}: Check logs for details.")
     
     # 5. 推送
     if recommendations_msg or execution_logs:
@@ -227,6 +274,7 @@ def run_pre_market_routine(test_mode=False):
         logging.info("今日无买入计划，不发送通知。")
     logging.info("<<< Pre-Market Routine Finished")
 
+@routine_context.track('midday')
 def run_midday_routine(test_mode=False):
     """午间休盘前分析: 风控(止盈/止损) + 机会(加仓/买入)"""
     logging.info(">>> Starting Midday Routine")
@@ -234,71 +282,64 @@ def run_midday_routine(test_mode=False):
     execution_logs = []
     buy_candidates_reports = [] # 收集买入建议
 
-    # 1. 遍历持仓 (检查卖出 或 加仓)
-    positions = Position.select()
-    held_codes = set()
-    for pos in positions:
-        held_codes.add(pos.ts_code)
-        
-        # 获取实时价格
-        quote = ts_client.get_realtime_quote(pos.ts_code)
-        current_price = 0.0
-        if quote:
-            try:
-                current_price = float(quote.get('price', quote.get('close', 0)))
-            except: pass
-        if current_price <= 0:
-             current_price = ts_client.get_latest_price(pos.ts_code)
-        
-        if current_price > 0:
-            pos.current_price = current_price
-            
-            # 更新持仓市值和盈亏
-            pos.market_value = pos.volume * current_price
-            if pos.volume > 0:
-                pos.profit = pos.market_value - (pos.avg_price * pos.volume)
-            pos.last_updated = datetime.datetime.now()
-            pos.save()
-
-            # 分析
-            report = analyst.analyze_intra_day(pos.ts_code, current_price, position=pos, quote_data=quote)
-            
-            if report:
-                action = report.get('action')
-                # 情况A: 卖出建议
-                if action in ['SELL_ALL', 'SELL_HALF']:
-                    sell_order = decision_maker.make_sell_decision(report) # 简单透传
-                    if sell_order:
-                        stock_name = ts_client.get_stock_name(sell_order['ts_code'])
-                        res = trader.execute_sell(sell_order['ts_code'], sell_order['action'], sell_order['reason'], current_price, stock_name=stock_name)
-                        if res: 
-                            execution_logs.append(f"{res}\n  _Reason: {sell_order['reason']}_")
-                        else:
-                            execution_logs.append(f"❌ Failed to SELL {sell_order['ts_code']}: Check logs.")
-                
-                # 情况B: 加仓建议
-                elif action == 'BUY':
-                    logging.info(f"Analyst suggests ADDING position for {pos.ts_code}")
-                    buy_candidates_reports.append(report)
+    positions = list(Position.select())
+    held_codes = {pos.ts_code for pos in positions}
+    watchlist = set(CONFIG.get('watchlist', []))
+
+    # 行情快照: 持仓 + Watchlist 一次性批量拉取
+    snapshot = new_quote_snapshot()
+    snapshot.fetch(held_codes | watchlist)
+
+    # 1. 持仓批量估值 (刷新价格、市值、盈亏与账户总资产)
+    prices = portfolio.revalue(positions, snapshot=snapshot)
+    holding_items = [(pos.ts_code, prices[pos.ts_code], pos, snapshot.get(pos.ts_code))
+                     for pos in positions if pos.ts_code in prices]
 
     # 2. 遍历 Watchlist (检查新开仓) - 仅检查非持仓部分
-    watchlist = set(CONFIG.get('watchlist', []))
-    new_candidates = watchlist - held_codes
+    new_candidates = sorted(watchlist - held_codes)
     
+    watch_items = []
     for ts_code in new_candidates:
-        quote = ts_client.get_realtime_quote(ts_code)
-        current_price = 0.0
-        if quote:
-            try:
-                current_price = float(quote.get('price', quote.get('close', 0)))
-            except: pass
+        quote = snapshot.get(ts_code)
+        current_price = snapshot.price(ts_code)
         
         if current_price > 0:
-            # 分析 (非持仓)
-            report = analyst.analyze_intra_day(ts_code, current_price, position=None, quote_data=quote)
-            if report and report.get('action') == 'BUY':
-                logging.info(f"Analyst suggests BUYING new stock {ts_code}")
+            watch_items.append((ts_code, current_price, None, quote))
+
+    # 持仓与新标的的分析请求一次性并发提交
+    reports = analyst.analyze_intra_day_many(holding_items + watch_items)
+    holding_reports = reports[:len(holding_items)]
+    watch_reports = reports[len(holding_items):]
+
+    # 2.1 持仓: 卖出 或 加仓
+    sell_orders = []
+    for (ts_code, current_price, pos, quote), report in zip(holding_items, holding_reports):
+        if report:
+            action = report.get('action')
+            # 情况A: 卖出建议
+            if action in ['SELL_ALL', 'SELL_HALF']:
+                sell_order = decision_maker.make_sell_decision(report) # 简单透传
+                if sell_order:
+                    sell_orders.append(dict(sell_order, price=current_price,
+                                            stock_name=ts_client.get_stock_name(sell_order['ts_code'])))
+            
+            # 情况B: 加仓建议
+            elif action == 'BUY':
+                logging.info(f"Analyst suggests ADDING position for {ts_code}")
                 buy_candidates_reports.append(report)
+
+    # 卖单先于买单一次性提交 (释放的资金可用于随后的买入)
+    for order, res in zip(sell_orders, trader.execute_orders(sell_orders)):
+        if res:
+            execution_logs.append(f"{res}\n  _Reason: {order['reason']}_")
+        else:
+            execution_logs.append(f"❌ Failed to SELL {order['ts_code']}: Check logs.")
+
+    # 2.2 非持仓: 新开仓
+    for (ts_code, current_price, _, quote), report in zip(watch_items, watch_reports):
+        if report and report.get('action') == 'BUY':
+            logging.info(f"Analyst suggests BUYING new stock {ts_code}")
+            buy_candidates_reports.append(report)
                 
     # 3. 统一执行买入决策 (资金分配)
     if buy_candidates_reports:
@@ -307,20 +348,20 @@ def run_midday_routine(test_mode=False):
         max_pos_pct = CONFIG['settings'].get('max_position_per_stock', 1.0)
         buy_orders = decision_maker.make_buy_decision(buy_candidates_reports, max_position_pct=max_pos_pct)
         
+        orders = []
         for order in buy_orders:
-            ts_code = order['ts_code']
-            budget = order['budget']
-            reason = order['reason']
-            # 重新获取价格或使用之前的
-            price = ts_client.get_latest_price(ts_code)
-            stock_name = ts_client.get_stock_name(ts_code)
-            
+            # 下单前确保行情足够新 (过期则刷新)
+            price = snapshot.price_for_order(order['ts_code'])
             if price > 0:
-                res = trader.execute_buy(ts_code, budget, reason, price, stock_name=stock_name)
-                if res: 
-                    execution_logs.append(f"{res}\n  _Reason: {reason}_")
-                else:
-                    execution_logs.append(f"❌ Failed to BUY {ts_code}: Check logs.")
+                orders.append({'ts_code': order['ts_code'], 'action': 'BUY', 'budget': order['budget'],
+                               'reason': order['reason'], 'price': price,
+                               'stock_name': ts_client.get_stock_name(order['ts_code'])})
+
+        for order, res in zip(orders, trader.execute_orders(orders)):
+            if res:
+                execution_logs.append(f"{res}\n  _Reason: {order['reason']}_")
+            else:
+                execution_logs.append(f"❌ Failed to BUY {order['ts_code']}: Check logs.")
 
     # 4. 推送
     midday_recs = []
@@ -346,42 +387,43 @@ def run_midday_routine(test_mode=False):
             notifier.send_markdown("盘中报告", "**盘中分析完成** \n\n无重磅信号。")
         logging.info("Midday check finished, no action.")
 
+@routine_context.track('pre_close')
 def run_pre_close_routine(test_mode=False):
     """尾盘流程: 监控持仓 -> 分析 -> 卖出"""
     logging.info(">>> Starting Pre-Close Routine")
     
-    positions = Position.select()
+    positions = list(Position.select())
     if not positions:
         logging.info("No positions held.")
         return
 
     execution_logs = []
     
-    for pos in positions:
-        # 1. 更新最新价格
-        current_price = ts_client.get_latest_price(pos.ts_code)
-        if current_price > 0:
-            pos.current_price = current_price
-            pos.market_value = pos.volume * current_price
-            if pos.volume > 0:
-                pos.profit = pos.market_value - (pos.avg_price * pos.volume)
-            pos.last_updated = datetime.datetime.now()
-            pos.save()
-        
-        # 2. 分析
-        report = analyst.analyze_pre_close(pos)
+    # 行情快照: 所有持仓一次性批量拉取
+    snapshot = new_quote_snapshot()
+    snapshot.fetch([pos.ts_code for pos in positions])
+
+    # 1. 持仓批量估值 (刷新价格、市值、盈亏与账户总资产)
+    prices = portfolio.revalue(positions, snapshot=snapshot)
+    current_prices = [prices.get(pos.ts_code, 0.0) for pos in positions]
         
-        # 3. 决策
+    # 2. 分析 (所有持仓并发提交)
+    reports = analyst.analyze_pre_close_many(positions, [snapshot.get(pos.ts_code) for pos in positions])
+
+    # 3. 决策
+    sell_orders = []
+    for current_price, report in zip(current_prices, reports):
         sell_order = decision_maker.make_sell_decision(report)
-        
-        # 4. 执行
         if sell_order:
-            stock_name = ts_client.get_stock_name(sell_order['ts_code'])
-            res = trader.execute_sell(sell_order['ts_code'], sell_order['action'], sell_order['reason'], current_price, stock_name=stock_name)
-            if res: 
-                execution_logs.append(f"{res}\n  _Reason: {sell_order['reason']}_")
-            else:
-                execution_logs.append(f"❌ Failed to SELL {sell_order['ts_code']} ({stock_name}): Check logs.")
+            sell_orders.append(dict(sell_order, price=current_price,
+                                    stock_name=ts_client.get_stock_name(sell_order['ts_code'])))
+
+    # 4. 执行 (所有卖单一次性提交)
+    for order, res in zip(sell_orders, trader.execute_orders(sell_orders)):
+        if res:
+            execution_logs.append(f"{res}\n  _Reason: {order['reason']}_")
+        else:
+            execution_logs.append(f"❌ Failed to SELL {order['ts_code']} ({order['stock_name']}): Check logs.")
 
     # 5. 推送
     if execution_logs:
@@ -393,39 +435,53 @@ def run_pre_close_routine(test_mode=False):
             notifier.send_markdown("尾盘风控", "**尾盘风控报告** \n\n持仓稳健，无需卖出。")
         logging.info("持仓稳健，不发送通知。")
 
+@routine_context.track('data_sync')
 def run_data_sync_routine(test_mode=False):
     """盘后数据同步"""
     logging.info(">>> Starting Data Sync")
-    # 同步 Watchlist
-    for ts_code in CONFIG.get('watchlist', []):
-        ts_client.append_daily_data(ts_code)
-    
-    # 同步持仓
-    for pos in Position.select():
-        ts_client.append_daily_data(pos.ts_code)
-    logging.info("<<< Data Sync Finished")
+    # 证券主表 (名称/行业/上市状态)
+    ts_client.refresh_security_master()
+
+    sync_cfg = CONFIG.get('sync', {})
+    if sync_cfg.get('mode', 'market') == 'market':
+        # 全市场按交易日批量同步 (含停机期间缺失交易日的补齐)
+        ts_client.sync_market_daily(backfill_days=sync_cfg.get('backfill_days', 90),
+                                    include_daily_basic=sync_cfg.get('include_daily_basic', True))
+    else:
+        # 同步 Watchlist
+        for ts_code in CONFIG.get('watchlist', []):
+            ts_client.append_daily_data(ts_code)
+        
+        # 同步持仓
+        for pos in Position.select():
+            ts_client.append_daily_data(pos.ts_code)
 
-def run_monitor_task():
-    """实时价格监控任务"""
-    now_dt = datetime.datetime.now()
-    
-    # 1. 排除周末 (0-4 为周一到周五)
-    if now_dt.weekday() > 4:
-        return
+    # 技术指标增量计算 (跟踪池 或 全市场)
+    try:
+        if CONFIG.get('indicators', {}).get('universe', 'tracked') == 'all':
+            indicator_engine.update()
+        else:
+            tracked = set(CONFIG.get('watchlist', []))
+            tracked.update(p.ts_code for p in Position.select())
+            tracked.update(m.ts_code for m in PriceMonitor.select(PriceMonitor.ts_code).where(PriceMonitor.status == 'ACTIVE'))
+            indicator_engine.update(sorted(tracked))
+    except Exception as e:
+        logging.error(f"Indicator update failed: {e}")
 
-    now = now_dt.time()
-    # 简单的交易时间判断 (9:30 - 11:29, 13:00 - 14:49)
-    # 放宽前后几分钟，确保集合竞价和尾盘数据能覆盖
-    start_am = datetime.time(9, 30)
-    end_am = datetime.time(11, 29)
-    start_pm = datetime.time(13, 0)
-    end_pm = datetime.time(14, 49) 
-    
-    if (start_am <= now <= end_am) or (start_pm <= now <= end_pm):
+    # 列式历史库 (可选) 增量跟进
+    store_cfg = CONFIG.get('history_store', {})
+    if store_cfg.get('enabled'):
         try:
-            monitor_service.run_check()
+            ColumnarHistoryStore(store_cfg.get('root', 'data/history')).sync_from_db()
         except Exception as e:
-            logging.error(f"Monitor task error: {e}")
+            logging.error(f"History store sync failed: {e}")
+
+    # 分钟线保留期清理
+    try:
+        minute_bars.prune()
+    except Exception as e:
+        logging.error(f"Minute bar pruning failed: {e}")
+    logging.info("<<< Data Sync Finished")
 
 if __name__ == "__main__":
     # 初始化数据库
@@ -439,8 +495,38 @@ if __name__ == "__main__":
     parser.add_argument('--pre-close', action='store_true', help='立即运行尾盘策略')
     parser.add_argument('--sync', action='store_true', help='立即运行数据同步')
     parser.add_argument('--init-data', action='store_true', help='初始化历史数据')
+    parser.add_argument('--monitor', action='store_true', help='仅运行实时价格监控循环 (独立进程)')
+    parser.add_argument('--llm-stats', action='store_true', help='输出 LLM 调用统计 (延迟分位、各流程 tokens、各 Key 失败率)')
+    parser.add_argument('--stats-days', type=float, default=1, help='--llm-stats 统计最近N天 (默认1)')
+    parser.add_argument('--profile', action='store_true', help='记录各流程分段耗时 (Chrome trace JSON + 折叠栈，输出到 profiling.output_dir)')
+    parser.add_argument('--profile-cpu', action='store_true', help='同 --profile，并为每个流程保存 cProfile 结果')
     args = parser.parse_args()
 
+    if args.profile or args.profile_cpu:
+        tracer.configure(CONFIG.get('profiling'), cpu=args.profile_cpu)
+        tracer.install_sqlite(db)
+
+    if args.llm_stats:
+        print(llm_stats.report(days=args.stats_days))
+        exit(0)
+
+    monitor_config = CONFIG.get('monitor', {})
+    monitor_runner = MonitorRunner(monitor_service,
+                                   interval=monitor_config.get('interval', 5),
+                                   idle_interval=monitor_config.get('idle_interval', 30))
+
+    # 独立监控进程模式
+    if args.monitor:
+        signal.signal(signal.SIGTERM, lambda signum, frame: monitor_runner.stop())
+        try:
+            monitor_runner.run()
+        except KeyboardInterrupt:
+            monitor_runner.stop()
+            monitor_service.drain()
+        notification_queue.close()
+        tracer.close()
+        exit(0)
+
     # 手动触发模式
     if args.pre_market or args.midday or args.pre_close or args.sync or args.init_data:
         if args.init_data:
@@ -455,7 +541,10 @@ if __name__ == "__main__":
             run_pre_close_routine(args.test)
         if args.sync:
             run_data_sync_routine(args.test)
+        logging.info(f"LLM cache stats: {llm_cache.stats()}")
         logging.info("Manual execution finished.")
+        notification_queue.close()
+        tracer.close()
         exit(0)
     
     # 默认模式: 启动调度器init_db()
@@ -473,13 +562,14 @@ if __name__ == "__main__":
     scheduler.add_job(run_pre_close_routine, 'cron', hour=t_afternoon[0], minute=t_afternoon[1], day_of_week='mon-fri')
     scheduler.add_job(run_data_sync_routine, 'cron', hour=t_sync[0], minute=t_sync[1], day_of_week='mon-fri')
 
-    # 监控任务 (默认 120s)
-    monitor_interval = 120
-    if 'settings' in CONFIG and 'monitor_interval' in CONFIG['settings']:
-        monitor_interval = CONFIG['settings']['monitor_interval']
-    # IntervalTrigger DOES NOT support day_of_week argument directly. 
-    # Logic for checking weekday/time is already inside run_monitor_task.
-    scheduler.add_job(run_monitor_task, 'interval', seconds=monitor_interval)
+    # 实时监控: 独立于调度器运行，策略流程耗时不影响监控节奏
+    monitor_process = None
+    if monitor_config.get('mode', 'thread') == 'process':
+        profile_args = ['--profile-cpu'] if args.profile_cpu else ['--profile'] if args.profile else []
+        monitor_process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--monitor', *profile_args])
+        logging.info(f"Monitor process started (pid={monitor_process.pid}).")
+    else:
+        monitor_runner.start()
 
     logging.info("Agent Scheduler Started. Press Ctrl+C to exit.")
     print("Agent is running...")
@@ -488,3 +578,13 @@ if __name__ == "__main__":
         scheduler.start()
     except (KeyboardInterrupt, SystemExit):
         pass
+    finally:
+        # 停止监控并等待进行中的触发处理完成 (可能已下单)
+        if monitor_process is not None:
+            monitor_process.terminate()
+            monitor_process.wait(timeout=60)
+        else:
+            monitor_runner.stop(timeout=60)
+        monitor_service.drain()
+        notification_queue.close()
+        tracer.close()